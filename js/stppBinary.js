@@ -0,0 +1,106 @@
+/*jshint esversion: 6 */
+
+/*
+Loader for the binary files written by collectFromFile.py --binary,
+one per year and charter variant at data/<year>/stpp<variant>.bin, where
+the variant is "" for the default, "WithCharters" (--include-charters)
+or "ChartersOnly" (--charters-only). The layout is described next to
+BINARY_MAGIC in makedata/collectFromFile.py.
+
+loadStppYear(year, variant) fetches and decodes a year once, and
+stppView(yearData, groupKey, punishmentKey) returns the same object as
+the matching data/<year>/<groupKey>/<punishmentKey><variant>.json file,
+so the rest of the map can use either one.
+*/
+
+const STPP_MAGIC = "STPP";
+const STPP_VERSION = 1;
+const STPP_MISSING = {"C": -1, "S": -128};
+const STPP_ARRAY_TYPES = {"<i4": Int32Array, "|i1": Int8Array};
+const STPP_VARIANTS = ["", "WithCharters", "ChartersOnly"];
+
+function decodeStppYear(buffer) {
+    const bytes = new Uint8Array(buffer);
+    const magic = String.fromCharCode.apply(null, bytes.subarray(0, 4));
+    if (magic !== STPP_MAGIC) {
+        throw new Error("Not an stpp binary file");
+    }
+    const headerLength = new DataView(buffer).getUint32(4, true);
+    const header = JSON.parse(new TextDecoder().decode(
+        bytes.subarray(8, 8 + headerLength)));
+    if (header.version !== STPP_VERSION) {
+        throw new Error("Unknown stpp binary version " + header.version);
+    }
+    const body = 8 + headerLength;
+    var arrays = {};
+    for (var name in header.arrays) {
+        const offset = header.arrays[name][0];
+        const ArrayType = STPP_ARRAY_TYPES[header.arrays[name][1]];
+        const length = header.arrays[name][2];
+        arrays[name] = new ArrayType(buffer, body + offset, length);
+    }
+    return {year: header.year, arrays: arrays};
+}
+
+function stppPath(year, variant) {
+    variant = variant || "";
+    if (STPP_VARIANTS.indexOf(variant) === -1) {
+        throw new Error("Unknown stpp variant " + variant);
+    }
+    return "data/" + year + "/stpp" + variant + ".bin";
+}
+
+function loadStppYear(year, variant) {
+    return fetch(stppPath(year, variant)).then(function(response) {
+        if (response.ok) {
+            return response.arrayBuffer();
+        }
+        throw new Error('Network response was not ok.');
+    }).then(decodeStppYear);
+}
+
+function stppView(yearData, groupKey, punishmentKey) {
+    const arrays = yearData.arrays;
+    const districts = arrays.districts;
+
+    function value(name, field, i) {
+        if (!(name in arrays) || arrays[name][i] === STPP_MISSING[field]) {
+            return null;
+        }
+        return arrays[name][i];
+    }
+
+    const counts = groupKey + "/" + punishmentKey + "/C";
+    const scales = groupKey + "/" + punishmentKey + "/S";
+    const state = districts.indexOf(0);
+    var view = {};
+    for (var i = 0; i < districts.length; i++) {
+        if (value(counts, "C", i) === null) {
+            continue;
+        }
+        if (groupKey === "ALL") {
+            view[districts[i]] = {
+                "C": value(counts, "C", i),
+                "S": value(scales, "S", i),
+                "P": value("ALL/POP/C", "C", i),
+                "aC": value(counts, "C", state),
+                "aP": value("ALL/POP/C", "C", state)
+            };
+        }
+        else {
+            view[districts[i]] = {
+                "C": value(counts, "C", i),
+                "S": value(scales, "S", i),
+                "P": value(groupKey + "/POP/C", "C", i),
+                "aC": value("ALL/" + punishmentKey + "/C", "C", i),
+                "aP": value("ALL/POP/C", "C", i)
+            };
+        }
+    }
+    return view;
+}
+
+if (typeof module !== "undefined") {
+    module.exports = {decodeStppYear: decodeStppYear, stppPath: stppPath,
+                      stppView: stppView};
+}
@@ -0,0 +1,69 @@
+# use python -m makedata.benchmarks.classifier
+
+"""
+Compares classifying the rows of the 2009 test data with
+classify_headings against the old approach of scanning every row's
+headings for each pattern in HEADING_NAME_IN, HEADING_NAME_OUT and
+SECTION_OUT.
+"""
+
+import time
+
+from makedata import collectFromFile
+
+
+def scan_rows(rows: list, code_index: int, demo_index: int,
+              punishment_index: int) -> list:
+    kept = []
+    for row in rows:
+        row = collectFromFile.relabel_row(
+            row[:], code_index, demo_index, punishment_index)
+        if collectFromFile.keep_headings.__wrapped__(
+                row[demo_index], row[punishment_index]):
+            kept.append(collectFromFile.rename_row(
+                row, demo_index, punishment_index))
+    return kept
+
+
+def classify_rows(rows: list, code_index: int, demo_index: int,
+                  punishment_index: int) -> list:
+    collectFromFile.classify_headings.cache_clear()
+    kept = []
+    for row in rows:
+        labels = collectFromFile.classify_headings(
+            row[code_index], row[demo_index], row[punishment_index])
+        if labels is not None:
+            row = row[:]
+            row[demo_index], row[punishment_index] = labels
+            kept.append(row)
+    return kept
+
+
+def best_time(function, *args, repeat: int = 5) -> float:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(*args)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main() -> None:
+    year_of_records = collectFromFile.get_year(2009)
+    header, rows = year_of_records[0], year_of_records[1:]
+    indexes = (header.index("HEADING"), header.index("HEADING NAME"),
+               header.index("SECTION"))
+    assert scan_rows(rows, *indexes) == classify_rows(rows, *indexes)
+
+    scan = best_time(scan_rows, rows, *indexes)
+    classify = best_time(classify_rows, rows, *indexes)
+    print(f"{len(rows)} rows, "
+          f"{collectFromFile.classify_headings.cache_info().currsize} "
+          "distinct heading combinations")
+    print(f"pattern scan:      {scan * 1000:8.1f} ms")
+    print(f"classify_headings: {classify * 1000:8.1f} ms")
+    print(f"speedup:           {scan / classify:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+# use python -m makedata.benchmarks.export_formats
+
+"""
+Compares the nested JSON export of the 2009 test data with the binary
+export: the bytes on disk, raw and gzipped, and the time to parse one
+demo and punishment, and every one of them, from each format.
+"""
+
+import gzip
+import json
+import os
+import tempfile
+import time
+
+from makedata import collectFromFile
+
+
+def best_time(function, *args, repeat: int = 5) -> float:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(*args)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def sizes(paths: list) -> tuple:
+    raw = gzipped = 0
+    for path in paths:
+        with open(path, 'rb') as f:
+            content = f.read()
+        raw += len(content)
+        gzipped += len(gzip.compress(content))
+    return raw, gzipped
+
+
+def parse_json_files(paths: list) -> list:
+    views = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            views.append(json.loads(f.read()))
+    return views
+
+
+def parse_binary_views(path: str, slices: list) -> list:
+    year_data = collectFromFile.load_binary_year(path)
+    return [collectFromFile.binary_year_to_view(year_data, demo, p)
+            for demo, p in slices]
+
+
+def main() -> None:
+    year = 2009
+    d = collectFromFile.add_year_to_dict(
+        year, collectFromFile.make_empty_dict(year, year),
+        show_progress=False)
+    with tempfile.TemporaryDirectory() as root:
+        collectFromFile.__file__ = os.path.join(root, 'makedata', 'fake.py')
+        json_paths = [path for paths in collectFromFile.dict_to_nested_json(
+            d, year, year).values() for path in paths]
+        binary_path = collectFromFile.dict_to_binary(d, year, year)[year][0]
+        slices = [(demo, p) for demo in d[year]
+                  for p in d[year][demo] if p != "POP"]
+
+        json_raw, json_gzipped = sizes(json_paths)
+        binary_raw, binary_gzipped = sizes([binary_path])
+        one_json = best_time(parse_json_files, json_paths[:1])
+        all_json = best_time(parse_json_files, json_paths)
+        one_binary = best_time(parse_binary_views, binary_path, slices[:1])
+        all_binary = best_time(parse_binary_views, binary_path, slices)
+        load_binary = best_time(collectFromFile.load_binary_year,
+                                binary_path)
+
+    print(f"{len(json_paths)} JSON files against 1 binary file for {year}")
+    print(f"{'':24}{'JSON':>12}{'binary':>12}")
+    print(f"{'bytes':24}{json_raw:12,}{binary_raw:12,}")
+    print(f"{'gzipped bytes':24}{json_gzipped:12,}{binary_gzipped:12,}")
+    print(f"{'parse one view (ms)':24}"
+          f"{one_json * 1000:12.2f}{one_binary * 1000:12.2f}")
+    print(f"{'parse every view (ms)':24}"
+          f"{all_json * 1000:12.2f}{all_binary * 1000:12.2f}")
+    print(f"{'load arrays only (ms)':24}{'':12}{load_binary * 1000:12.2f}")
+
+
+if __name__ == "__main__":
+    main()
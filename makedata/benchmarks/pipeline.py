@@ -0,0 +1,265 @@
+# use python -m makedata.benchmarks.pipeline --help
+
+"""
+Times each stage of the pipeline on the bundled 2009 data, with cold
+caches (an empty file cache, p-value cache, heading lookups and output
+folder before every run) and warm ones (left in place from an earlier
+run). Each stage is also run once under tracemalloc for its peak memory.
+
+The results can be saved as JSON with --output, and compared against an
+earlier run, for instance from another commit, with --compare.
+"""
+
+import contextlib
+import copy
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import tempfile
+import time
+import tracemalloc
+import warnings
+from typing import Callable, Dict, List, Optional, Tuple
+
+import click
+
+from makedata import collectFromFile
+
+
+YEAR = 2009
+
+# In the rows of get_year, after the district names are dropped.
+
+PUNISHMENT_INDEX = 1
+CODE_INDEX = 2
+DEMO_INDEX = 3
+
+
+class Workspace:
+
+    """
+    Temporary folders standing in for data/cache/ and for the project
+    folder that exporters write data/ into, so the benchmark doesn't
+    touch the real ones."""
+
+    def __init__(self, root: str) -> None:
+        self.root = root
+        self.runs = 0
+        self.cache_dir = ""
+        self.project_dir = ""
+        self.new_cache()
+        self.new_project()
+
+    def new_cache(self) -> None:
+        self.runs += 1
+        self.cache_dir = os.path.join(self.root, f'cache{self.runs}')
+        os.makedirs(self.cache_dir)
+        collectFromFile.PVALUE_CACHE = collectFromFile.PValueCache()
+        collectFromFile.classify_headings.cache_clear()
+        collectFromFile.keep_headings.cache_clear()
+        collectFromFile.read_district_file.cache_clear()
+        return None
+
+    def new_project(self) -> None:
+        self.runs += 1
+        self.project_dir = os.path.join(self.root, f'project{self.runs}')
+        os.makedirs(os.path.join(self.project_dir, 'makedata'))
+        return None
+
+    def get_cache_path(self, filename: str) -> str:
+        return os.path.join(self.cache_dir, filename)
+
+
+def prepare_inputs() -> Dict[str, object]:
+
+    """
+    The input of each stage, made once, so each run starts from a copy
+    of the same state."""
+
+    year = collectFromFile.mandatory_and_discretionary(
+        collectFromFile.get_year(YEAR), CODE_INDEX, DEMO_INDEX,
+        PUNISHMENT_INDEX)
+    d = collectFromFile.add_records_to_dict(
+        YEAR, collectFromFile.make_empty_dict(YEAR, YEAR),
+        collectFromFile.make_year_of_records(YEAR),
+        collectFromFile.get_charters())
+    inputs = {"charters": collectFromFile.get_charters(),
+              "relabeled": year,
+              "records": copy.deepcopy(d)}
+    collectFromFile.add_aggregates_to_dict(YEAR, d)
+    inputs["aggregates"] = copy.deepcopy(d)
+    collectFromFile.add_scale_statistic(YEAR, d, show_progress=False)
+    inputs["scores"] = copy.deepcopy(d)
+    collectFromFile.add_district_to_state_scale_statistic(YEAR, d)
+    inputs["complete"] = d
+    return inputs
+
+
+def make_stages(inputs: Dict[str, object],
+                workspace: Workspace
+                ) -> List[Tuple[str, Callable[[], Tuple], Callable]]:
+
+    """
+    Each stage's name, a function making its arguments, which isn't
+    timed, and the function to time."""
+
+    def copy_of(name: str) -> Callable[[], Tuple]:
+        return lambda: (YEAR, copy.deepcopy(inputs[name]))
+
+    def exporter(function: Callable) -> Callable:
+        def export(d: dict) -> None:
+            collectFromFile.__file__ = os.path.join(
+                workspace.project_dir, 'makedata', 'collectFromFile.py')
+            function(d, YEAR, YEAR)
+        return export
+
+    complete = lambda: (inputs["complete"],)
+    return [
+        ("get_year", lambda: (YEAR,), collectFromFile.get_year),
+        ("make_year_of_records", lambda: (YEAR,),
+         collectFromFile.make_year_of_records),
+        ("filter_records",
+         lambda: ([row[:] for row in inputs["relabeled"]],
+                  DEMO_INDEX, PUNISHMENT_INDEX),
+         collectFromFile.filter_records),
+        ("add_zeros_to_dict", copy_of("records"),
+         collectFromFile.add_zeros_to_dict),
+        ("add_aggregates_to_dict", copy_of("records"),
+         collectFromFile.add_aggregates_to_dict),
+        ("add_scale_statistic", copy_of("aggregates"),
+         lambda year, d: collectFromFile.add_scale_statistic(
+             year, d, show_progress=False)),
+        ("add_district_to_state_scale_statistic", copy_of("scores"),
+         collectFromFile.add_district_to_state_scale_statistic),
+        ("add_year_to_dict",
+         lambda: (YEAR, collectFromFile.make_empty_dict(YEAR, YEAR)),
+         lambda year, d: collectFromFile.add_year_to_dict(
+             year, d, show_progress=False)),
+        ("dict_to_nested_json", complete,
+         exporter(collectFromFile.dict_to_nested_json)),
+        ("dict_to_nested", complete,
+         exporter(collectFromFile.dict_to_nested)),
+        ("dict_to_json", complete, exporter(collectFromFile.dict_to_json)),
+        ("dict_to_binary", complete,
+         exporter(collectFromFile.dict_to_binary)),
+        ("dict_to_sqlite", complete,
+         exporter(lambda d, first, last: collectFromFile.dict_to_sqlite(
+             d, first, last, charters=inputs["charters"]))),
+    ]
+
+
+def time_stage(setup: Callable[[], Tuple], run: Callable,
+               workspace: Workspace, cold: bool, repeat: int
+               ) -> Dict[str, float]:
+    times = []
+    if not cold:
+        run(*setup())
+    for _ in range(repeat):
+        if cold:
+            workspace.new_cache()
+            workspace.new_project()
+        args = setup()
+        start = time.perf_counter()
+        run(*args)
+        times.append(time.perf_counter() - start)
+
+    if cold:
+        workspace.new_cache()
+        workspace.new_project()
+    args = setup()
+    tracemalloc.start()
+    run(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {"min_s": min(times),
+            "median_s": statistics.median(times),
+            "peak_mb": peak / 1e6}
+
+
+def get_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            check=True).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results: List[dict],
+                  baseline: Optional[List[dict]] = None) -> None:
+    before = {(r["stage"], r["cache"]): r for r in baseline or []}
+    header = f"{'stage':40}{'cache':>6}{'min ms':>11}{'median ms':>11}" \
+             f"{'peak MB':>9}"
+    print(header + (f"{'before ms':>11}{'ratio':>8}" if baseline else ""))
+    for r in results:
+        line = f"{r['stage']:40}{r['cache']:>6}{r['min_s'] * 1000:11.1f}" \
+               f"{r['median_s'] * 1000:11.1f}{r['peak_mb']:9.1f}"
+        old = before.get((r["stage"], r["cache"]))
+        if old is not None:
+            line += f"{old['min_s'] * 1000:11.1f}" \
+                    f"{r['min_s'] / old['min_s']:8.2f}"
+        print(line)
+    return None
+
+
+@click.command()
+@click.option('--repeat', '-r', type=click.IntRange(1, None), default=3,
+              help="Timed runs of each stage with each kind of cache.")
+@click.option('--stage', '-s', 'stages', multiple=True,
+              help="Only run stages with names containing this. Can be "
+              "given more than once.")
+@click.option('--output', '-o', type=click.Path(dir_okay=False),
+              help="Saves the results to this JSON file.")
+@click.option('--compare', '-c', type=click.Path(exists=True,
+                                                  dir_okay=False),
+              help="A JSON file from an earlier run to compare against.")
+def main(repeat: int,
+         stages: Tuple[str, ...],
+         output: Optional[str],
+         compare: Optional[str]) -> None:
+    warnings.simplefilter("ignore")
+    inputs = prepare_inputs()
+    results = []
+    with tempfile.TemporaryDirectory() as root:
+        workspace = Workspace(root)
+        collectFromFile.FILE_CACHE_ENABLED = True
+        collectFromFile.get_cache_path = workspace.get_cache_path
+        project_file = collectFromFile.__file__
+        for name, setup, run in make_stages(inputs, workspace):
+            if stages and not any(stage in name for stage in stages):
+                continue
+            for cache in ("cold", "warm"):
+                # Reading the TEA files needs the real project folder.
+                collectFromFile.__file__ = project_file
+                click.echo(f"{name} ({cache})", err=True)
+                result = {"stage": name, "cache": cache}
+                # Keeps the exporters' messages out of the results.
+                with contextlib.redirect_stdout(io.StringIO()):
+                    result.update(time_stage(setup, run, workspace,
+                                             cache == "cold", repeat))
+                results.append(result)
+        collectFromFile.__file__ = project_file
+
+    baseline = None
+    if compare:
+        with open(compare) as f:
+            baseline = json.load(f)["results"]
+    print_results(results, baseline)
+    if output:
+        with open(output, 'w') as f:
+            json.dump({"commit": get_commit(),
+                       "python": platform.python_version(),
+                       "machine": platform.platform(),
+                       "year": YEAR,
+                       "repeat": repeat,
+                       "results": results}, f, indent=1)
+    return None
+
+
+if __name__ == "__main__":
+    main()
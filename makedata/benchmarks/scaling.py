@@ -0,0 +1,186 @@
+# use python -m makedata.benchmarks.scaling --help
+
+"""
+Measures how building and exporting a year grow with the number of
+districts, using synthetic TEA files from makedata.synthetic: about
+1,200 districts like Texas, 10 times as many like campus-level data,
+or more. Each stage starts with empty caches and output folders.
+
+For each stage and size, prints the best time, the throughput in input
+rows (for reading and building) or districts (for exports) per second,
+the peak memory under tracemalloc, and how fast the time grows between
+sizes, as the exponent k in time ~ districts ** k.
+"""
+
+import contextlib
+import io
+import json
+import math
+import os
+import platform
+import shutil
+import tempfile
+import time
+import tracemalloc
+import warnings
+from typing import Callable, Dict, List, Optional, Tuple
+
+import click
+
+from makedata import collectFromFile, synthetic
+from makedata.benchmarks.pipeline import get_commit
+
+
+YEAR = 2009
+
+
+def reset(root: str) -> None:
+
+    """
+    Points collectFromFile at the synthetic files under root, and
+    clears the caches and exported files left by the last run."""
+
+    collectFromFile.__file__ = os.path.join(root, 'makedata',
+                                            'collectFromFile.py')
+    collectFromFile.PVALUE_CACHE = collectFromFile.PValueCache()
+    collectFromFile.classify_headings.cache_clear()
+    collectFromFile.keep_headings.cache_clear()
+    collectFromFile.read_district_file.cache_clear()
+    for folder in (str(YEAR), 'processed'):
+        shutil.rmtree(os.path.join(root, 'data', folder), ignore_errors=True)
+    return None
+
+
+def make_stages(d: dict) -> List[Tuple[str, str, Callable[[], object]]]:
+
+    """
+    Each stage's name, whether its throughput is counted in input rows
+    or districts, and the function to time. The exports use d, the year
+    already built from the same files."""
+
+    def exporter(function: Callable) -> Callable[[], object]:
+        return lambda: function(d, YEAR, YEAR)
+
+    return [
+        ("make_year_of_records", "rows",
+         lambda: collectFromFile.make_year_of_records(YEAR)),
+        ("add_year_to_dict", "rows",
+         lambda: collectFromFile.add_year_to_dict(
+             YEAR, collectFromFile.make_empty_dict(YEAR, YEAR),
+             show_progress=False)),
+        ("dict_to_nested_json", "districts",
+         exporter(collectFromFile.dict_to_nested_json)),
+        ("dict_to_json", "districts", exporter(collectFromFile.dict_to_json)),
+        ("dict_to_binary", "districts",
+         exporter(collectFromFile.dict_to_binary)),
+        ("dict_to_sqlite", "districts",
+         exporter(collectFromFile.dict_to_sqlite)),
+    ]
+
+
+def time_stage(run: Callable[[], object], root: str,
+               repeat: int) -> Dict[str, float]:
+    times = []
+    for _ in range(repeat):
+        reset(root)
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    reset(root)
+    tracemalloc.start()
+    run()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {"min_s": min(times), "peak_mb": peak / 1e6}
+
+
+def measure_size(root: str, districts: int, repeat: int,
+                 stages: Tuple[str, ...]) -> List[dict]:
+    rows = synthetic.generate(root, districts, [YEAR])[YEAR]
+    reset(root)
+    d = collectFromFile.add_year_to_dict(
+        YEAR, collectFromFile.make_empty_dict(YEAR, YEAR),
+        show_progress=False)
+    results = []
+    for name, unit, run in make_stages(d):
+        if stages and not any(stage in name for stage in stages):
+            continue
+        click.echo(f"{name} ({districts:,} districts)", err=True)
+        result = {"stage": name, "districts": districts, "rows": rows}
+        # Keeps the exporters' messages out of the results.
+        with contextlib.redirect_stdout(io.StringIO()):
+            result.update(time_stage(run, root, repeat))
+        result["per_second"] = (rows if unit == "rows" else districts) \
+            / result["min_s"]
+        result["unit"] = unit
+        results.append(result)
+    return results
+
+
+def growth(result: dict, smaller: Optional[dict]) -> Optional[float]:
+    if smaller is None or smaller["min_s"] <= 0:
+        return None
+    return math.log(result["min_s"] / smaller["min_s"]) \
+        / math.log(result["districts"] / smaller["districts"])
+
+
+def print_results(results: List[dict]) -> None:
+    print(f"{'stage':24}{'districts':>10}{'rows':>11}{'min ms':>11}"
+          f"{'per second':>21}{'peak MB':>9}{'growth':>8}")
+    order = {stage: i for i, stage in enumerate(
+        dict.fromkeys(r["stage"] for r in results))}
+    last: Dict[str, dict] = {}
+    for r in sorted(results,
+                    key=lambda r: (order[r["stage"]], r["districts"])):
+        k = growth(r, last.get(r["stage"]))
+        print(f"{r['stage']:24}{r['districts']:10,}{r['rows']:11,}"
+              f"{r['min_s'] * 1000:11.1f}"
+              f"{r['per_second']:11,.0f} {r['unit']:9}"
+              f"{r['peak_mb']:9.1f}{'' if k is None else f'{k:.2f}':>8}")
+        last[r["stage"]] = r
+    return None
+
+
+@click.command()
+@click.option('--districts', '-n', 'sizes', type=click.IntRange(1, None),
+              multiple=True, help="A number of districts to measure. Can be "
+              "given more than once. Defaults to 1,200, 6,000 and 12,000.")
+@click.option('--repeat', '-r', type=click.IntRange(1, None), default=1,
+              help="Timed runs of each stage at each size.")
+@click.option('--stage', '-s', 'stages', multiple=True,
+              help="Only run stages with names containing this. Can be "
+              "given more than once.")
+@click.option('--output', '-o', type=click.Path(dir_okay=False),
+              help="Saves the results to this JSON file.")
+def main(sizes: Tuple[int, ...],
+         repeat: int,
+         stages: Tuple[str, ...],
+         output: Optional[str]) -> None:
+    warnings.simplefilter("ignore")
+    sizes = tuple(sorted(sizes or (1200, 6000, 12000)))
+    project_file = collectFromFile.__file__
+    cache_enabled = collectFromFile.FILE_CACHE_ENABLED
+    collectFromFile.FILE_CACHE_ENABLED = False
+    results = []
+    try:
+        for districts in sizes:
+            with tempfile.TemporaryDirectory() as root:
+                results += measure_size(root, districts, repeat, stages)
+    finally:
+        collectFromFile.__file__ = project_file
+        collectFromFile.FILE_CACHE_ENABLED = cache_enabled
+
+    print_results(results)
+    if output:
+        with open(output, 'w') as f:
+            json.dump({"commit": get_commit(),
+                       "python": platform.python_version(),
+                       "machine": platform.platform(),
+                       "year": YEAR,
+                       "repeat": repeat,
+                       "results": results}, f, indent=1)
+    return None
+
+
+if __name__ == "__main__":
+    main()
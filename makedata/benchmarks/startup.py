@@ -0,0 +1,185 @@
+# use python -m makedata.benchmarks.startup --help
+
+"""
+Measures how long the collectFromFile command takes to start, running
+it in a new interpreter under python -X importtime for --help, for a
+--download run that only checks the files already downloaded, and for
+a full run building one year of synthetic TEA files from
+makedata.synthetic.
+
+For each run, prints the best and median wall time of the whole
+command, the time spent importing, the time to import collectFromFile
+itself, and the time to import each of the slow packages it uses, or
+"-" if the run didn't import it, along with numpy's share of the time
+spent importing.
+"""
+
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import warnings
+from typing import Dict, List, Optional
+
+import click
+
+from makedata import synthetic
+from makedata.benchmarks.pipeline import get_commit
+
+
+YEAR = 2009
+
+# Each slow package, with the packages it imports that this one doesn't.
+
+PACKAGES = {
+    "numpy": ("numpy",),
+    "click": ("click",),
+    "scipy": ("scipy",),
+    "requests": ("requests", "urllib3", "idna", "charset_normalizer",
+                 "chardet"),
+}
+
+# Runs the command as if it were installed, with its data folder in root.
+
+COMMAND = """
+import os, sys
+root = sys.argv.pop(1)
+from makedata import collectFromFile as c
+c.__file__ = os.path.join(root, 'makedata', 'collectFromFile.py')
+c.cli(prog_name='collectFromFile')
+"""
+
+RUNS = (
+    ("cli --help", ["--help"]),
+    ("download only", ["--download", "--skip-processing",
+                       "-f", str(YEAR), "-l", str(YEAR)]),
+    ("full run", ["--no-cache", "-f", str(YEAR), "-l", str(YEAR)]),
+)
+
+
+def parse_importtime(stderr: str) -> Dict[str, float]:
+
+    """
+    The total time spent importing, in seconds, the cumulative time of
+    importing collectFromFile, and the time spent in the modules of each
+    of PACKAGES, which is left out if none of them were imported."""
+
+    times = {"imports": 0.0}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        own, cumulative, name = line[len("import time:"):].split("|")
+        times["imports"] += int(own) / 1e6
+        name = name.strip()
+        if name == "makedata.collectFromFile":
+            times[name] = int(cumulative) / 1e6
+        for package, prefixes in PACKAGES.items():
+            if name.split(".")[0] in prefixes:
+                times[package] = times.get(package, 0.0) + int(own) / 1e6
+    return times
+
+
+def time_run(root: str, args: List[str]) -> Dict[str, float]:
+    project_dir = os.path.dirname(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))))
+    env = dict(os.environ, PYTHONPATH=project_dir)
+    start = time.perf_counter()
+    finished = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", COMMAND, root] + args,
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, env=env)
+    wall = time.perf_counter() - start
+    stderr = finished.stderr.decode(errors="replace")
+    if finished.returncode != 0:
+        raise click.ClickException(f"collectFromFile {' '.join(args)} "
+                                   f"failed:\n{stderr[-2000:]}")
+    return {"wall_s": wall, **parse_importtime(stderr)}
+
+
+def measure(root: str, name: str, args: List[str],
+            repeat: int) -> dict:
+    runs = [time_run(root, args) for _ in range(repeat)]
+    walls = [run["wall_s"] for run in runs]
+    result = {"run": name, "args": args,
+              "min_s": min(walls), "median_s": statistics.median(walls)}
+    for key in ("imports", "makedata.collectFromFile", *PACKAGES):
+        values = [run[key] for run in runs if key in run]
+        result[key] = min(values) if values else None
+    return result
+
+
+def print_results(results: List[dict],
+                  baseline: Optional[List[dict]] = None) -> None:
+
+    def ms(seconds: Optional[float]) -> str:
+        return "-" if seconds is None else f"{seconds * 1000:.1f}"
+
+    def percent(part: Optional[float], whole: Optional[float]) -> str:
+        return "-" if part is None or not whole else f"{part / whole:.0%}"
+
+    before = {r["run"]: r for r in baseline or []}
+    columns = ("imports", "collectFromFile", *PACKAGES)
+    header = f"{'run':14}{'min ms':>10}{'median ms':>11}" \
+             + "".join(f"{column:>17}" if column == "collectFromFile"
+                       else f"{column:>10}" for column in columns) \
+             + f"{'numpy %':>9}"
+    print(header + (f"{'before ms':>11}{'ratio':>8}" if baseline else ""))
+    for r in results:
+        line = f"{r['run']:14}{ms(r['min_s']):>10}{ms(r['median_s']):>11}" \
+               f"{ms(r['imports']):>10}" \
+               f"{ms(r['makedata.collectFromFile']):>17}" \
+               + "".join(f"{ms(r[package]):>10}" for package in PACKAGES) \
+               + f"{percent(r['numpy'], r['imports']):>9}"
+        old = before.get(r["run"])
+        if old is not None:
+            line += f"{ms(old['min_s']):>11}{r['min_s'] / old['min_s']:8.2f}"
+        print(line)
+    return None
+
+
+@click.command()
+@click.option('--repeat', '-r', type=click.IntRange(1, None), default=5,
+              help="Timed runs of each command.")
+@click.option('--districts', '-n', type=click.IntRange(1, None),
+              default=1200, help="The number of districts in the "
+              "synthetic files for the full run.")
+@click.option('--output', '-o', type=click.Path(dir_okay=False),
+              help="Saves the results to this JSON file.")
+@click.option('--compare', '-c', type=click.Path(exists=True,
+                                                  dir_okay=False),
+              help="A JSON file from an earlier run to compare against.")
+def main(repeat: int,
+         districts: int,
+         output: Optional[str],
+         compare: Optional[str]) -> None:
+    warnings.simplefilter("ignore")
+    results = []
+    with tempfile.TemporaryDirectory() as root:
+        os.makedirs(os.path.join(root, 'makedata'))
+        synthetic.generate(root, districts, [YEAR])
+        for name, args in RUNS:
+            click.echo(name, err=True)
+            results.append(measure(root, name, args, repeat))
+
+    baseline = None
+    if compare:
+        with open(compare) as f:
+            baseline = json.load(f)["results"]
+    print_results(results, baseline)
+    if output:
+        with open(output, 'w') as f:
+            json.dump({"commit": get_commit(),
+                       "python": platform.python_version(),
+                       "machine": platform.platform(),
+                       "year": YEAR,
+                       "districts": districts,
+                       "repeat": repeat,
+                       "results": results}, f, indent=1)
+    return None
+
+
+if __name__ == "__main__":
+    main()
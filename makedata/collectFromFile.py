@@ -1,35 +1,300 @@
+import cProfile
 import csv
+import hashlib
+import io
 import json
 import os
+import pickle
+import pstats
 import random
+import sqlite3
+import sys
+import tempfile
+import threading
 import time
-from typing import Dict
+import zlib
+from collections import OrderedDict
+from collections.abc import Mapping
+from concurrent.futures import (ProcessPoolExecutor, ThreadPoolExecutor,
+                                as_completed)
+from contextlib import contextmanager
+from functools import lru_cache
+from itertools import islice
+from typing import (TYPE_CHECKING, Any, Callable, Dict, Hashable, Iterable,
+                    Iterator, List, Optional, Sequence, Tuple, Union)
 
 
 import click
-import requests
-import scipy.stats as stats
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
-def load_region_file(apple_path: str) -> list:
+try:
+    import resource
+except ImportError:
+    # Not on Windows, where peak memory isn't reported.
+    resource = None
+
+# scipy.stats and requests take longer to import than everything else
+# here together, so they're imported by the functions that score and
+# download, and a run that does neither never loads them. numpy is next,
+# so it's imported by the functions that read and score the data, and
+# --help or a run that only downloads doesn't load it either.
+
+if TYPE_CHECKING:
+    import numpy as np
+    import requests
+
+
+
+# Turned on by the CLI's --cache option.
+
+FILE_CACHE_ENABLED = False
+
+# Change this when the cleaning rules change, to discard old caches.
+
+FILE_CACHE_VERSION = 2
+
+# What pickle.load can raise for a cache file that's truncated, corrupt,
+# or refers to code that has since changed.
+
+CACHE_LOAD_ERRORS = (OSError, EOFError, pickle.UnpicklingError,
+                     AttributeError, ImportError, IndexError, TypeError,
+                     ValueError)
+
+
+def get_cache_path(filename: str) -> str:
+    dirname = os.path.dirname
+    return os.path.join(dirname(dirname(__file__)),
+                        os.path.join('data', 'cache', filename))
+
+
+def get_district_path(year: int) -> str:
+    dirname = os.path.dirname
+    return os.path.join(dirname(dirname(__file__)),
+                        os.path.join('data', 'from_agency', 'districts',
+                        f'district{year}.dat'))
+
+
+def get_file_signature(path: str,
+                       known: Optional[dict] = None) -> dict:
+
+    """
+    Describes a source file by its size, mtime and a hash of its
+    contents. If the size and mtime match the known signature, the file
+    isn't read again and the known hash is reused."""
+
+    stat = os.stat(path)
+    signature = {"size": stat.st_size, "mtime": stat.st_mtime_ns}
+    if known and all(known.get(k) == v for k, v in signature.items()):
+        signature["sha256"] = known["sha256"]
+        return signature
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    signature["sha256"] = sha.hexdigest()
+    return signature
+
+
+def cache_matches_sources(metadata: dict,
+                          source_paths: Sequence[str]) -> bool:
+    if metadata.get("version") != FILE_CACHE_VERSION:
+        return False
+    known = metadata.get("sources", [])
+    if len(known) != len(source_paths):
+        return False
+    for path, signature in zip(source_paths, known):
+        current = get_file_signature(path, signature)
+        if current["sha256"] != signature["sha256"]:
+            return False
+    return True
+
+
+def read_cache(cache_path: str,
+               source_paths: Sequence[str]) -> Optional[Iterator]:
+    try:
+        f = open(cache_path, 'rb')
+    except OSError:
+        return None
+    try:
+        metadata = pickle.load(f)
+        fresh = cache_matches_sources(metadata, source_paths)
+    except CACHE_LOAD_ERRORS:
+        fresh = False
+    if not fresh:
+        f.close()
+        return None
+
+    def items() -> Iterator:
+
+        # The last chunk is followed by None, so a file cut off between
+        # two chunks raises EOFError like any other truncated file.
+
+        with f:
+            while True:
+                chunk = pickle.load(f)
+                if chunk is None:
+                    return
+                yield from chunk
+
+    return items()
+
+
+def write_cache(cache_path: str,
+                source_paths: Sequence[str],
+                items: Iterable,
+                chunk_size: int = 2000) -> Iterator:
+
+    """
+    Passes items through while pickling them, in chunks, to a temporary
+    file that replaces the cache file only after the last item."""
+
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    metadata = {"version": FILE_CACHE_VERSION,
+                "sources": [get_file_signature(path)
+                            for path in source_paths]}
+    temp_path = f'{cache_path}.{os.getpid()}.tmp'
+    try:
+        with open(temp_path, 'wb') as f:
+            pickle.dump(metadata, f, protocol=pickle.HIGHEST_PROTOCOL)
+            chunk = []
+            for item in items:
+                chunk.append(item)
+                if len(chunk) == chunk_size:
+                    pickle.dump(chunk, f, protocol=pickle.HIGHEST_PROTOCOL)
+                    chunk = []
+                yield item
+            pickle.dump(chunk, f, protocol=pickle.HIGHEST_PROTOCOL)
+            pickle.dump(None, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, cache_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def cached_stream(filename: str,
+                  source_paths: Sequence[str],
+                  build: Callable[[], Iterable]) -> Iterator:
+
+    """
+    Yields the items made by build(). When FILE_CACHE_ENABLED, the items
+    are also saved to data/cache/filename, and later calls load them from
+    there instead, until the size, mtime and hash of any of the source
+    files show that it has changed (for instance after --download). If
+    the cache file turns out to be unreadable partway through, it's
+    rebuilt, and the items not yet yielded are taken from build()."""
+
+    if not FILE_CACHE_ENABLED:
+        yield from build()
+        return
+    cache_path = get_cache_path(filename)
+    cached = read_cache(cache_path, source_paths)
+    yielded = 0
+    while cached is not None:
+        try:
+            item = next(cached)
+        except StopIteration:
+            return
+        except CACHE_LOAD_ERRORS:
+            break
+        yield item
+        yielded += 1
+    yield from islice(write_cache(cache_path, source_paths, build()),
+                      yielded, None)
+
+
+def cached_value(filename: str,
+                 source_paths: Sequence[str],
+                 build: Callable[[], Any]) -> Any:
+    return list(cached_stream(filename, source_paths,
+                              lambda: [build()]))[0]
+
+
+def iter_region_file(apple_path: str) -> Iterator[list]:
     with open(apple_path) as csvfile:
         reader = csv.reader(csvfile)
-        region_records = [row[3:] # ignoring district names for now
-                          for row in reader]
-    return region_records
+        for row in reader:
+            yield row[3:] # ignoring district names for now
 
-def get_year(year: int) -> list:
+
+def load_region_file(apple_path: str) -> list:
+    return list(iter_region_file(apple_path))
+
+
+def get_region_path(year: int, region: int) -> str:
     dirname = os.path.dirname
-    apple_path = os.path.join(dirname(dirname(__file__)),
-                              os.path.join('data', 'from_agency', 'by_region',
-                              'REGION_{}_DISTRICT_summary_{}.csv'))
-    one_year = [load_region_file(apple_path.format(str(region).zfill(2),str(year)[-2:]))
-                for region in range(1,21)]
-    one_year = [row for sublist in one_year for row in sublist]
-    one_year[1:] = [row for row in one_year[1:]
-                    if row != one_year[0] if len(row) == len(one_year[0])]
-    return one_year
+    return os.path.join(dirname(dirname(__file__)),
+                        os.path.join('data', 'from_agency', 'by_region',
+                        f'REGION_{str(region).zfill(2)}_DISTRICT_summary_'
+                        f'{str(year)[-2:]}.csv'))
+
+
+def iter_year(year: int) -> Iterator[list]:
+
+    """
+    Yields the header of the first region file, then the rows of all
+    20 region files, one at a time, skipping the other files' headers
+    and any rows that don't match the header's length."""
+
+    header = None
+    for region in range(1, 21):
+        for row in iter_region_file(get_region_path(year, region)):
+            if header is None:
+                header = row
+                yield row
+            elif row != header and len(row) == len(header):
+                yield row
+
+
+def get_year(year: int) -> list:
+    return list(iter_year(year))
+
+
+CODE_HEADINGS = {
+    "B04": ("EXP", "CNT"),
+    "B05": ("EXP", "MAN"),
+    "B06": ("EXP", "DIS"),
+    "B07": ("DAE", "CNT"),
+    "B08": ("DAE", "MAN"),
+    "B09": ("DAE", "DIS"),
+    "B10": ("ISS", "CNT"),
+    "B11": ("ISS", "MAN"),
+    "B12": ("ISS", "DIS"),
+    "B13": ("OSS", "CNT"),
+    "B14": ("OSS", "MAN"),
+    "B15": ("OSS", "DIS"),
+    "D05": ("EXP", "SPE"),
+    "D06": ("EXP", "NON"),
+    "D08": ("DAE", "SPE"),
+    "D09": ("DAE", "NON"),
+    "D11": ("OSS", "SPE"),
+    "D12": ("OSS", "NON"),
+    "D14": ("ISS", "SPE"),
+    "D15": ("ISS", "NON"),
+    "E06": ("EXP", "ECO"),
+    "E10": ("DAE", "ECO"),
+    "E14": ("OSS", "ECO"),
+    "E18": ("ISS", "ECO"),
+
+}
+
+
+def relabel_row(row: list,
+                code_index: int,
+                demo_index: int,
+                punishment_index: int) -> list:
+    if row[code_index] in CODE_HEADINGS:
+        row[punishment_index] = CODE_HEADINGS[row[code_index]][0]
+        row[demo_index] = CODE_HEADINGS[row[code_index]][1]
+    return row
 
 
 def mandatory_and_discretionary(year_of_records: list,
@@ -37,38 +302,8 @@ def mandatory_and_discretionary(year_of_records: list,
                                 demo_index: int,
                                 punishment_index: int) -> list:
 
-    code_headings = {
-        "B04": ("EXP", "CNT"),
-        "B05": ("EXP", "MAN"),
-        "B06": ("EXP", "DIS"),
-        "B07": ("DAE", "CNT"),
-        "B08": ("DAE", "MAN"),
-        "B09": ("DAE", "DIS"),
-        "B10": ("ISS", "CNT"),
-        "B11": ("ISS", "MAN"),
-        "B12": ("ISS", "DIS"),
-        "B13": ("OSS", "CNT"),
-        "B14": ("OSS", "MAN"),
-        "B15": ("OSS", "DIS"),
-        "D05": ("EXP", "SPE"),
-        "D06": ("EXP", "NON"),
-        "D08": ("DAE", "SPE"),
-        "D09": ("DAE", "NON"),
-        "D11": ("OSS", "SPE"),
-        "D12": ("OSS", "NON"),
-        "D14": ("ISS", "SPE"),
-        "D15": ("ISS", "NON"),
-        "E06": ("EXP", "ECO"),
-        "E10": ("DAE", "ECO"),
-        "E14": ("OSS", "ECO"),
-        "E18": ("ISS", "ECO"),
-
-    }
-
     for row in year_of_records:
-        if row[code_index] in code_headings:
-            row[punishment_index] = code_headings[row[code_index]][0]
-            row[demo_index] = code_headings[row[code_index]][1]
+        relabel_row(row, code_index, demo_index, punishment_index)
     return year_of_records
 
 
@@ -77,139 +312,178 @@ def filter_year_by_column(year_of_records: list,
                           pattern: tuple,
                           keep_matches: bool = False) -> list:
 
+    # Each distinct value in the column is only checked against the
+    # pattern once.
+
+    values = {row[column_index] for row in year_of_records[1:]}
     if keep_matches:
-        year_of_records[1:] = [row for row in year_of_records[1:]
-                                if any(word in row[column_index]
-                                    for word in pattern)]
+        keep = {value for value in values
+                if any(word in value for word in pattern)}
     else:
-        year_of_records[1:] = [row for row in year_of_records[1:]
-                        if all(word not in row[column_index]
-                            for word in pattern)]
+        keep = {value for value in values
+                if all(word not in value for word in pattern)}
+    year_of_records[1:] = [row for row in year_of_records[1:]
+                           if row[column_index] in keep]
 
     return year_of_records
 
 
+# Keeping only the rows that categorize students by protected class,
+# or that have totals.
+
+HEADING_NAME_IN = ("WHITE",
+                   "AFRICAN AMERICAN",
+                   "AMERICAN INDIAN OR ALASKA NAT",
+                   "HISPANIC",
+                   "NATIVE HAWAIIAN",
+                   "ASIAN",
+                   "TWO OR MORE RACES",
+                   "SPEC. ED",
+                   "ECO. DISAD",
+                   "ECO DISAD.",
+                   "TOTAL",
+                   "DISTRICT CUMULATIVE YEAR END ENROLLMENT",
+                   "MANDATORY",
+                   "DISCRETIONARY",
+                   "NATIVE AMERICAN",
+                   "NON",
+                   "SPE",
+                   "MAN",
+                   "DIS")
+
+# Getting rid of rows that count students instead of incidents, or
+# non-disadvantaged kids.
+
+HEADING_NAME_OUT = ("SPEC. ED. STUDENTS",
+                    "EXPULSIONS TO JJAEP",
+                    "ECO DISAD. STUDENTS",
+                    "ECO. DISAD. STUDENTS",
+                    "AT RISK",
+                    "NON AT",
+                    "NON TITLE",
+                    "NON-TITLE",
+                    "NON-ILLEGAL",
+                    "UNKNOWN AT",
+                    "UNKNOWN ECO STATUS",
+                    "NON ECO DISAD.",
+                    "NON ECO. DISAD.",
+                    "REMOVAL",
+                    "MANSLAUGHTER",
+                    "DISRUPTIVE",
+                    "DISTRICT DISCIPLINE POPULATION",
+                    "DISTRICT DISCIPLINE RECORD COUNT",
+                    "DIST EMP",
+                    "DISTRICT EMPLOYEE",
+                    )
+
+# Delete rows appearing to double-count the same expulsions.
+
+SECTION_OUT = ("M-ECO. DISADV. JJAEP PLACEMENTS",
+               "H-SPEC. ED. JJAEP EXPULSIONS",
+               "JJAEP EXPULSIONS",
+               "DISCIPLINE ACTION COUNTS")
+
+
+@lru_cache(maxsize=None)
+def keep_headings(heading_name: str, section: str) -> bool:
+    return (any(word in heading_name for word in HEADING_NAME_IN)
+            and all(word not in heading_name for word in HEADING_NAME_OUT)
+            and all(word not in section for word in SECTION_OUT))
+
+
+def keep_row(row: list,
+             demo_index: int,
+             punishment_index: int) -> bool:
+    return keep_headings(row[demo_index], row[punishment_index])
+
+
 def filter_records(year_of_records: list,
                    demo_index: int,
                    punishment_index: int) -> list:
 
-    # Keeping only the rows that categorize students by protected class,
-    # or that have totals.
-
-    heading_name_in = ("WHITE",
-                       "AFRICAN AMERICAN",
-                       "AMERICAN INDIAN OR ALASKA NAT",
-                       "HISPANIC",
-                       "NATIVE HAWAIIAN",
-                       "ASIAN",
-                       "TWO OR MORE RACES",
-                       "SPEC. ED",
-                       "ECO. DISAD",
-                       "ECO DISAD.",
-                       "TOTAL",
-                       "DISTRICT CUMULATIVE YEAR END ENROLLMENT",
-                       "MANDATORY",
-                       "DISCRETIONARY",
-                       "NATIVE AMERICAN",
-                       "NON",
-                       "SPE",
-                       "MAN",
-                       "DIS")
-
-    year_of_records = filter_year_by_column(year_of_records,
-                          demo_index, heading_name_in, keep_matches=True)
-
-    # Getting rid of rows that count students instead of incidents, or
-    # non-disadvantaged kids.
-
-    heading_name_out = ("SPEC. ED. STUDENTS",
-                        "EXPULSIONS TO JJAEP",
-                        "ECO DISAD. STUDENTS",
-                        "ECO. DISAD. STUDENTS",
-                        "AT RISK",
-                        "NON AT",
-                        "NON TITLE",
-                        "NON-TITLE",
-                        "NON-ILLEGAL",
-                        "UNKNOWN AT",
-                        "UNKNOWN ECO STATUS",
-                        "NON ECO DISAD.",
-                        "NON ECO. DISAD.",
-                        "REMOVAL",
-                        "MANSLAUGHTER",
-                        "DISRUPTIVE",
-                        "DISTRICT DISCIPLINE POPULATION",
-                        "DISTRICT DISCIPLINE RECORD COUNT",
-                        "DIST EMP",
-                        "DISTRICT EMPLOYEE",
-                        )
-
-
-    year_of_records = filter_year_by_column(year_of_records,
-                          demo_index, heading_name_out, keep_matches=False)
-
-    # Delete rows appearing to double-count the same expulsions.
-
-    section_out = ("M-ECO. DISADV. JJAEP PLACEMENTS",
-                   "H-SPEC. ED. JJAEP EXPULSIONS",
-                   "JJAEP EXPULSIONS",
-                   "DISCIPLINE ACTION COUNTS")
-
-    year_of_records = filter_year_by_column(year_of_records,
-                         punishment_index, section_out, keep_matches=False)
-
+    year_of_records[1:] = [row for row in year_of_records[1:]
+                           if keep_row(row, demo_index, punishment_index)]
     return year_of_records
 
 
+CATEGORY_NAMES = {
+    "SECTION": {
+        'A-PARTICIPATION': 'POP',
+        'D-EXPULSION ACTIONS': 'EXP',
+        'N-ECO. DISADV. EXPULSIONS': 'EXP',
+        'I-SPEC. ED. EXPULSIONS': 'EXP',
+        'E-DAEP PLACEMENTS': 'DAE',
+        'O-ECO. DISADV. DAEP PLACEMENTS': 'DAE',
+        'J-SPEC. ED. DAEP PLACEMENTS': 'DAE',
+        'F-OUT OF SCHOOL SUSPENSIONS': 'OSS',
+        'P-ECO. DISADV. OUT OF SCHOOL SUS.': 'OSS',
+        'K-SPEC. ED. OUT OF SCHOOL SUS.': 'OSS',
+        'G-IN SCHOOL SUSPENSIONS': 'ISS',
+        'Q-ECO. DISADV. IN SCHOOL SUS.': 'ISS',
+        'L-SPEC. ED. IN SCHOOL SUS.': 'ISS',
+        },
+    "HEADING NAME": {
+        'SPEC. ED.': 'SPE',
+        'SPEC. EDU.': 'SPE',
+        'SPEC. EDUCATION': 'SPE',
+        'ECO. DISAD.': 'ECO',
+        'ECON. DISAD.': 'ECO',
+        'ECO. DISADV.': 'ECO',
+        'HIS/LATINO': 'HIS',
+        'HISPANIC/LATINO': 'HIS',
+        'HISPANIC': 'HIS',
+        'BLACK OR AFRICAN AMERICAN': 'BLA',
+        'BLACK/AFRICAN AMERICAN': 'BLA',
+        'AFRICAN AMERICAN': 'BLA',
+        'WHITE': 'WHI',
+        'NATIVE AMERICAN':'IND',
+        'AMERICAN INDIAN OR ALASKA NAT': 'IND',
+        'ASIAN': 'ASI',
+        'NATIVE HAWAIIAN/OTHER PACIFIC': 'PCI',
+        'TWO OR MORE RACES': 'TWO',
+        'DISTRICT CUMULATIVE YEAR END ENROLLMENT': 'ALL',
+                    }
+    }
+
+
+def rename_row(row: list,
+               demo_index: int,
+               punishment_index: int) -> list:
+    if len(row[demo_index]) > 3:
+        row[demo_index] = CATEGORY_NAMES["HEADING NAME"][row[demo_index]]
+    if len(row[punishment_index]) > 3:
+        row[punishment_index] = CATEGORY_NAMES["SECTION"][row[punishment_index]]
+    return row
+
+
 def replace_category_names(year_of_records: list,
                            demo_index: int,
                            punishment_index: int) -> list:
-    headings = {
-        "SECTION": {
-            'A-PARTICIPATION': 'POP',
-            'D-EXPULSION ACTIONS': 'EXP',
-            'N-ECO. DISADV. EXPULSIONS': 'EXP',
-            'I-SPEC. ED. EXPULSIONS': 'EXP',
-            'E-DAEP PLACEMENTS': 'DAE',
-            'O-ECO. DISADV. DAEP PLACEMENTS': 'DAE',
-            'J-SPEC. ED. DAEP PLACEMENTS': 'DAE',
-            'F-OUT OF SCHOOL SUSPENSIONS': 'OSS',
-            'P-ECO. DISADV. OUT OF SCHOOL SUS.': 'OSS',
-            'K-SPEC. ED. OUT OF SCHOOL SUS.': 'OSS',
-            'G-IN SCHOOL SUSPENSIONS': 'ISS',
-            'Q-ECO. DISADV. IN SCHOOL SUS.': 'ISS',
-            'L-SPEC. ED. IN SCHOOL SUS.': 'ISS',
-            },
-        "HEADING NAME": {
-            'SPEC. ED.': 'SPE',
-            'SPEC. EDU.': 'SPE',
-            'SPEC. EDUCATION': 'SPE',
-            'ECO. DISAD.': 'ECO',
-            'ECON. DISAD.': 'ECO',
-            'ECO. DISADV.': 'ECO',
-            'HIS/LATINO': 'HIS',
-            'HISPANIC/LATINO': 'HIS',
-            'HISPANIC': 'HIS',
-            'BLACK OR AFRICAN AMERICAN': 'BLA',
-            'BLACK/AFRICAN AMERICAN': 'BLA',
-            'AFRICAN AMERICAN': 'BLA',
-            'WHITE': 'WHI',
-            'NATIVE AMERICAN':'IND',
-            'AMERICAN INDIAN OR ALASKA NAT': 'IND',
-            'ASIAN': 'ASI',
-            'NATIVE HAWAIIAN/OTHER PACIFIC': 'PCI',
-            'TWO OR MORE RACES': 'TWO',
-            'DISTRICT CUMULATIVE YEAR END ENROLLMENT': 'ALL',
-                        }
-        }
     for row in year_of_records[1:]:
-        if len(row[demo_index]) > 3:
-            row[demo_index] = headings["HEADING NAME"][row[demo_index]]
-        if len(row[punishment_index]) > 3:
-            row[punishment_index] = headings["SECTION"][row[punishment_index]]
+        rename_row(row, demo_index, punishment_index)
     return year_of_records
 
 
+@lru_cache(maxsize=None)
+def classify_headings(code: str,
+                      heading_name: str,
+                      section: str) -> Optional[Tuple[str, str]]:
+
+    """
+    Decides what to do with a row from its HEADING, HEADING NAME and
+    SECTION values, applying relabel_row, keep_row and rename_row at
+    once. Returns None if the row should be dropped, or else the row's
+    new (demo, punishment) labels. A year has only a few hundred distinct
+    combinations of headings, so after the first row with each
+    combination, classifying a row is one cache lookup."""
+
+    row = relabel_row([code, heading_name, section], 0, 1, 2)
+    if not keep_row(row, 1, 2):
+        return None
+    row = rename_row(row, 1, 2)
+    return row[1], row[2]
+
+
 def number_strings_to_int(row: list) -> list:
     row[0] = int(row[0]) # DISTRICT
 
@@ -218,45 +492,297 @@ def number_strings_to_int(row: list) -> list:
         row[-1] = 1
     return row
 
+
+# (include_charters, include_traditional) for each output file suffix
+
+CHARTER_VARIANTS = {
+    "": (False, True),
+    "WithCharters": (True, True),
+    "ChartersOnly": (True, False),
+}
+
+
+def get_charter_status(include_charters: bool,
+                       include_traditional: bool) -> str:
+    if not include_traditional:
+        return "ChartersOnly"
+    elif include_charters:
+        return "WithCharters"
+    return ""
+
+
+DEMOS = ('SPE', 'ECO', 'HIS', 'BLA', 'WHI', 'IND',
+         'ASI', 'PCI', 'TWO', 'ALL', 'NON', 'MAN', 'DIS')
+
+ACTIONS = ('ISS', 'OSS', 'EXP', 'DAE')
+
+PUNISHMENTS = ('POP',) + ACTIONS
+
+
 def make_empty_dict(first_year: int, last_year: int) -> dict:
+    return make_empty_dict_for_years(range(first_year, last_year + 1))
 
-    demos = {'SPE', 'ECO', 'HIS', 'BLA', 'WHI', 'IND',
-             'ASI', 'PCI', 'TWO', 'ALL', 'NON', 'MAN', 'DIS'}
-    return {year: {demo: {} for demo in demos}
-            for year in range(first_year, last_year + 1)}
+
+def make_empty_dict_for_years(years: Iterable[int]) -> dict:
+    return {year: {demo: {} for demo in DEMOS} for year in years}
+
+
+def clean_year_of_records(year: int) -> Iterator[list]:
+
+    """
+    Streams a year's rows through the relabeling, filtering, int
+    conversion and renaming steps, yielding the header first and then
+    each cleaned row, without holding the whole year in memory."""
+
+    rows = iter_year(year)
+    header = next(rows)
+    demo_index = header.index("HEADING NAME")
+    code_index = header.index("HEADING")
+    punishment_index = header.index("SECTION")
+    yield header
+    rows_read = 0
+    for rows_read, row in enumerate(rows, 1):
+        labels = classify_headings(row[code_index], row[demo_index],
+                                   row[punishment_index])
+        if labels is not None:
+            row[demo_index], row[punishment_index] = labels
+            yield number_strings_to_int(row)
+    METRICS.count("rows read", rows_read)
+
+
+def get_year_region_paths(year: int) -> List[str]:
+    return [get_region_path(year, region) for region in range(1, 21)]
+
+
+def get_year_source_paths(year: int) -> List[str]:
+
+    """
+    Every TEA file that a year's statistics depend on: the year's region
+    files, its district file, and, if that has no COMMTYPE column, the
+    CHARTER_FALLBACK_YEAR district file used for charter status."""
+
+    paths = get_year_region_paths(year) + [get_district_path(year)]
+    if get_district_index(year).charter is None:
+        paths.append(get_district_path(CHARTER_FALLBACK_YEAR))
+    return paths
+
+
+def iter_year_of_records(year: int) -> Iterator[list]:
+    return cached_stream(f'records{year}.pickle',
+                         get_year_region_paths(year),
+                         lambda: clean_year_of_records(year))
 
 
 def make_year_of_records(year: int) -> list:
+    return list(iter_year_of_records(year))
 
-    year_of_records = get_year(year)
-    demo_index = year_of_records[0].index("HEADING NAME")
-    code_index = year_of_records[0].index("HEADING")
-    punishment_index = year_of_records[0].index("SECTION")
 
-    year_of_records = mandatory_and_discretionary(year_of_records, code_index,
-                                                demo_index, punishment_index)
-    year_of_records = filter_records(year_of_records, demo_index,
-                                    punishment_index)
-    year_of_records[1:] = [number_strings_to_int(row)
-                           for row in year_of_records[1:]]
-    return replace_category_names(year_of_records,
-                                  demo_index, punishment_index)
+# The demographics with a percentage column, DPET<demo>P, in the
+# district files. Not every year has all of them.
 
+DISTRICT_DEMOS = ('SPE', 'ECO', 'HIS', 'BLA', 'WHI', 'IND',
+                  'ASI', 'PCI', 'TWO')
 
-def get_charters() -> set:
-    charters = set()
-    dirname=os.path.dirname
-    district_path = os.path.join(dirname(dirname(__file__)),
-                            os.path.join('data', 'from_agency', 'districts',
-                            'district2016.dat'))
-    with open(district_path) as csvfile:
-        reader = csv.DictReader(csvfile)
-        for row in reader:
-            if row["COMMTYPE"] == "Charters":
-                charters.add(int(row["DISTRICT"]))
+# District files before 2016's, such as 2009's, have no COMMTYPE column,
+# so those years use 2016's list of charters.
+
+CHARTER_FALLBACK_YEAR = 2016
+
+
+class DistrictIndex:
+
+    """
+    The columns of one year's district file that are used here, read
+    once: each district's region, county, charter status and
+    demographic percentages, as arrays in the order of the sorted
+    district numbers. charter is None if the file has no COMMTYPE
+    column, and so is a demo's entry in percents if it has no DPET
+    column for the demo."""
+
+    def __init__(self, year: int,
+                 districts: "np.ndarray",
+                 regions: "np.ndarray",
+                 counties: "np.ndarray",
+                 charter: Optional["np.ndarray"],
+                 percents: Dict[str, Optional["np.ndarray"]]) -> None:
+        self.year = year
+        self.districts = districts
+        self.regions = regions
+        self.counties = counties
+        self.charter = charter
+        self.percents = percents
+
+    @classmethod
+    def from_file(cls, year: int, path: str) -> "DistrictIndex":
+
+        """
+        Parses a district file, keeping only the needed fields of each
+        row. The files have around 100 columns, of which this uses at
+        most 13."""
+
+        import numpy as np
+        with open(path, newline='') as f:
+            reader = csv.reader(f)
+            header = next(reader, [])
+            names = ["DISTRICT", "REGION", "DZCNTYNM", "COMMTYPE"] + \
+                [f"DPET{demo}P" for demo in DISTRICT_DEMOS]
+            names = [name for name in names if name in header]
+            indexes = [header.index(name) for name in names]
+            # Like csv.DictReader, skips blank lines, and also lines too
+            # short to have every column used here.
+            width = max(indexes, default=0) + 1
+            rows = [tuple(row[i] for i in indexes)
+                    for row in reader if len(row) >= width]
+        if "DISTRICT" not in names:
+            rows = []
+        columns = dict(zip(names, zip(*rows))) if rows \
+            else {name: () for name in names}
+
+        districts = np.array([int(district)
+                              for district in columns.get("DISTRICT", ())],
+                             dtype=np.int64)
+        order = np.argsort(districts, kind="stable")
+
+        def column(name: str, convert: Callable, dtype: Any
+                   ) -> Optional["np.ndarray"]:
+            if name not in columns:
+                return None
+            return np.array([convert(value) for value in columns[name]],
+                            dtype=dtype)[order]
+
+        regions = column("REGION", lambda region: int(region)
+                         if region.isdigit() else -1, np.int16)
+        counties = column("DZCNTYNM", str, str)
+        return cls(year, districts[order],
+                   regions if regions is not None
+                   else np.full(len(districts), -1, dtype=np.int16),
+                   counties if counties is not None
+                   else np.full(len(districts), ""),
+                   column("COMMTYPE", lambda kind: kind == "Charters", bool),
+                   {demo: column(f"DPET{demo}P", float, np.float64)
+                    for demo in DISTRICT_DEMOS})
+
+    def to_columns(self) -> dict:
+
+        """
+        The index as a dict of arrays, for the file cache. A pickled
+        DistrictIndex would name the module it was imported as, which is
+        collectFromFile for the installed command but
+        makedata.collectFromFile elsewhere, so only one could load it."""
+
+        return {"year": self.year,
+                "districts": self.districts,
+                "regions": self.regions,
+                "counties": self.counties,
+                "charter": self.charter,
+                "percents": dict(self.percents)}
+
+    @classmethod
+    def from_columns(cls, columns: dict) -> "DistrictIndex":
+        return cls(**columns)
+
+    def __len__(self) -> int:
+        return len(self.districts)
+
+    def position(self, district: int) -> Optional[int]:
+        import numpy as np
+        i = int(np.searchsorted(self.districts, district))
+        if i < len(self.districts) and self.districts[i] == district:
+            return i
+        return None
+
+    def __contains__(self, district: int) -> bool:
+        return self.position(district) is not None
+
+    def get(self, district: int) -> Optional[dict]:
+        i = self.position(district)
+        if i is None:
+            return None
+        return {"district": district,
+                "region": int(self.regions[i]),
+                "county": str(self.counties[i]),
+                "charter": None if self.charter is None
+                else bool(self.charter[i]),
+                "percents": {demo: float(values[i])
+                             for demo, values in self.percents.items()
+                             if values is not None}}
+
+    def charters(self) -> Optional[set]:
+        if self.charter is None:
+            return None
+        return set(self.districts[self.charter].tolist())
+
+    def percent_matrix(self, districts: "np.ndarray"
+                       ) -> Tuple[List[str], "np.ndarray"]:
+
+        """
+        The percentages for districts, one row per demo, with NaN where
+        a district isn't in the file or the file has no column for the
+        demo."""
+
+        import numpy as np
+        where, found = DistrictIds(self.districts).find(districts)
+        matrix = np.full((len(self.percents), len(districts)), np.nan)
+        for row, values in zip(matrix, self.percents.values()):
+            if values is not None:
+                row[found] = values[where[found]]
+        return list(self.percents), matrix
+
+    def demo_dict(self) -> dict:
+
+        """
+        The percentages in the {demo: {district: percent}} form used by
+        add_demo_populations, with an empty dict for each demo the
+        file has no column for."""
+
+        districts = self.districts.tolist()
+        return {demo: {} if values is None
+                else dict(zip(districts, values.tolist()))
+                for demo, values in self.percents.items()}
+
+
+def read_district_index(year: int) -> DistrictIndex:
+    return DistrictIndex.from_file(year, get_district_path(year))
+
+
+@lru_cache(maxsize=32)
+def read_district_file(year: int, path: str, size: int,
+                       mtime: int) -> DistrictIndex:
+
+    """
+    Keeps each district file's index in memory for as long as its size
+    and mtime stay the same, since it's needed for both the charters and
+    the demographics of a year."""
+
+    return DistrictIndex.from_file(year, path)
+
+
+def get_district_index(year: int) -> DistrictIndex:
+    path = get_district_path(year)
+    if FILE_CACHE_ENABLED:
+        return DistrictIndex.from_columns(cached_value(
+            f'districts{year}.pickle', [path],
+            lambda: read_district_index(year).to_columns()))
+    stat = os.stat(path)
+    return read_district_file(year, path, stat.st_size, stat.st_mtime_ns)
+
+
+def get_charters(year: int = CHARTER_FALLBACK_YEAR) -> set:
+
+    """
+    The charter districts in year, or in CHARTER_FALLBACK_YEAR if that
+    year's district file doesn't say which districts are charters."""
+
+    charters = get_district_index(year).charters()
+    if charters is None:
+        charters = get_district_index(CHARTER_FALLBACK_YEAR).charters()
     return charters
 
 
+def read_charters(year: int = CHARTER_FALLBACK_YEAR) -> Optional[set]:
+    return read_district_index(year).charters()
+
+
 def punishment_totals_for_year(year: int, d: dict) -> dict:
 
     """
@@ -266,66 +792,31 @@ def punishment_totals_for_year(year: int, d: dict) -> dict:
     students. Relying on whichever number is higher, on the assumption that
     if actions are reported anywhere, they probably really happened."""
 
-    for action in ("ISS", "OSS", "EXP", "DAE"):
-        for district in set(d[year]["BLA"][action].keys() |
-                            d[year]["HIS"][action].keys() |
-                            d[year]["WHI"][action].keys()):
-            sn = d[year]["SPE"].get(action, {}).get(district, {}).get("C", 0)
-            sn += d[year]["NON"].get(action, {}).get(district, {}).get("C", 0)
-            md = d[year]["MAN"].get(action, {}).get(district, {}).get("C", 0)
-            md += d[year]["DIS"].get(action, {}).get(district, {}).get("C", 0)
-            if action not in d[year]["ALL"]:
-                d[year]["ALL"][action] = {}
-            d[year]["ALL"][action][district] = {"C": max(sn, md)}
-    d[year].pop("NON", None)
-    d[year].pop("MAN", None)
-    d[year].pop("DIS", None)
-    return d
+    return update_year_dict(year, d, YearTable.add_punishment_totals)
 
 
 def get_demo_year(year: int) -> dict:
-    dirname=os.path.dirname
-    district_path = os.path.join(dirname(dirname(__file__)),
-                            os.path.join('data', 'from_agency', 'districts',
-                            f'district{year}.dat'))
-    demos = {'SPE', 'ECO', 'HIS', 'BLA', 'WHI', 'IND',
-             'ASI', 'PCI', 'TWO'}
+    with METRICS.stage("get_demo_year", year):
+        return get_district_index(year).demo_dict()
+
+
+def read_demo_year(year: int) -> dict:
 
     # dropping 'DPETALLC', which is also a measure of district population,
     # but isn't what TEA uses in the discipline reports processed above.
 
-    demo_dict: Dict[str, dict] = {demo: {} for demo in demos}
-    with open(district_path) as csvfile:
-        reader = csv.DictReader(csvfile)
-        for row in reader:
-            for demo in demos:
-                if f"DPET{demo}P" in reader.fieldnames:
-                    demo_dict[demo][int(row["DISTRICT"])] = float(
-                            row[f"DPET{demo}P"])
-    return demo_dict
-
-
-def add_demo_populations(year: int, d: dict) -> dict:
-    demo_dict = get_demo_year(year)
-    for demo in (demo for demo in demo_dict if demo != "ALL"):
-        if "POP" not in d[year][demo]:
-            d[year][demo]["POP"] = {}
-        for district in demo_dict[demo]:
-            if d[year]["ALL"]["POP"].get(district, None):
-                d[year][demo]["POP"][district] = {"C": int(
-                        d[year]["ALL"]["POP"][district]["C"]
-                        * demo_dict[demo][district] // 100)}
-    return d
+    return read_district_index(year).demo_dict()
+
+
+def add_demo_populations(year: int, d: dict,
+                         demo_dict: Optional[dict] = None) -> dict:
+    demos = get_district_index(year) if demo_dict is None else demo_dict
+    return update_year_dict(
+        year, d, lambda table: table.add_demo_populations(demos))
 
 
 def add_statewide_totals(year: int, d: dict) -> dict:
-    for demo in d[year]:
-        for punishment in d[year][demo]:
-            d[year][demo][punishment][0] = {"C": sum(
-                d[year][demo][punishment][district]["C"]
-                for district in d[year][demo][punishment]
-            )}
-    return d
+    return update_year_dict(year, d, YearTable.add_statewide_totals)
 
 
 def impossible(member_punishments: int,
@@ -345,6 +836,256 @@ def impossible(member_punishments: int,
 
 
 
+def get_peak_rss_mb() -> Optional[float]:
+
+    """
+    The most memory this process has used so far, in megabytes."""
+
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1 << 20 if sys.platform == "darwin" else 1 << 10)
+
+
+class StageMetrics:
+
+    """
+    Wall time, CPU time, peak RSS and row or file counts for each stage
+    of a run, for the CLI's --profile and --metrics-json options. Stages
+    can be nested, and counts are added to the innermost open stage.
+    With profile_scoring, the scoring loop is also run under cProfile."""
+
+    def __init__(self, enabled: bool = False,
+                 profile_scoring: bool = False) -> None:
+        self.enabled = enabled
+        self.records: List[dict] = []
+        self.open: List[dict] = []
+        self.profiler = cProfile.Profile() if profile_scoring else None
+
+    @contextmanager
+    def stage(self, name: str, year: Optional[int] = None) -> Iterator[None]:
+        if not self.enabled:
+            yield
+            return
+        record = {"stage": name, "year": year, "depth": len(self.open),
+                  "counts": {}}
+        self.records.append(record)
+        self.open.append(record)
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            record["wall_s"] = time.perf_counter() - wall
+            record["cpu_s"] = time.process_time() - cpu
+            # The high-water mark of the process, not just of this stage.
+            record["peak_rss_mb"] = get_peak_rss_mb()
+            self.open.pop()
+
+    def count(self, name: str, n: int) -> None:
+        if self.open:
+            counts = self.open[-1]["counts"]
+            counts[name] = counts.get(name, 0) + n
+        return None
+
+    def take(self) -> List[dict]:
+
+        """
+        The stages recorded so far, which are then forgotten, so a
+        worker process building several years sends each stage once."""
+
+        records, self.records = self.records, []
+        return records
+
+    def extend(self, records: List[dict]) -> None:
+
+        """
+        Adds the stages recorded in a worker process, nested under the
+        stage open here."""
+
+        for record in records:
+            self.records.append(dict(record,
+                                     depth=record["depth"] + len(self.open)))
+        return None
+
+    @contextmanager
+    def profile(self) -> Iterator[None]:
+        if self.profiler is None:
+            yield
+            return
+        self.profiler.enable()
+        try:
+            yield
+        finally:
+            self.profiler.disable()
+
+    def summary(self) -> List[dict]:
+
+        """
+        The finished stages, with those for the same stage and year added
+        together, such as scoring traditional districts and charters."""
+
+        stages: Dict[Tuple[str, Optional[int]], dict] = OrderedDict()
+        for record in self.records:
+            if "wall_s" not in record:
+                continue
+            key = (record["stage"], record["year"])
+            if key not in stages:
+                stages[key] = {"stage": record["stage"],
+                               "year": record["year"],
+                               "depth": record["depth"],
+                               "calls": 0, "wall_s": 0.0, "cpu_s": 0.0,
+                               "peak_rss_mb": None, "counts": {}}
+            total = stages[key]
+            total["calls"] += 1
+            total["wall_s"] += record["wall_s"]
+            total["cpu_s"] += record["cpu_s"]
+            if record["peak_rss_mb"] is not None:
+                total["peak_rss_mb"] = max(total["peak_rss_mb"] or 0,
+                                           record["peak_rss_mb"])
+            for name, n in record["counts"].items():
+                total["counts"][name] = total["counts"].get(name, 0) + n
+        return list(stages.values())
+
+    def scoring_profile(self, limit: int = 25) -> Optional[str]:
+        if self.profiler is None:
+            return None
+        out = io.StringIO()
+        try:
+            report = pstats.Stats(self.profiler, stream=out)
+        except TypeError:
+            # Nothing was scored in this process.
+            return None
+        report.sort_stats("cumulative").print_stats(limit)
+        return out.getvalue()
+
+    def table(self) -> str:
+        lines = [f"{'stage':44}{'year':>6}{'calls':>7}{'wall ms':>11}"
+                 f"{'cpu ms':>11}{'peak MB':>9}  counts"]
+        for stage in self.summary():
+            year = "" if stage["year"] is None else stage["year"]
+            peak = "" if stage["peak_rss_mb"] is None \
+                else f"{stage['peak_rss_mb']:.1f}"
+            counts = ", ".join(f"{name} {n:,}"
+                               for name, n in stage["counts"].items())
+            lines.append(f"{'  ' * stage['depth'] + stage['stage']:44}"
+                         f"{year:>6}{stage['calls']:>7}"
+                         f"{stage['wall_s'] * 1000:11.1f}"
+                         f"{stage['cpu_s'] * 1000:11.1f}{peak:>9}  {counts}")
+        return "\n".join(lines)
+
+    def to_json(self) -> dict:
+        return {"stages": self.summary(),
+                "scoring_profile": self.scoring_profile()}
+
+
+# Replaced by the CLI when --profile or --metrics-json is given.
+
+METRICS = StageMetrics()
+
+
+class PValueCache:
+
+    """
+    Bounded memo of binomial test p-values, keyed on the normalized
+    inputs (member_punishments, trials, member_pop, all_pop, tail).
+    When full, the least recently used entry is evicted. The entries
+    can be saved to disk so later runs of the CLI reuse them."""
+
+    def __init__(self, max_size: int = 250000) -> None:
+        self.max_size = max_size
+        self.entries: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # Entries put since the last take(), once track_added() is called.
+        self.added: Optional[OrderedDict] = None
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, key: Hashable) -> Optional[float]:
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.entries.move_to_end(key)
+        return value
+
+    def put(self, key: Hashable, value: float) -> None:
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if self.added is not None:
+            self.added[key] = value
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def load(self, path: str) -> None:
+        try:
+            with open(path, 'rb') as f:
+                entries = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        for key, value in entries.items():
+            self.put(key, value)
+        return None
+
+    def save(self, path: str) -> None:
+        directory = os.path.dirname(path)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        temp_path = f'{path}.tmp'
+        with open(temp_path, 'wb') as f:
+            pickle.dump(self.entries, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, path)
+        return None
+
+    def track_added(self) -> None:
+        self.added = OrderedDict()
+        self.hits = self.misses = 0
+        return None
+
+    def take(self) -> "PValueCache":
+
+        """
+        The entries put, and the hits and misses counted, since the last
+        take() or track_added(), which a worker process sends back to be
+        merged instead of its whole cache."""
+
+        taken = PValueCache(self.max_size)
+        taken.entries = self.added if self.added is not None \
+            else OrderedDict()
+        taken.hits, taken.misses = self.hits, self.misses
+        self.track_added()
+        return taken
+
+    def merge(self, other: "PValueCache") -> None:
+        for key, value in other.entries.items():
+            self.put(key, value)
+        self.hits += other.hits
+        self.misses += other.misses
+        return None
+
+    def report(self) -> str:
+        lookups = self.hits + self.misses
+        rate = self.hits / lookups if lookups else 0
+        return (f"P-value cache: {self.hits} hits, {self.misses} misses "
+                f"({rate:.1%} hit rate), {len(self)} entries stored")
+
+
+PVALUE_CACHE = PValueCache()
+
+
+# relying on https://en.wikipedia.org/wiki/68%E2%80%9395%E2%80%9399.7_rule
+# to find one-sided odds of being 1-5 standard deviations away from mean
+
+STD_INTERVALS = (.5/3, .5/22, .5/370, .5/15787, .5/1744278)
+
+# also requiring a minimum percentage difference to get a brighter color
+
+P_INTERVALS = (1.1, 1.3, 1.6, 2, 2.5)
+
+
 def binomial_scale(member_punishments: int,
                    all_punishments: int,
                    member_pop: int,
@@ -377,48 +1118,143 @@ def binomial_scale(member_punishments: int,
         tail = 'less'
     else:
         return score
-    pvalue = stats.binom_test(member_punishments,
-                               max(all_punishments, member_punishments),
-                               p,
-                               alternative=tail)
+    key = (member_punishments, max(all_punishments, member_punishments),
+           member_pop, max(all_pop, 1), tail)
+    pvalue = PVALUE_CACHE.get(key)
+    if pvalue is None:
+        from scipy import stats
+        pvalue = stats.binom_test(member_punishments,
+                                   max(all_punishments, member_punishments),
+                                   p,
+                                   alternative=tail)
+        PVALUE_CACHE.put(key, float(pvalue))
 
-    # relying on https://en.wikipedia.org/wiki/68%E2%80%9395%E2%80%9399.7_rule
-    # to find one-sided odds of being 1-5 standard deviations away from mean
+    # again, max() is to avoid divide by zero errors
+    if tail == 'greater':
+        score += min(sum(pvalue < t for t in STD_INTERVALS),
+                     sum(group_p/(max(p, .00001)) > t for t in P_INTERVALS))
+    else:
+        score -= min(sum(pvalue < t for t in STD_INTERVALS),
+                     sum(p/(max(group_p, .00001)) > t for t in P_INTERVALS))
+    return int(score)
 
-    std_intervals = (.5/3, .5/22, .5/370, .5/15787, .5/1744278)
 
-    # also requiring a minimum percentage difference to get a brighter color
+def binomial_pvalues(k: "np.ndarray",
+                     n: "np.ndarray",
+                     member_pop: "np.ndarray",
+                     all_pop: "np.ndarray",
+                     tail: str) -> "np.ndarray":
 
-    p_intervals = (1.1, 1.3, 1.6, 2, 2.5)
+    """
+    Finds binom_test's one-sided p-values for arrays of inputs, looking
+    each one up in PVALUE_CACHE and computing only the misses, all at
+    once, with the binomial distribution's sf or cdf."""
+
+    import numpy as np
+    all_pop = np.maximum(all_pop, 1)
+    keys = list(zip(k.tolist(), n.tolist(), member_pop.tolist(),
+                    all_pop.tolist(), [tail] * len(k)))
+    pvalues = np.empty(len(keys))
+    missing: Dict[tuple, list] = {}
+    for i, key in enumerate(keys):
+        if key in missing:
+            # already being computed for an earlier district in this slice
+            missing[key].append(i)
+            PVALUE_CACHE.hits += 1
+            continue
+        value = PVALUE_CACHE.get(key)
+        if value is None:
+            missing[key] = [i]
+        else:
+            pvalues[i] = value
+    METRICS.count("binomial tests", len(missing))
+    if missing:
+        from scipy import stats
+        todo = np.array([indices[0] for indices in missing.values()],
+                        dtype=np.intp)
+        p = member_pop[todo] / all_pop[todo]
+        if tail == 'greater':
+            computed = stats.binom.sf(k[todo] - 1, n[todo], p)
+        else:
+            computed = stats.binom.cdf(k[todo], n[todo], p)
+        for (key, indices), value in zip(missing.items(), computed.tolist()):
+            pvalues[indices] = value
+            PVALUE_CACHE.put(key, value)
+    return pvalues
+
+
+def binomial_scale_array(member_punishments: Sequence[int],
+                         all_punishments: Sequence[int],
+                         member_pop: Sequence[int],
+                         all_pop: Sequence[int]) -> "np.ndarray":
 
-    # again, max() is to avoid divide by zero errors
-    if tail == 'greater':
-        score += min(sum(pvalue < t for t in std_intervals),
-                     sum(group_p/(max(p, .00001)) > t for t in p_intervals))
+    """
+    Scores a whole year/demo/punishment slice at once. Takes equal-length
+    sequences of the arguments to binomial_scale and returns an array
+    of the same scores, using one call to scipy's binomial distribution
+    per tail instead of one binom_test per district."""
+
+    import numpy as np
+    k = np.asarray(member_punishments, dtype=np.int64)
+    all_k = np.asarray(all_punishments, dtype=np.int64)
+    pop = np.asarray(member_pop, dtype=np.int64)
+    all_p = np.asarray(all_pop, dtype=np.int64)
+
+    # same rules as impossible()
+    invalid = ((k > all_k) & (k > 10)) | ((pop == 0) & (k > 0))
+
+    # max() is to avoid divide by zero errors. A district with no members
+    # and no punishments gets NaN rates, so it falls through to 5.
+    with np.errstate(divide='ignore', invalid='ignore'):
+        p = pop / np.maximum(all_p, 1)
+        group_p = k / np.maximum(all_k, 1)
+        member_rate = k / pop
+        all_rate = all_k / all_p
+    greater = ~invalid & (member_rate > all_rate)
+    less = ~invalid & (member_rate < all_rate)
+
+    n = np.maximum(all_k, k)
+    pvalues = np.ones(k.shape)
+    for tail, mask in (('greater', greater), ('less', less)):
+        pvalues[mask] = binomial_pvalues(k[mask], n[mask], pop[mask],
+                                         all_p[mask], tail)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = np.where(greater,
+                         group_p / np.maximum(p, .00001),
+                         p / np.maximum(group_p, .00001))
+    steps = np.minimum(
+        (pvalues[:, np.newaxis] < np.array(STD_INTERVALS)).sum(axis=1),
+        (ratio[:, np.newaxis] > np.array(P_INTERVALS)).sum(axis=1))
+
+    scores = np.full(k.shape, 5, dtype=np.int64)
+    scores[greater] += steps[greater]
+    scores[less] -= steps[less]
+    scores[invalid] = -1
+    return scores
+
+
+@contextmanager
+def progress_bar(iterable: Iterable,
+                 label: str,
+                 length: int,
+                 show: bool = True) -> Iterator[Iterable]:
+
+    """
+    A click.progressbar that can be turned off, for code running in
+    worker processes that shouldn't draw over each other's bars."""
+
+    if show:
+        with click.progressbar(iterable, label=label, length=length) as bar:
+            yield bar
     else:
-        score -= min(sum(pvalue < t for t in std_intervals),
-                     sum(p/(max(group_p, .00001)) > t for t in p_intervals))
-    return int(score)
+        yield iterable
 
 
-def add_scale_statistic(year: int, d: dict) -> dict:
-    with click.progressbar(
-           (demo for demo in d[year] if demo != "ALL"),
-            label=f'Calculating year {year} for Appleseed map 🍎',
-            length=4) as bar:
-        for demo in bar:
-            for punishment in (p for p in d[year][demo] if p != "POP"):
-                for district in (d for d in d[year][demo][punishment]
-                                if d != 0):
-                    # No scale variable if the demo's population is unknown.
-                    if district in d[year][demo]["POP"]:
-                        d[year][demo][punishment][district]["S"] = binomial_scale(
-                            d[year][demo][punishment][district]["C"],
-                            d[year]["ALL"][punishment].get(district, {}).get("C", 0),
-                            d[year][demo]["POP"][district]["C"],
-                            d[year]["ALL"]["POP"][district]["C"]
-                            )
-    return d
+def add_scale_statistic(year: int, d: dict,
+                        show_progress: bool = True) -> dict:
+    return update_year_dict(
+        year, d, lambda table: table.add_scale_statistic(show_progress))
 
 
 def add_district_to_state_scale_statistic(year: int, d: dict) -> dict:
@@ -429,16 +1265,8 @@ def add_district_to_state_scale_statistic(year: int, d: dict) -> dict:
     that compares a demographic within a district to the district
     as a whole."""
 
-    demo = "ALL"
-    for punishment in (p for p in d[year][demo] if p != "POP"):
-        for district in (d for d in d[year][demo][punishment] if d != 0):
-            d[year][demo][punishment][district]["S"] = binomial_scale(
-                    d[year]["ALL"][punishment].get(district, {}).get("C", 0),
-                    d[year]["ALL"][punishment][0]["C"],
-                    d[year]["ALL"]["POP"][district]["C"],
-                    d[year]["ALL"]["POP"][0]["C"]
-                )
-    return d
+    return update_year_dict(
+        year, d, YearTable.add_district_to_state_scale_statistic)
 
 
 def add_zeros_to_dict(year: int,
@@ -450,46 +1278,642 @@ def add_zeros_to_dict(year: int,
     report ISS or OSS against a Black, Hispanic, or White student.
     """
 
-    for demo in d[year]:
-        for p in (p for p in d[year][demo] if p != "POP"):
-            for district in set(d[year]["BLA"]["ISS"].keys() |
-                            d[year]["HIS"]["ISS"].keys() |
-                            d[year]["WHI"]["ISS"].keys() |
-                            d[year]["BLA"]["OSS"].keys() |
-                            d[year]["HIS"]["OSS"].keys() |
-                            d[year]["WHI"]["OSS"].keys()):
-                count = d[year][demo][p].get(district, {}).get("C", 0)
-                d[year][demo][p][district] = {"C": count}
+    return update_year_dict(year, d, YearTable.add_zeros)
+
+
+def add_aggregates_to_dict(year: int, d: dict,
+                           demo_dict: Optional[dict] = None) -> dict:
+
+    """
+    add_zeros_to_dict, punishment_totals_for_year, add_demo_populations
+    and add_statewide_totals as one step."""
+
+    demos = get_district_index(year) if demo_dict is None else demo_dict
+    return update_year_dict(
+        year, d, lambda table: table.add_aggregates(demos))
+
+
+class DistrictIds:
+
+    """
+    Interns one year's district numbers as dense positions 0..N-1, in
+    sorted order, so that anything kept per district can be an array
+    indexed by position, and a set of districts a boolean mask. Looking
+    up any number of districts is one np.searchsorted call."""
+
+    def __init__(self, districts: Iterable[int]) -> None:
+        import numpy as np
+        self.ids = np.unique(np.fromiter(districts, dtype=np.int64))
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def find(self, districts: Iterable[int]
+             ) -> Tuple["np.ndarray", "np.ndarray"]:
+
+        """
+        The positions of districts, along with a mask of which of them
+        were found. The positions of the others are meaningless."""
+
+        import numpy as np
+        districts = as_int_array(districts)
+        where = np.searchsorted(self.ids, districts)
+        found = where < len(self.ids)
+        found[found] = self.ids[where[found]] == districts[found]
+        return where, found
+
+    def positions(self, districts: Iterable[int]) -> "np.ndarray":
+        where, found = self.find(districts)
+        if not found.all():
+            raise KeyError(as_int_array(districts)[~found][0])
+        return where
+
+
+def as_int_array(values: Iterable[int]) -> "np.ndarray":
+    import numpy as np
+    if isinstance(values, (np.ndarray, list)):
+        return np.asarray(values, dtype=np.int64)
+    return np.fromiter(values, dtype=np.int64)
+
+
+class Column:
+
+    """
+    One demo and punishment in a YearTable: views of its row of each of
+    the table's matrices, so writing a count or scale score to the
+    Column writes it to the table, and its statewide total once it's
+    been added."""
+
+    def __init__(self, table: "YearTable", demo: str, p: str) -> None:
+        self.table = table
+        self.slot = (DEMOS.index(demo), PUNISHMENTS.index(p))
+        self.count = table.count[self.slot]
+        self.has_count = table.has_count[self.slot]
+        self.scale = table.scale[self.slot]
+        self.has_scale = table.has_scale[self.slot]
+
+    @property
+    def total(self) -> Optional[int]:
+        if not self.table.has_total[self.slot]:
+            return None
+        return int(self.table.total[self.slot])
+
+    @total.setter
+    def total(self, total: Optional[int]) -> None:
+        self.table.has_total[self.slot] = total is not None
+        self.table.total[self.slot] = total or 0
+
+
+class YearTable:
+
+    """
+    Columnar form of one year of the nested dict. Each district gets a
+    dense index, and the counts and scale scores are demo × punishment
+    × district matrices in the order of DEMOS, PUNISHMENTS and the
+    districts, so the aggregate and scoring steps are array operations
+    instead of lookups in millions of small dicts. A Column for each
+    demo and punishment in the year's records views its rows of the
+    matrices, and to_year_dict() gives the d[year][demo][punishment]
+    [district] shape used by the exporters, with only those columns.
+    """
+
+    def __init__(self, year: int, districts: Iterable[int]) -> None:
+        import numpy as np
+        self.year = year
+        self.ids = DistrictIds(districts)
+        self.districts = self.ids.ids
+        shape = (len(DEMOS), len(PUNISHMENTS), len(self.districts))
+        self.count = np.zeros(shape, dtype=np.int64)
+        self.has_count = np.zeros(shape, dtype=bool)
+        self.scale = np.zeros(shape, dtype=np.int64)
+        self.has_scale = np.zeros(shape, dtype=bool)
+        self.total = np.zeros(shape[:2], dtype=np.int64)
+        self.has_total = np.zeros(shape[:2], dtype=bool)
+        self.columns: Dict[str, Dict[str, Column]] = {
+            demo: {} for demo in DEMOS}
+
+    @classmethod
+    def from_counts(cls, year: int,
+                    counts: Dict[Tuple[str, str], Dict[int, int]]
+                    ) -> "YearTable":
+        table = cls(year, (district for entries in counts.values()
+                           for district in entries))
+        for (demo, p), entries in counts.items():
+            column = table.column(demo, p)
+            where = table.positions(entries.keys())
+            column.count[where] = as_int_array(entries.values())
+            column.has_count[where] = True
+        return table
+
+    @classmethod
+    def from_year_dict(cls, year: int, year_dict: dict) -> "YearTable":
+        table = cls(year, (district for demo in year_dict
+                           for p in year_dict[demo]
+                           for district in year_dict[demo][p]
+                           if district != 0))
+        table.columns = {demo: {} for demo in year_dict}
+        for demo in year_dict:
+            for p, entries in year_dict[demo].items():
+                column = table.column(demo, p)
+                districts, counts, scored, scales = [], [], [], []
+                for district, entry in entries.items():
+                    if district == 0:
+                        column.total = entry["C"]
+                        continue
+                    if "S" in entry:
+                        scored.append(len(districts))
+                        scales.append(entry["S"])
+                    districts.append(district)
+                    counts.append(entry["C"])
+                where = table.positions(districts)
+                column.count[where] = counts
+                column.has_count[where] = True
+                column.scale[where[scored]] = scales
+                column.has_scale[where[scored]] = True
+        return table
+
+    @classmethod
+    def combine(cls, first: "YearTable",
+                second: "YearTable") -> "YearTable":
+
+        """
+        Joins the tables for two separate sets of districts, such as
+        traditional districts and charters, adding up new statewide
+        totals for the districts of both."""
+
+        table = cls(first.year, first.districts.tolist()
+                    + second.districts.tolist())
+        table.columns = {}
+        for part in (first, second):
+            for demo, columns in part.columns.items():
+                table.columns.setdefault(demo, {})
+                for p in columns:
+                    table.column(demo, p)
+            where = table.positions(part.districts)
+            table.count[..., where] = part.count
+            table.has_count[..., where] = part.has_count
+            table.scale[..., where] = part.scale
+            table.has_scale[..., where] = part.has_scale
+        table.add_statewide_totals()
+        return table
+
+    def to_year_dict(self) -> dict:
+        return {demo: {p: self.entries(demo, p) for p in columns}
+                for demo, columns in self.columns.items()}
+
+    def entries(self, demo: str, p: str) -> dict:
+
+        """
+        One demo and punishment in the {district: {"C": count, "S":
+        scale}} form of the nested dict, with the statewide total as
+        district 0."""
+
+        import numpy as np
+        column = self.columns[demo][p]
+        districts = self.districts.tolist()
+        counts = column.count.tolist()
+        scales = column.scale.tolist()
+        has_scale = column.has_scale.tolist()
+        entries = {}
+        for i in np.flatnonzero(column.has_count).tolist():
+            if has_scale[i]:
+                entries[districts[i]] = {"C": counts[i], "S": scales[i]}
+            else:
+                entries[districts[i]] = {"C": counts[i]}
+        if column.total is not None:
+            entries[0] = {"C": column.total}
+        return entries
+
+    def positions(self, districts: Iterable[int]) -> "np.ndarray":
+        return self.ids.positions(districts)
+
+    def column(self, demo: str, p: str) -> Column:
+        if p not in self.columns[demo]:
+            self.columns[demo][p] = Column(self, demo, p)
+        return self.columns[demo][p]
+
+    def present(self) -> "np.ndarray":
+
+        """
+        A demo × punishment mask of the columns in the table. The rows
+        of the others are all zeros."""
+
+        import numpy as np
+        mask = np.zeros(self.total.shape, dtype=bool)
+        for columns in self.columns.values():
+            for column in columns.values():
+                mask[column.slot] = True
+        return mask
+
+    def drop(self, demos: Iterable[str]) -> None:
+        for demo in demos:
+            if self.columns.pop(demo, None) is not None:
+                i = DEMOS.index(demo)
+                for matrix in (self.count, self.has_count,
+                               self.scale, self.has_scale,
+                               self.total, self.has_total):
+                    matrix[i] = 0
+        return None
+
+    def count_of(self, demo: str, p: str) -> "np.ndarray":
+
+        """
+        The counts for a demo and punishment, or zeros if there's no
+        such column."""
+
+        return self.count[DEMOS.index(demo), PUNISHMENTS.index(p)]
+
+    def reported(self, demos: Sequence[str],
+                 punishments: Sequence[str]) -> "np.ndarray":
+
+        """
+        A mask of the districts with a count for each of the
+        punishments against any of the demos, one row per punishment."""
+
+        import numpy as np
+        return self.has_count[
+            np.ix_([DEMOS.index(demo) for demo in demos],
+                   [PUNISHMENTS.index(p) for p in punishments])
+        ].any(axis=0)
+
+    def add_zeros(self) -> None:
+        reported = self.reported(("BLA", "HIS", "WHI"),
+                                 ("ISS", "OSS")).any(axis=0)
+        actions = self.present()
+        actions[:, PUNISHMENTS.index("POP")] = False
+        self.has_count[actions] |= reported
+        return None
+
+    def add_punishment_totals(self) -> None:
+        import numpy as np
+        for action in ACTIONS:
+            self.column("ALL", action)
+        actions = [PUNISHMENTS.index(action) for action in ACTIONS]
+        reported = self.reported(("BLA", "HIS", "WHI"), ACTIONS)
+        count = self.count[:, actions]
+        sn = count[DEMOS.index("SPE")] + count[DEMOS.index("NON")]
+        md = count[DEMOS.index("MAN")] + count[DEMOS.index("DIS")]
+        row = DEMOS.index("ALL")
+        self.count[row, actions] = np.where(reported, np.maximum(sn, md),
+                                            self.count[row, actions])
+        self.has_count[row, actions] |= reported
+        self.has_scale[row, actions] &= ~reported
+        self.drop(("NON", "MAN", "DIS"))
+        return None
+
+    def percent_matrix(self, demo_dict: dict
+                       ) -> Tuple[List[str], "np.ndarray"]:
+
+        """
+        Like DistrictIndex.percent_matrix, for the percentages in the
+        form returned by get_demo_year."""
+
+        import numpy as np
+        demos = list(demo_dict)
+        matrix = np.full((len(demos), len(self.districts)), np.nan)
+        for demo, row in zip(demos, matrix):
+            where, found = self.ids.find(demo_dict[demo].keys())
+            row[where[found]] = np.fromiter(demo_dict[demo].values(),
+                                            dtype=float)[found]
+        return demos, matrix
+
+    def add_demo_populations(self,
+                             demos: Union[dict, DistrictIndex]) -> None:
+        import numpy as np
+        if isinstance(demos, DistrictIndex):
+            demos, percents = demos.percent_matrix(self.districts)
+        else:
+            demos, percents = self.percent_matrix(demos)
+        keep = [demo != "ALL" for demo in demos]
+        demos = [demo for demo in demos if demo != "ALL"]
+        percents = percents[keep]
+        for demo in demos:
+            self.column(demo, "POP")
+        all_pop = self.columns["ALL"]["POP"]
+        known = ~np.isnan(percents) & all_pop.has_count
+        rows = ([DEMOS.index(demo) for demo in demos],
+                PUNISHMENTS.index("POP"))
+        self.count[rows] = np.where(
+            known, all_pop.count * np.where(known, percents, 0) // 100,
+            self.count[rows])
+        self.has_count[rows] |= known
+        return None
+
+    def add_statewide_totals(self) -> None:
+        import numpy as np
+        present = self.present()
+        totals = np.where(self.has_count, self.count, 0).sum(axis=2)
+        self.total[present] = totals[present]
+        self.has_total |= present
+        return None
+
+    def add_aggregates(self, demos: Union[dict, DistrictIndex]) -> None:
+
+        """
+        The steps that add up counts rather than score them: zeros,
+        punishment totals, demo populations and statewide totals, each
+        as operations on the table's whole matrices."""
+
+        self.add_zeros()
+        self.add_punishment_totals()
+        self.add_demo_populations(demos)
+        self.add_statewide_totals()
+        return None
+
+    def score(self, demo: str, p: str) -> None:
+
+        """
+        Adds the scale statistic for one demo and punishment, comparing
+        the demo to the rest of each district, or for ALL, each district
+        to the statewide totals."""
+
+        import numpy as np
+        all_pop = self.columns["ALL"]["POP"]
+        column = self.columns[demo][p]
+        if demo == "ALL":
+            where = np.flatnonzero(column.has_count)
+            column.scale[where] = binomial_scale_array(
+                column.count[where],
+                np.full(len(where), column.total),
+                all_pop.count[where],
+                np.full(len(where), all_pop.total))
+        else:
+            pop = self.columns[demo]["POP"]
+            # No scale variable if the demo's population is unknown.
+            where = np.flatnonzero(column.has_count & pop.has_count)
+            column.scale[where] = binomial_scale_array(
+                column.count[where],
+                self.count_of("ALL", p)[where],
+                pop.count[where],
+                all_pop.count[where])
+        column.has_scale[where] = True
+        METRICS.count("scores", len(where))
+        return None
+
+    def add_scale_statistic(self, show_progress: bool = True) -> None:
+        demos = [demo for demo in self.columns if demo != "ALL"]
+        with progress_bar(
+                demos,
+                label=f'Calculating year {self.year} for Appleseed map 🍎',
+                length=len(demos), show=show_progress) as bar:
+            for demo in bar:
+                for p in self.columns[demo]:
+                    if p != "POP":
+                        self.score(demo, p)
+        return None
+
+    def add_district_to_state_scale_statistic(self) -> None:
+        for p in self.columns["ALL"]:
+            if p != "POP":
+                self.score("ALL", p)
+        return None
+
+    def add_district_statistics(self, demos: Union[dict, DistrictIndex],
+                                show_progress: bool = True) -> None:
+
+        """
+        The aggregates, and the scores comparing each demo to the rest
+        of its district. Apart from the statewide totals, which combine()
+        adds up again, a district gets the same results no matter which
+        other districts are in the table."""
+
+        with METRICS.stage("aggregate", self.year):
+            self.add_aggregates(demos)
+        with METRICS.stage("add_scale_statistic", self.year), \
+                METRICS.profile():
+            self.add_scale_statistic(show_progress)
+        return None
+
+    def add_state_statistics(self) -> None:
+
+        """
+        The scores comparing each district to the statewide totals,
+        which depend on which districts are included."""
+
+        with METRICS.stage("add_district_to_state_scale_statistic",
+                           self.year), METRICS.profile():
+            self.add_district_to_state_scale_statistic()
+        return None
+
+
+def update_year_dict(year: int,
+                     d: dict,
+                     step: Callable[[YearTable], None]) -> dict:
+
+    """
+    Runs a YearTable step on d[year], for callers that still work
+    with the nested dict."""
+
+    table = YearTable.from_year_dict(year, d[year])
+    step(table)
+    d[year] = table.to_year_dict()
+    return d
+
+
+def count_year_of_records(year_of_records: Iterable[list],
+                          charters: set) -> Tuple[dict, dict]:
+
+    """
+    Consumes the header and rows of a year of records, returning the
+    counts for traditional districts and for charters, each keyed by
+    (demo, punishment) and then by district. Both include every
+    (demo, punishment) found in the records, even if it has no
+    districts."""
+
+    records = iter(year_of_records)
+    header = next(records)
+    demo_index = header.index("HEADING NAME")
+    punishment_index = header.index("SECTION")
+    traditional: Dict[Tuple[str, str], Dict[int, int]] = {}
+    charter: Dict[Tuple[str, str], Dict[int, int]] = {}
+    n = 0
+    for n, row in enumerate(records, 1):
+        key = (row[demo_index], row[punishment_index])
+        if key not in traditional:
+            traditional[key] = {}
+            charter[key] = {}
+        counts = charter if row[0] in charters else traditional
+        counts[key][row[0]] = row[-1]
+    METRICS.count("records", n)
+    return traditional, charter
+
+
+def read_year_counts(year: int) -> Tuple[dict, dict]:
+
+    """
+    count_year_of_records for one year's (possibly cached) records.
+    Reading the TEA files and filtering their rows are streamed
+    together, so they're measured as one stage."""
+
+    with METRICS.stage("read records", year):
+        return count_year_of_records(iter_year_of_records(year),
+                                     get_charters(year))
+
+
+def select_counts(traditional: dict,
+                  charter: dict,
+                  include_charters: bool = False,
+                  include_traditional: bool = True) -> dict:
+    return {key: {**(traditional[key] if include_traditional else {}),
+                  **(charter[key] if include_charters else {})}
+            for key in traditional}
+
+
+def add_records_to_dict(year: int,
+                        d: dict,
+                        year_of_records: Iterable[list],
+                        charters: set,
+                        include_charters: bool = False,
+                        include_traditional: bool = True) -> dict:
+    counts = select_counts(*count_year_of_records(year_of_records, charters),
+                           include_charters, include_traditional)
+    for (demo, p), entries in counts.items():
+        d[year][demo].setdefault(p, {}).update(
+            (district, {"C": count}) for district, count in entries.items())
     return d
 
 
+def add_district_statistics(year: int,
+                            d: dict,
+                            demo_dict: Optional[dict] = None,
+                            show_progress: bool = True) -> dict:
+    demos = get_district_index(year) if demo_dict is None else demo_dict
+    return update_year_dict(
+        year, d,
+        lambda table: table.add_district_statistics(demos, show_progress))
+
+
+def add_state_statistics(year: int, d: dict) -> dict:
+    return update_year_dict(year, d, YearTable.add_state_statistics)
+
+
+def make_year_table(year: int,
+                    include_charters: bool = False,
+                    include_traditional: bool = True,
+                    show_progress: bool = True) -> YearTable:
+    counts = select_counts(*read_year_counts(year),
+                           include_charters, include_traditional)
+    table = YearTable.from_counts(year, counts)
+    table.add_district_statistics(get_district_index(year), show_progress)
+    table.add_state_statistics()
+    return table
+
+
 def add_year_to_dict(year: int,
                      d: dict,
                      include_charters: bool = False,
-                     include_traditional: bool = True) -> dict:
+                     include_traditional: bool = True,
+                     show_progress: bool = True) -> dict:
 
-    year_of_records = make_year_of_records(year)
-    demo_index = year_of_records[0].index("HEADING NAME")
-    punishment_index = year_of_records[0].index("SECTION")
-    charters = get_charters()
-    for row in year_of_records[1:]:
-        if row[punishment_index] not in d[year].get(row[demo_index], {}):
-            d[year][row[demo_index]][row[punishment_index]] = {}
-        if row[0] in charters and include_charters:
-            d[year][row[demo_index]][row[punishment_index]]\
-                [int(row[0])] = {"C": row[-1]}
-        if row[0] not in charters and include_traditional:
-            d[year][row[demo_index]][row[punishment_index]]\
-                [int(row[0])] = {"C": row[-1]}
-    d = add_zeros_to_dict(year, d)
-    d = punishment_totals_for_year(year, d)
-    d = add_demo_populations(year, d)
-    d = add_statewide_totals(year, d)
-    d = add_scale_statistic(year, d)
-    d = add_district_to_state_scale_statistic(year, d)
+    with METRICS.stage("add_year_to_dict", year):
+        table = make_year_table(year, include_charters, include_traditional,
+                                show_progress)
+        d[year] = table.to_year_dict()
     return d
 
 
+def add_year_to_variant_dicts(year: int,
+                              dicts: Dict[str, dict],
+                              show_progress: bool = True) -> Dict[str, dict]:
+
+    """
+    Adds one year to a dict for each charter variant in CHARTER_VARIANTS,
+    reading the year's files only once. Traditional districts and
+    charters are scored separately, and the "WithCharters" table is
+    assembled from the two, so only the statewide totals and the
+    district-to-state scores are calculated for each variant."""
+
+    with METRICS.stage("add_year_to_variant_dicts", year):
+        traditional, charter = read_year_counts(year)
+        index = get_district_index(year)
+        tables = {"": YearTable.from_counts(year, traditional),
+                  "ChartersOnly": YearTable.from_counts(year, charter)}
+        for table in tables.values():
+            table.add_district_statistics(index, show_progress)
+        tables["WithCharters"] = YearTable.combine(tables[""],
+                                                   tables["ChartersOnly"])
+        for variant, table in tables.items():
+            table.add_state_statistics()
+            dicts[variant][year] = table.to_year_dict()
+    return dicts
+
+
+def start_year_worker(file_cache_enabled: bool = False,
+                      metrics_enabled: bool = False,
+                      pvalues: Optional[PValueCache] = None) -> None:
+
+    """
+    Gives each worker process a copy of the parent's p-value cache,
+    which records what the worker adds to it, and empty metrics, so
+    the parent can merge in exactly what each worker computed."""
+
+    global PVALUE_CACHE, FILE_CACHE_ENABLED, METRICS
+    PVALUE_CACHE = pvalues if pvalues is not None \
+        else PValueCache(PVALUE_CACHE.max_size)
+    PVALUE_CACHE.track_added()
+    FILE_CACHE_ENABLED = file_cache_enabled
+    METRICS = StageMetrics(metrics_enabled)
+    return None
+
+
+def make_one_year(year: int,
+                  include_charters: bool = False,
+                  include_traditional: bool = True
+                  ) -> Tuple[int, dict, PValueCache, List[dict]]:
+
+    """
+    Builds a single year in a worker process, returning that year's
+    part of the dict along with the p-values the worker computed for it
+    and the stages it measured."""
+
+    d = make_empty_dict(year, year)
+    d = add_year_to_dict(year, d, include_charters, include_traditional,
+                         show_progress=False)
+    return year, d[year], PVALUE_CACHE.take(), METRICS.take()
+
+
+def make_one_year_of_variants(year: int
+                              ) -> Tuple[int, Dict[str, dict], PValueCache,
+                                         List[dict]]:
+
+    """
+    Like make_one_year, but builds every charter variant of the year."""
+
+    dicts = {variant: make_empty_dict(year, year)
+             for variant in CHARTER_VARIANTS}
+    dicts = add_year_to_variant_dicts(year, dicts, show_progress=False)
+    return year, {variant: dicts[variant][year] for variant in dicts}, \
+        PVALUE_CACHE.take(), METRICS.take()
+
+
+def make_years_in_processes(worker: Callable,
+                            years: Sequence[int],
+                            workers: int,
+                            *args) -> Iterator[Tuple[int, dict]]:
+
+    """
+    Runs worker for each year in a process pool, yielding each year's
+    result as it finishes and merging the workers' p-values into
+    PVALUE_CACHE and their measurements into METRICS."""
+
+    with ProcessPoolExecutor(max_workers=workers,
+                             initializer=start_year_worker,
+                             initargs=(FILE_CACHE_ENABLED,
+                                       METRICS.enabled,
+                                       PVALUE_CACHE)) as executor:
+        futures = [executor.submit(worker, year, *args) for year in years]
+        with click.progressbar(
+                as_completed(futures),
+                label=f'Calculating {len(futures)} years in '
+                f'{workers} processes for Appleseed map 🍎',
+                length=len(futures)) as bar:
+            for future in bar:
+                year, result, year_cache, records = future.result()
+                PVALUE_CACHE.merge(year_cache)
+                METRICS.extend(records)
+                yield year, result
+
+
 def make_csv_row_demo(d: dict, year: int,
                       demo: str, p: str,
                       district: int) -> list:
@@ -529,157 +1953,963 @@ def report_nested_file_location(first_year: int, last_year: int):
         return f"🍏🍏🍏 Data saved to {first_path} through {last_path} 🍏🍏🍏"
 
 
+NESTED_HEADER = ["district",
+                 "groupActions",
+                 "scale",
+                 "groupPop",
+                 "allActions",
+                 "allPop"]
+
+
+def get_nested_path(year: int, demo: str, p: str,
+                    extension: str,
+                    include_charters: bool = False,
+                    include_traditional: bool = True) -> str:
+    dirname = os.path.dirname
+    charter_status = get_charter_status(include_charters,
+                                        include_traditional)
+    return os.path.join(dirname(dirname(__file__)),
+                        os.path.join('data', str(year), demo,
+                        f'{p}{charter_status}.{extension}'))
+
+
+def make_nested_rows(d: dict, year: int, demo: str, p: str) -> List[list]:
+    make_row = make_csv_row_all if demo == "ALL" else make_csv_row_demo
+    return [make_row(d, year, demo, p, district)
+            for district in d[year][demo][p]]
+
+
+def stdlib_json_dumps(obj: Any) -> bytes:
+    return json.dumps(obj, separators=(',', ':'),
+                      ensure_ascii=False).encode()
+
+
+def orjson_dumps(obj: Any) -> bytes:
+    return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+
+
+# Both backends produce the same bytes: compact separators, int keys
+# as strings, and UTF-8 instead of escapes for any non-ASCII text.
+
+JSON_BACKENDS: Dict[str, Callable[[Any], bytes]] = {
+    "stdlib": stdlib_json_dumps}
+if orjson is not None:
+    JSON_BACKENDS["orjson"] = orjson_dumps
+
+# Changed by the CLI's --json-backend option.
+
+JSON_BACKEND = "orjson" if orjson is not None else "stdlib"
+
+
+def json_dumps(obj: Any) -> bytes:
+    return JSON_BACKENDS[JSON_BACKEND](obj)
+
+
+def iter_json_chunks(d: dict, depth: int = 2) -> Iterator[bytes]:
+
+    """
+    Serializes a nested dict a piece at a time, encoding only one value
+    at the given depth at once, so the whole document never has to be
+    held in memory."""
+
+    if depth == 0 or not isinstance(d, dict):
+        yield json_dumps(d)
+        return
+    yield b'{'
+    for i, (key, value) in enumerate(d.items()):
+        if i:
+            yield b','
+        yield json_dumps({key: None})[1:-len(b'null}')]
+        yield from iter_json_chunks(value, depth - 1)
+    yield b'}'
+
+
+def nested_csv_content(rows: List[list]) -> bytes:
+    f = io.StringIO(newline='')
+    writer = csv.writer(f)
+    writer.writerow(NESTED_HEADER)
+    writer.writerows(rows)
+    return f.getvalue().encode()
+
+
+def nested_json_content(rows: List[list]) -> bytes:
+    view = {row[0]: {"C": row[1],
+                     "S": row[2],
+                     "P": row[3],
+                     "aC": row[4],
+                     "aP": row[5]} for row in rows}
+    return json_dumps(view)
+
+
+# mkstemp makes files only the owner can read, so exports are given
+# the mode open() would have given them before they're renamed.
+
+def get_umask() -> int:
+    umask = os.umask(0o022)
+    os.umask(umask)
+    return umask
+
+
+FILE_MODE = 0o666 & ~get_umask()
+
+
+def write_file_atomically(path: str, content: bytes) -> None:
+    return write_chunks_atomically(path, [content])
+
+
+def write_chunks_atomically(path: str, chunks: Iterable[bytes]) -> None:
+
+    """
+    Writes a file through a temporary file in the same folder, so that
+    an interrupted write never leaves a partial file at path."""
+
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                     suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+        os.chmod(temp_path, FILE_MODE)
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return None
+
+
+# File extensions for the precompressed copies that exports can write
+# next to each file, for a web server to send as they are.
+
+COMPRESSIONS = ("gz", "br") if brotli is not None else ("gz",)
+
+
+def compress_chunks(extension: str,
+                    chunks: Iterable[bytes]) -> Iterator[bytes]:
+    if extension == "gz":
+        # A gzip header with no timestamp, so unchanged content
+        # compresses to unchanged bytes.
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 31)
+        process, finish = compressor.compress, compressor.flush
+    else:
+        compressor = brotli.Compressor(quality=11)
+        process, finish = compressor.process, compressor.finish
+    for chunk in chunks:
+        yield process(chunk)
+    yield finish()
+
+
+def iter_file_chunks(path: str) -> Iterator[bytes]:
+    with open(path, 'rb') as f:
+        yield from iter(lambda: f.read(1 << 20), b'')
+
+
+def write_compressed_siblings(path: str,
+                              compressions: Sequence[str],
+                              content: Optional[bytes] = None) -> List[str]:
+
+    """
+    Writes a compressed copy of path next to it for each extension in
+    compressions, such as path.gz, unless that copy is newer than path,
+    meaning path hasn't been rewritten since it was compressed. Uses
+    content if given, instead of reading path again. Returns the paths
+    of all the copies."""
+
+    siblings = []
+    for extension in compressions:
+        sibling = f'{path}.{extension}'
+        siblings.append(sibling)
+        try:
+            if os.stat(sibling).st_mtime_ns >= os.stat(path).st_mtime_ns:
+                continue
+        except OSError:
+            pass
+        chunks = [content] if content is not None else iter_file_chunks(path)
+        write_chunks_atomically(sibling, compress_chunks(extension, chunks))
+    return siblings
+
+
+def write_if_changed(path: str, content: bytes) -> bool:
+
+    """
+    Writes content to path unless the file there already has the same
+    hash, leaving its mtime alone so web server ETags and caches stay
+    valid. Returns whether the file was written."""
+
+    try:
+        if os.path.getsize(path) == len(content):
+            with open(path, 'rb') as f:
+                on_disk = hashlib.sha256(f.read()).digest()
+            if on_disk == hashlib.sha256(content).digest():
+                return False
+    except OSError:
+        pass
+    write_file_atomically(path, content)
+    return True
+
+
+def write_stream_if_changed(path: str, chunks: Iterable[bytes]) -> bool:
+
+    """
+    Like write_if_changed, for content too big to hold in memory: the
+    chunks are written to a temporary file, which replaces the file at
+    path only if their hash differs from it."""
+
+    sha = hashlib.sha256()
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                     suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in chunks:
+                sha.update(chunk)
+                f.write(chunk)
+        os.chmod(temp_path, FILE_MODE)
+        try:
+            if get_file_signature(path)["sha256"] == sha.hexdigest():
+                return False
+        except OSError:
+            pass
+        os.replace(temp_path, path)
+        return True
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def write_nested_files(d: dict,
+                       serialize: Callable[[List[list]], bytes],
+                       extension: str,
+                       include_charters: bool = False,
+                       include_traditional: bool = True,
+                       workers: int = 8,
+                       compressions: Sequence[str] = ()
+                       ) -> Dict[int, List[str]]:
+
+    """
+    Writes one file for each year, demo and punishment in d, along with
+    any compressed copies, serializing, compressing and writing them in
+    a pool of threads. Returns the files for each year, including those
+    that were already up to date."""
+
+    files = [(year, demo, p, get_nested_path(year, demo, p, extension,
+                                             include_charters,
+                                             include_traditional))
+             for year in d
+             for demo in d[year]
+             for p in d[year][demo] if p != "POP"]
+    for directory in {os.path.dirname(file[-1]) for file in files}:
+        os.makedirs(directory, exist_ok=True)
+
+    def write(file: Tuple[int, str, str, str]) -> Tuple[bool, List[str]]:
+        year, demo, p, path = file
+        content = serialize(make_nested_rows(d, year, demo, p))
+        changed = write_if_changed(path, content)
+        return changed, write_compressed_siblings(path, compressions,
+                                                  content)
+
+    written: Dict[int, List[str]] = {}
+    changed = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for file, (file_changed, siblings) in zip(
+                files, executor.map(write, files)):
+            changed += file_changed
+            written.setdefault(file[0], []).extend([file[-1]] + siblings)
+    click.echo(f"{changed} files written, "
+               f"{len(files) - changed} already up to date")
+    return written
+
+
 def dict_to_nested(d: dict, first_year: int, last_year: int,
               include_charters: bool = False,
-              include_traditional: bool = True) -> None:
-    for year in d:
-        for demo in d[year]:
-            for p in (p for p in d[year][demo] if p != "POP"):
-                view = [
-                    ["district",
-                    "groupActions",
-                    "scale",
-                    "groupPop",
-                    "allActions",
-                    "allPop"]
-                ]
-                for district in d[year][demo][p]:
-                    if demo == "ALL":
-                        view.append(make_csv_row_all(
-                            d, year, demo, p, district))
-                    else:
-                        view.append(make_csv_row_demo(
-                            d, year, demo, p, district))
-                dirname = os.path.dirname
-                if not include_traditional:
-                    charter_status = "ChartersOnly"
-                elif include_charters:
-                    charter_status = "WithCharters"
-                else:
-                    charter_status = ""
-                csv_path = os.path.join(dirname(dirname(__file__)),
-                            os.path.join('data', str(year), demo,
-                            f'{p}{charter_status}.csv'))
-                directory = os.path.dirname(csv_path)
-                if not os.path.exists(directory):
-                    os.makedirs(directory)
-                with open(csv_path, 'w', newline='') as f:
-                    writer = csv.writer(f)
-                    writer.writerows(view)
+              include_traditional: bool = True,
+              workers: int = 8,
+              compressions: Sequence[str] = ()) -> Dict[int, List[str]]:
+    written = write_nested_files(d, nested_csv_content, 'csv',
+                                 include_charters, include_traditional,
+                                 workers, compressions)
     click.echo(report_nested_file_location(first_year, last_year))
 
-    return None
+    return written
 
 def dict_to_nested_json(d: dict, first_year: int, last_year: int,
               include_charters: bool = False,
-              include_traditional: bool = True) -> None:
+              include_traditional: bool = True,
+              workers: int = 8,
+              compressions: Sequence[str] = ()) -> Dict[int, List[str]]:
 
-    for year in d:
-        for demo in d[year]:
-            for p in (p for p in d[year][demo] if p != "POP"):
-                view = {}
-                for district in d[year][demo][p]:
-                    if demo == "ALL":
-                        district_row = make_csv_row_all(
-                            d, year, demo, p, district)
-                    else:
-                        district_row = make_csv_row_demo(
-                            d, year, demo, p, district)
-                    view[district] = {
-                        "C": district_row[1],
-                        "S": district_row[2],
-                        "P": district_row[3],
-                        "aC": district_row[4],
-                        "aP": district_row[5]}
-                dirname = os.path.dirname
-                if not include_traditional:
-                    charter_status = "ChartersOnly"
-                elif include_charters:
-                    charter_status = "WithCharters"
-                else:
-                    charter_status = ""
-                json_path = os.path.join(dirname(dirname(__file__)),
-                            os.path.join('data', str(year), demo,
-                            f'{p}{charter_status}.json'))
-                directory = os.path.dirname(json_path)
-                if not os.path.exists(directory):
-                    os.makedirs(directory)
-                with open(json_path, 'w') as f:
-                    json.dump(view, f)
+    written = write_nested_files(d, nested_json_content, 'json',
+                                 include_charters, include_traditional,
+                                 workers, compressions)
+    click.echo(report_nested_file_location(first_year, last_year))
+
+    return written
+
+
+# The binary format is BINARY_MAGIC, the length of a JSON header as a
+# little-endian uint32, the header padded to a multiple of 8 bytes, and
+# then the arrays the header lists, each as [offset, dtype, length]
+# with the offset counted from the end of the header. There's one
+# district array for the year, in ascending order with 0 for the state,
+# and for each demo and punishment a "C" array of counts and, except
+# for populations, an "S" array of scale scores.
+
+BINARY_MAGIC = b"STPP"
+BINARY_VERSION = 1
+BINARY_MISSING = {"C": -1, "S": -128}
+BINARY_DTYPES = {"C": "<i4", "S": "|i1"}
+
+
+def get_binary_path(year: int,
+                    include_charters: bool = False,
+                    include_traditional: bool = True) -> str:
+    dirname = os.path.dirname
+    charter_status = get_charter_status(include_charters,
+                                        include_traditional)
+    return os.path.join(dirname(dirname(__file__)),
+                        os.path.join('data', str(year),
+                        f'stpp{charter_status}.bin'))
+
+
+def binary_year_content(year: int, year_dict: dict) -> bytes:
+    import numpy as np
+    districts = sorted({district for demo in year_dict
+                        for p in year_dict[demo]
+                        for district in year_dict[demo][p]})
+    index = {district: i for i, district in enumerate(districts)}
+    arrays = [("districts", np.array(districts, dtype="<i4"))]
+    for demo in year_dict:
+        for p, entries in year_dict[demo].items():
+            where = [index[district] for district in entries]
+            for field in ("C", "S") if p != "POP" else ("C",):
+                values = np.full(len(districts), BINARY_MISSING[field],
+                                 dtype=BINARY_DTYPES[field])
+                values[where] = [entry.get(field, BINARY_MISSING[field])
+                                 for entry in entries.values()]
+                arrays.append((f"{demo}/{p}/{field}", values))
+    header = {"version": BINARY_VERSION, "year": year, "arrays": {}}
+    offset = 0
+    for name, values in arrays:
+        header["arrays"][name] = [offset, values.dtype.str, len(values)]
+        offset += -(-values.nbytes // 8) * 8
+    header_bytes = json.dumps(header, separators=(',', ':')).encode()
+    header_bytes += b" " * (-(len(BINARY_MAGIC) + 4 + len(header_bytes))
+                            % 8)
+    body = bytearray(offset)
+    for name, values in arrays:
+        start = header["arrays"][name][0]
+        body[start:start + values.nbytes] = values.tobytes()
+    return (BINARY_MAGIC + len(header_bytes).to_bytes(4, "little")
+            + header_bytes + bytes(body))
+
+
+def load_binary_year(path: str) -> dict:
+
+    """
+    Reads a file written by dict_to_binary, returning its year and a
+    dict of numpy arrays by name, such as "districts" or "BLA/OSS/C".
+    The arrays are read-only views of the file's bytes."""
+
+    import numpy as np
+    with open(path, 'rb') as f:
+        content = f.read()
+    if content[:len(BINARY_MAGIC)] != BINARY_MAGIC:
+        raise ValueError(f"{path} isn't an stpp binary file")
+    start = len(BINARY_MAGIC) + 4
+    header_length = int.from_bytes(content[len(BINARY_MAGIC):start],
+                                   "little")
+    header = json.loads(content[start:start + header_length])
+    if header["version"] != BINARY_VERSION:
+        raise ValueError(f"{path} has unknown version {header['version']}")
+    body = start + header_length
+    return {"year": header["year"],
+            "arrays": {name: np.frombuffer(content, dtype=dtype,
+                                           count=length,
+                                           offset=body + offset)
+                       for name, (offset, dtype, length)
+                       in header["arrays"].items()}}
+
+
+def binary_year_to_view(year_data: dict, demo: str, p: str) -> dict:
+
+    """
+    The same view of one demo and punishment that dict_to_nested_json
+    writes, made from the arrays of load_binary_year."""
+
+    arrays = year_data["arrays"]
+
+    def values(name: str, field: str) -> list:
+        if name not in arrays:
+            return [None] * len(arrays["districts"])
+        return [None if value == BINARY_MISSING[field] else value
+                for value in arrays[name].tolist()]
+
+    counts = values(f"{demo}/{p}/C", "C")
+    scales = values(f"{demo}/{p}/S", "S")
+    districts = arrays["districts"].tolist()
+    if demo == "ALL":
+        state = districts.index(0)
+        pops = values("ALL/POP/C", "C")
+        all_counts = [counts[state]] * len(counts)
+        all_pops = [pops[state]] * len(counts)
+    else:
+        pops = values(f"{demo}/POP/C", "C")
+        all_counts = values(f"ALL/{p}/C", "C")
+        all_pops = values("ALL/POP/C", "C")
+    return {district: {"C": counts[i],
+                       "S": scales[i],
+                       "P": pops[i],
+                       "aC": all_counts[i],
+                       "aP": all_pops[i]}
+            for i, district in enumerate(districts)
+            if counts[i] is not None}
+
+
+def dict_to_binary(d: dict, first_year: int, last_year: int,
+                   include_charters: bool = False,
+                   include_traditional: bool = True,
+                   compressions: Sequence[str] = ()
+                   ) -> Dict[int, List[str]]:
 
+    """
+    Exports one compact binary file per year, holding every demo and
+    punishment as columns. See BINARY_MAGIC for the layout, and
+    load_binary_year and js/stppBinary.js for loaders."""
+
+    written: Dict[int, List[str]] = {}
+    for year in (year for year in d if any(d[year].values())):
+        path = get_binary_path(year, include_charters, include_traditional)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        content = binary_year_content(year, d[year])
+        write_if_changed(path, content)
+        written[year] = [path] + write_compressed_siblings(
+            path, compressions, content)
     click.echo(report_nested_file_location(first_year, last_year))
 
-    return None
+    return written
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS districts (
+    district INTEGER PRIMARY KEY,
+    charter INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS facts (
+    variant TEXT NOT NULL,
+    year INTEGER NOT NULL,
+    demo TEXT NOT NULL,
+    punishment TEXT NOT NULL,
+    district INTEGER NOT NULL REFERENCES districts (district),
+    C INTEGER,
+    S INTEGER,
+    P INTEGER,
+    aC INTEGER,
+    aP INTEGER,
+    PRIMARY KEY (variant, year, demo, punishment, district)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS facts_by_district
+    ON facts (district, year);
+CREATE INDEX IF NOT EXISTS facts_by_scale
+    ON facts (variant, year, demo, punishment, S);
+"""
+
+
+def get_sqlite_path() -> str:
+    dirname = os.path.dirname
+    return os.path.join(dirname(dirname(__file__)),
+                        os.path.join('data', 'processed', 'stpp.sqlite'))
 
-def dict_to_json(d: dict, first_year: int, last_year: int,
-              include_charters: bool = False,
-              include_traditional: bool = True) -> None:
+
+def iter_sqlite_facts(d: dict, year: int,
+                      charter_status: str) -> Iterator[tuple]:
+    for demo in d[year]:
+        for p in (p for p in d[year][demo] if p != "POP"):
+            for row in make_nested_rows(d, year, demo, p):
+                yield (charter_status, year, demo, p, *row)
+
+
+def dict_to_sqlite(d: dict, first_year: int, last_year: int,
+                   include_charters: bool = False,
+                   include_traditional: bool = True,
+                   charters: Optional[set] = None) -> Dict[int, List[str]]:
+
+    """
+    Writes the same rows as the nested exports into one SQLite database
+    with a table of districts and a table of facts, keyed by charter
+    variant, year, demo, punishment and district. Each year in d
+    replaces whatever that year held before, so rebuilding some years
+    updates them in place. The whole export is one transaction."""
+
+    db_path = get_sqlite_path()
+    os.makedirs(os.path.dirname(db_path), exist_ok=True)
+    charter_status = get_charter_status(include_charters,
+                                        include_traditional)
+    years = [year for year in d if any(d[year].values())]
+    if charters is None:
+        # One charter flag per district, as of the last year exported.
+        charters = get_charters(max(years, default=CHARTER_FALLBACK_YEAR))
+    connection = sqlite3.connect(db_path)
+    try:
+        connection.executescript(SQLITE_SCHEMA)
+        with connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO districts VALUES (?, ?)",
+                ((district, district in charters) for district in
+                 {district for year in years for demo in d[year]
+                  for p in d[year][demo] for district in d[year][demo][p]}))
+            for year in years:
+                connection.execute(
+                    "DELETE FROM facts WHERE variant = ? AND year = ?",
+                    (charter_status, year))
+                connection.executemany(
+                    "INSERT INTO facts VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    iter_sqlite_facts(d, year, charter_status))
+    finally:
+        connection.close()
+    click.echo(f"🍏🍏🍏 Data saved to {db_path} 🍏🍏🍏")
+    return {year: [db_path] for year in years}
+
+
+def get_json_path(first_year: int, last_year: int,
+                  include_charters: bool = False,
+                  include_traditional: bool = True) -> str:
     if first_year == last_year:
         filename_year = str(first_year)
     else:
         filename_year = f"{first_year}-{last_year}"
-    if not include_traditional:
-        charter_status = "ChartersOnly"
-    elif include_charters:
-        charter_status = "WithCharters"
-    else:
-        charter_status = ""
+    charter_status = get_charter_status(include_charters,
+                                        include_traditional)
     dirname=os.path.dirname
-    data_path = os.path.join(dirname(dirname(__file__)),
-                            os.path.join('data', 'processed',
-                            f'stpp{charter_status}{filename_year}.json'))
-    directory = dirname(data_path)
-    if not os.path.exists(directory):
-        os.makedirs(directory)
-    with open(data_path, 'w') as fp:
-        json.dump(d, fp)
-        click.echo(f"🍏🍏🍏 Data saved to {data_path} 🍏🍏🍏")
-    return None
+    return os.path.join(dirname(dirname(__file__)),
+                        os.path.join('data', 'processed',
+                        f'stpp{charter_status}{filename_year}.json'))
 
 
-def TEA_to_dict(first_year: int, last_year: int,
+def dict_to_json(d: dict, first_year: int, last_year: int,
               include_charters: bool = False,
-              include_traditional: bool = True) -> dict:
+              include_traditional: bool = True,
+              compressions: Sequence[str] = ()) -> Dict[int, List[str]]:
+    data_path = get_json_path(first_year, last_year,
+                              include_charters, include_traditional)
+    os.makedirs(os.path.dirname(data_path), exist_ok=True)
+    write_stream_if_changed(data_path, iter_json_chunks(d))
+    # The file is too big to hold in memory, so each compressed copy
+    # reads it back, in its own thread.
+    with ThreadPoolExecutor(max_workers=max(len(compressions), 1)) as pool:
+        siblings = [path for paths in pool.map(
+            lambda extension: write_compressed_siblings(data_path,
+                                                        [extension]),
+            compressions) for path in paths]
+    click.echo(f"🍏🍏🍏 Data saved to {data_path} 🍏🍏🍏")
+    return {year: [data_path] + siblings for year in d}
+
+
+class BuildManifest:
 
+    """
+    Records the signatures of the TEA files each year was built from, and
+    the files that each export format and charter variant wrote for it,
+    so that an incremental build can skip years whose inputs haven't
+    changed and whose outputs are still in place."""
+
+    def __init__(self) -> None:
+        self.years: Dict[str, dict] = {}
+
+    def load(self, path: str) -> None:
+        try:
+            with open(path) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if manifest.get("version") == FILE_CACHE_VERSION:
+            self.years = manifest.get("years", {})
+        return None
+
+    def save(self, path: str) -> None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f'{path}.{os.getpid()}.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump({"version": FILE_CACHE_VERSION, "years": self.years},
+                      f, indent=1, sort_keys=True)
+        os.replace(temp_path, path)
+        return None
+
+    def is_current(self, year: int, output_key: str) -> bool:
+        entry = self.years.get(str(year))
+        if entry is None or output_key not in entry["outputs"]:
+            return False
+        if not all(os.path.isfile(get_project_path(path))
+                   for path in entry["outputs"][output_key]):
+            return False
+        try:
+            return cache_matches_sources(entry, get_year_source_paths(year))
+        except OSError:
+            return False
+
+    def record(self, year: int, output_key: str,
+               output_paths: Iterable[str]) -> None:
+
+        """
+        Records the files written for one output of a year. If the
+        year's TEA files have changed since its other outputs were
+        recorded, those are forgotten, since they're now out of date."""
+
+        entry = self.years.get(str(year), {})
+        known = entry.get("sources", [])
+        source_paths = get_year_source_paths(year)
+        if len(known) != len(source_paths):
+            known = [None] * len(source_paths)
+        sources = [get_file_signature(path, signature)
+                   for path, signature in zip(source_paths, known)]
+        if [s["sha256"] for s in sources] != [
+                s and s["sha256"] for s in known]:
+            entry = {}
+        self.years[str(year)] = {
+            "version": FILE_CACHE_VERSION,
+            "sources": sources,
+            "outputs": {**entry.get("outputs", {}),
+                        output_key: sorted(get_relative_project_path(path)
+                                           for path in output_paths)}}
+        return None
+
+
+def get_project_path(relative_path: str) -> str:
+    dirname = os.path.dirname
+    return os.path.join(dirname(dirname(__file__)), relative_path)
+
+
+def get_relative_project_path(path: str) -> str:
+    dirname = os.path.dirname
+    return os.path.relpath(path, dirname(dirname(__file__)))
+
+
+def get_output_key(format: str, variant: str,
+                   compressions: Iterable[str] = ()) -> str:
+
+    """
+    The name of an export in the manifest: its format, charter variant
+    and the compressed copies written with it, so that asking for other
+    copies makes the year stale."""
+
+    return f'{format}{variant}' + "".join(
+        f'.{extension}' for extension in sorted(set(compressions)))
+
+
+def find_stale_years(manifest: BuildManifest,
+                     first_year: int,
+                     last_year: int,
+                     output_keys: Iterable[str]) -> List[int]:
+    output_keys = list(output_keys)
+    return [year for year in range(first_year, last_year + 1)
+            if not all(manifest.is_current(year, key)
+                       for key in output_keys)]
+
+
+def report_year_range(first_year: int, last_year: int) -> None:
     if last_year == first_year:
         click.secho(
             f'Making statistics for just the year {first_year}', fg='green')
     else:
         click.secho(
             f'Making statistics for years {first_year} through {last_year}', fg='green')
-    d = make_empty_dict(first_year, last_year)
+    return None
 
-    for year in range(first_year, last_year + 1):
+
+def TEA_to_dict(first_year: int, last_year: int,
+              include_charters: bool = False,
+              include_traditional: bool = True,
+              workers: int = 1,
+              years: Optional[Sequence[int]] = None) -> dict:
+
+    report_year_range(first_year, last_year)
+    if years is None:
+        years = range(first_year, last_year + 1)
+    d = make_empty_dict_for_years(years)
+
+    if workers > 1:
+        for year, year_dict in make_years_in_processes(
+                make_one_year, list(d), workers,
+                include_charters, include_traditional):
+            d[year] = year_dict
+        return d
+
+    for year in d:
         d = add_year_to_dict(year, d, include_charters, include_traditional)
     return d
 
 
-def download_one_file(url: str,
-                      payload: dict) -> str:
+def TEA_to_variant_dicts(first_year: int, last_year: int,
+                         workers: int = 1,
+                         years: Optional[Sequence[int]] = None
+                         ) -> Dict[str, dict]:
+
+    """
+    Builds a dict for each charter variant in CHARTER_VARIANTS, reading
+    and scoring each year's records only once."""
+
+    report_year_range(first_year, last_year)
+    if years is None:
+        years = range(first_year, last_year + 1)
+    dicts = {variant: make_empty_dict_for_years(years)
+             for variant in CHARTER_VARIANTS}
+
+    if workers > 1:
+        for year, year_dicts in make_years_in_processes(
+                make_one_year_of_variants, list(dicts[""]), workers):
+            for variant in dicts:
+                dicts[variant][year] = year_dicts[variant]
+        return dicts
+
+    for year in dicts[""]:
+        dicts = add_year_to_variant_dicts(year, dicts)
+    return dicts
+
+
+class LazyDemo(Mapping):
+
+    """
+    The punishments of one demo in a LazyYear. Each punishment's
+    entries, with their scale statistic, are made the first time
+    they're looked up."""
+
+    def __init__(self, year: "LazyYear", demo: str) -> None:
+        self.year = year
+        self.demo = demo
+        self.slices: Dict[str, dict] = {}
+
+    def __getitem__(self, p: str) -> dict:
+        if p not in self.slices:
+            table = self.year.get_table()
+            if p not in table.columns[self.demo]:
+                raise KeyError(p)
+            if p != "POP":
+                table.score(self.demo, p)
+            self.slices[p] = table.entries(self.demo, p)
+        return self.slices[p]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.year.get_table().columns[self.demo])
+
+    def __len__(self) -> int:
+        return len(self.year.get_table().columns[self.demo])
+
+
+class LazyYear(Mapping):
+
+    """
+    One year of a TEADataset. The year's records are read and added up
+    into a YearTable the first time anything in it is looked up, and
+    each demo and punishment is only scored when it's looked up."""
+
+    def __init__(self, year: int,
+                 include_charters: bool = False,
+                 include_traditional: bool = True) -> None:
+        self.year = year
+        self.include_charters = include_charters
+        self.include_traditional = include_traditional
+        self.table: Optional[YearTable] = None
+        self.demos: Dict[str, LazyDemo] = {}
+
+    def get_table(self) -> YearTable:
+        if self.table is None:
+            counts = select_counts(*read_year_counts(self.year),
+                                   self.include_charters,
+                                   self.include_traditional)
+            table = YearTable.from_counts(self.year, counts)
+            with METRICS.stage("aggregate", self.year):
+                table.add_aggregates(get_district_index(self.year))
+            self.table = table
+        return self.table
+
+    def __getitem__(self, demo: str) -> LazyDemo:
+        if demo not in self.demos:
+            if demo not in self.get_table().columns:
+                raise KeyError(demo)
+            self.demos[demo] = LazyDemo(self, demo)
+        return self.demos[demo]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.get_table().columns)
+
+    def __len__(self) -> int:
+        return len(self.get_table().columns)
+
+    def to_dict(self) -> dict:
+        return {demo: dict(self[demo]) for demo in self}
+
+
+class TEADataset(Mapping):
+
+    """
+    Works like the dict from TEA_to_dict, as d[year][demo][p][district],
+    but only reads and scores what's looked up, keeping it for the next
+    time. Looking up one punishment of one demo reads that year's TEA
+    files and scores just that punishment. to_dict() makes the whole
+    nested dict, for the exporters."""
+
+    def __init__(self, years: Iterable[int],
+                 include_charters: bool = False,
+                 include_traditional: bool = True) -> None:
+        self.years = {year: LazyYear(year, include_charters,
+                                     include_traditional)
+                      for year in years}
+
+    def __getitem__(self, year: int) -> LazyYear:
+        return self.years[year]
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self.years)
+
+    def __len__(self) -> int:
+        return len(self.years)
+
+    def to_dict(self) -> dict:
+        return {year: self[year].to_dict() for year in self}
+
+
+def TEA_to_dataset(first_year: int, last_year: int,
+                   include_charters: bool = False,
+                   include_traditional: bool = True,
+                   years: Optional[Sequence[int]] = None) -> TEADataset:
+    if years is None:
+        years = range(first_year, last_year + 1)
+    return TEADataset(years, include_charters, include_traditional)
+
+
+TEA_REGION_URL = "https://rptsvr1.tea.texas.gov/cgi/sas/broker"
+TEA_PERFREPORT_URL = \
+    "https://rptsvr1.tea.texas.gov/perfreport/snapshot/push.cgi"
+
+# A download is a local path, the URL to post to, and the form payload.
+
+Download = Tuple[str, str, dict]
+
+
+class RateLimiter:
+
+    """
+    Spaces out the start of the requests made by each thread, so that
+    each download worker, and so each connection, starts no more than
+    requests_per_second on average. The workers' requests overlap, so
+    all of them together make up to workers times as many."""
+
+    def __init__(self, requests_per_second: float) -> None:
+        self.interval = (1 / requests_per_second
+                         if requests_per_second > 0 else 0)
+        self.local = threading.local()
+
+    def wait(self) -> None:
+        now = time.monotonic()
+        start = max(now, getattr(self.local, "next_start", 0.0))
+        self.local.next_start = start + self.interval
+        time.sleep(start - now)
+        return None
+
+
+def make_download_session(workers: int) -> "requests.Session":
+    import requests
+    from requests.adapters import HTTPAdapter
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.verify = False # overrides the SSL error
+    return session
 
-    request = requests.post(
+
+def is_complete_report(text: str) -> bool:
+
+    """
+    Both kinds of TEA file start with a header naming the DISTRICT
+    column. An error page from the server doesn't."""
+
+    return "DISTRICT" in text.split("\n", 1)[0]
+
+
+def is_complete_download(path: str) -> bool:
+    try:
+        with open(path) as f:
+            return is_complete_report(f.readline())
+    except (OSError, UnicodeDecodeError):
+        return False
+
+
+def download_one_file(url: str,
+                      payload: dict,
+                      session: Optional["requests.Session"] = None,
+                      limiter: Optional[RateLimiter] = None) -> str:
+
+    import requests
+    if limiter is not None:
+        limiter.wait()
+    post = session.post if session is not None else requests.post
+    request = post(
         url,
         verify=False, # verify=False overrides the SSL error
         data=payload)
-    time.sleep(2)
+    request.raise_for_status()
+    if not is_complete_report(request.text):
+        raise ValueError(f"Unexpected response from {url}")
     return request.text
 
 
-def download_regions_from_TEA(first_year: int,
-                              last_year: int) -> None:
-    """
-    Downloads district disciplinary report records for the specified years
-    # from the Texas Education Agency's website."""
+def download_to_file(download: Download,
+                     session: "requests.Session",
+                     limiter: RateLimiter,
+                     attempts: int = 3) -> str:
+    import requests
+    path, url, payload = download
+    for attempt in range(1, attempts + 1):
+        try:
+            report = download_one_file(url, payload, session, limiter)
+            break
+        except (requests.RequestException, ValueError):
+            if attempt == attempts:
+                raise
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    write_file_atomically(path, report.encode())
+    return path
+
+
+def download_files(downloads: Sequence[Download],
+                   workers: int = 4,
+                   requests_per_second: float = 0.5,
+                   force: bool = False) -> List[str]:
 
-    dirname=os.path.dirname
+    """
+    Downloads files in a pool of threads sharing one session, skipping
+    the files that were already downloaded completely, so that running
+    it again resumes an interrupted download. Returns the paths that
+    couldn't be downloaded."""
+
+    import requests
+    pending = [download for download in downloads
+               if force or not is_complete_download(download[0])]
+    if len(pending) < len(downloads):
+        click.echo(f"Skipping {len(downloads) - len(pending)} files "
+                   "that were already downloaded")
+    failed = []
+    limiter = RateLimiter(requests_per_second)
+    with make_download_session(workers) as session, \
+            ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(download_to_file, download,
+                                   session, limiter): download[0]
+                   for download in pending}
+        for future in as_completed(futures):
+            try:
+                click.echo(f"Saving {future.result()}")
+            except (requests.RequestException, ValueError) as e:
+                click.echo(f"Unable to download {futures[future]}: {e}")
+                failed.append(futures[future])
+    return failed
+
+
+def get_region_downloads(first_year: int,
+                         last_year: int,
+                         url: str = TEA_REGION_URL) -> List[Download]:
+    downloads = []
     for year in range(first_year, last_year + 1):
         for region in range(1,21):
             r = str(region).zfill(2)
             y = str(year)[-2:]
-            district_path = os.path.join(
-                dirname(dirname(__file__)),
-                os.path.join('data', 'from_agency', 'by_region',
-                f'REGION_{r}_DISTRICT_summary_{y}.csv'))
             payload = {'_service': 'marykay',
                        '_program': 'adhoc.download_static_summary.sas',
                        'report_type':'csv',
@@ -688,41 +2918,49 @@ def download_regions_from_TEA(first_year: int,
                        '_debug':"0",
                        'school_yr': y,
                        'region': r}
-            report = download_one_file(
-                "https://rptsvr1.tea.texas.gov/cgi/sas/broker",
-                payload)
-            with open(district_path, "w") as f:
-                f.write(report)
-                click.echo(f"Saving {district_path}")
-                f.close()
-    return None
+            downloads.append((get_region_path(year, region), url, payload))
+    return downloads
+
+
+def get_perfreport_downloads(first_year: int,
+                             last_year: int,
+                             url: str = TEA_PERFREPORT_URL
+                             ) -> List[Download]:
+    downloads = []
+    for year in range(first_year, last_year + 1):
+        y = str(year)[-2:]
+        payload = {'level': 'district',
+                    'set': y,
+                    'suf':'.dat'}
+        downloads.append((get_district_path(year), url, payload))
+    return downloads
+
+
+def download_regions_from_TEA(first_year: int,
+                              last_year: int,
+                              workers: int = 4,
+                              requests_per_second: float = 0.5,
+                              force: bool = False) -> List[str]:
+    """
+    Downloads district disciplinary report records for the specified years
+    # from the Texas Education Agency's website."""
+
+    return download_files(get_region_downloads(first_year, last_year),
+                          workers, requests_per_second, force)
 
 
 def download_perfreports_from_TEA(first_year: int,
-                              last_year: int) -> None:
+                              last_year: int,
+                              workers: int = 4,
+                              requests_per_second: float = 0.5,
+                              force: bool = False) -> List[str]:
 
     """
     Downloads Snapshot district statistics for the specified years
     from the Texas Education Agency's website."""
 
-    dirname=os.path.dirname
-    for year in range(first_year, last_year + 1):
-        y = str(year)[-2:]
-        year_path = os.path.join(
-            dirname(dirname(__file__)),
-            os.path.join('data', 'from_agency', 'districts',
-            f'district20{y}.dat'))
-        payload = {'level': 'district',
-                    'set': y,
-                    'suf':'.dat'}
-        report = download_one_file(
-                "https://rptsvr1.tea.texas.gov/perfreport/snapshot/push.cgi",
-                payload)
-        with open(year_path, "w") as f:
-            f.write(report)
-            click.echo(f"Saving {year_path}")
-            f.close()
-    return None
+    return download_files(get_perfreport_downloads(first_year, last_year),
+                          workers, requests_per_second, force)
 
 
 def check_for_input_files(first_year: int,
@@ -756,11 +2994,34 @@ def check_for_input_files(first_year: int,
     return True
 
 
+def report_metrics(profile: bool, metrics_json: Optional[str]) -> None:
+    if profile:
+        click.echo(METRICS.table())
+        scoring_profile = METRICS.scoring_profile()
+        if scoring_profile:
+            click.echo("Scoring loop:")
+            click.echo(scoring_profile)
+    if metrics_json:
+        write_file_atomically(os.path.abspath(metrics_json), json.dumps(
+            METRICS.to_json(), indent=1).encode())
+    return None
+
+
+def non_negative(ctx: click.Context, param: click.Parameter,
+                 value: float) -> float:
+    if value < 0:
+        raise click.BadParameter("can't be negative.")
+    return value
+
+
 @click.command()
 @click.option('--include-charters', is_flag=True,
               help="Include statistics about charter schools.")
 @click.option('--charters-only', is_flag=True, help="Include charter "
               "schools, and also omit traditional districts.")
+@click.option('--all-variants', is_flag=True, help="Exports the default, "
+              "--include-charters, and --charters-only versions of the "
+              "data, reading the TEA's files only once.")
 @click.option('--first-year', '-f', type=click.IntRange(2006, 2050),
               default=2006, help="The first year of data to process. 2006 is "
               "the earliest year known to have been covered by the "
@@ -771,10 +3032,48 @@ def check_for_input_files(first_year: int,
               help="Connects to the TEA's server and tries to download "
               "data in the TEA's format to '../data/from_agency/'. "
               "This currently generates an InsecureRequestWarning "
-              "because SSL validation is not working.")
+              "because SSL validation is not working. Files that were "
+              "already downloaded completely are skipped.")
+@click.option('--redownload', is_flag=True, help="With --download, "
+              "downloads every file again even if it was already "
+              "downloaded.")
+@click.option('--download-workers', type=click.IntRange(1, None),
+              default=4, help="The number of files to download at once.")
+@click.option('--download-rate', type=float, callback=non_negative,
+              default=0.5, help="The most requests per second that each "
+              "download worker makes to the TEA's server, or 0 for no "
+              "limit.")
 @click.option('--skip-processing/--no-skip', default=False,
               help="Skips the process of converting data from the TEA's "
               "format into a new format.")
+@click.option('--workers', '-w', type=click.IntRange(1, None), default=1,
+              help="The number of processes to use. With more than one, "
+              "each year is calculated in a separate process.")
+@click.option('--cache/--no-cache', default=True,
+              help="Saves intermediate results such as the cleaned TEA "
+              "records and binomial test p-values in 'data/cache/', and "
+              "reuses them on later runs until the TEA files change.")
+@click.option('--incremental', is_flag=True, help="Only rebuilds the "
+              "years whose TEA files have changed, or whose exported "
+              "files are missing, since the last run, and leaves the "
+              "other years' files alone.")
+@click.option('--json-backend', type=click.Choice(sorted(JSON_BACKENDS)),
+              default=JSON_BACKEND, help="The library used to write JSON. "
+              "orjson is faster, and is used if it's installed. Both "
+              "write the same output.")
+@click.option('--precompress', type=click.Choice(COMPRESSIONS),
+              multiple=True, help="Also writes a compressed copy of each "
+              "exported file, such as OSS.json.gz, for the web server "
+              "to send as is. Can be given more than once. 'br' needs "
+              "the brotli package.")
+@click.option('--profile', is_flag=True, help="Prints the wall time, CPU "
+              "time, peak memory and row counts of each stage and year, "
+              "and a cProfile report of the scoring loop. With --workers "
+              "above 1, the scoring loop runs in the worker processes, "
+              "which aren't profiled.")
+@click.option('--metrics-json', type=click.Path(dir_okay=False),
+              help="Saves the measurements made for --profile to this "
+              "JSON file.")
 @click.option('--json', 'format', flag_value='json', help="Exports a single json file.")
 @click.option('--csv', 'format', flag_value='nested', help="Exports "
               "nested directories labeled by year, demographic, and "
@@ -785,12 +3084,29 @@ def check_for_input_files(first_year: int,
               "nested directories labeled by year, demographic, and "
               "punishment, with JSON files each containing the data "
               "corresponding to one possible user query.")
+@click.option('--binary', 'format', flag_value='binary', help="Exports "
+              "one compact binary file per year, with the data for every "
+              "demographic and punishment stored as columns.")
+@click.option('--sqlite', 'format', flag_value='sqlite', help="Exports "
+              "to the SQLite database 'data/processed/stpp.sqlite', "
+              "updating only the years that were processed.")
 def cli(include_charters: bool,
              charters_only: bool,
+             all_variants: bool,
              first_year: int,
              last_year: int,
              download: bool,
+             redownload: bool,
+             download_workers: int,
+             download_rate: float,
              skip_processing: bool,
+             workers: int,
+             cache: bool,
+             incremental: bool,
+             json_backend: str,
+             precompress: Tuple[str, ...],
+             profile: bool,
+             metrics_json: Optional[str],
              format: str) -> None:
 
     """
@@ -802,29 +3118,109 @@ def cli(include_charters: bool,
     (See www.texasdisciplinelab.org.)
     """
 
+    global FILE_CACHE_ENABLED, JSON_BACKEND, METRICS
+    FILE_CACHE_ENABLED = cache
+    JSON_BACKEND = json_backend
+    METRICS = StageMetrics(profile or metrics_json is not None, profile)
+
     include_traditional = True
     if charters_only:
         include_charters = True
         include_traditional = False
 
     if download:
-        download_perfreports_from_TEA(first_year, last_year)
-        download_regions_from_TEA(first_year, last_year)
+        downloads = get_perfreport_downloads(first_year, last_year) \
+            + get_region_downloads(first_year, last_year)
+        with METRICS.stage("download"):
+            failed = download_files(downloads, download_workers,
+                                    download_rate, redownload)
+            METRICS.count("files", len(downloads))
+            METRICS.count("failed", len(failed))
+        if failed:
+            click.echo(f"{len(failed)} files couldn't be downloaded. "
+                       "Running with --download again will retry them.")
 
     if not skip_processing:
         if check_for_input_files(first_year, last_year):
-            d = TEA_to_dict(first_year, last_year,
-                            include_charters,
-                            include_traditional)
-            if format == "json":
-                dict_to_json(d, first_year, last_year,
-                        include_charters, include_traditional)
-            if format == "nested":
-                dict_to_nested(d, first_year, last_year,
-                        include_charters, include_traditional)
-            if format == "nested_json":
-                dict_to_nested_json(d, first_year, last_year,
-                        include_charters, include_traditional)
-
-
+            if all_variants:
+                variants = list(CHARTER_VARIANTS)
+            else:
+                variants = [get_charter_status(include_charters,
+                                               include_traditional)]
+            manifest_path = get_cache_path('manifest.json')
+            manifest = BuildManifest()
+            manifest.load(manifest_path)
+            # With --no-cache, nothing is written to data/cache/ unless
+            # --incremental asks for the manifest.
+            keep_manifest = cache or incremental
+            years = list(range(first_year, last_year + 1))
+            # The SQLite export doesn't write compressed copies.
+            compressions = precompress if format != "sqlite" else ()
+            if incremental:
+                years = find_stale_years(
+                    manifest, first_year, last_year,
+                    (get_output_key(format, variant, compressions)
+                     for variant in variants))
+                # The single JSON file holds every year, so it's
+                # rebuilt whole if any of them has changed.
+                if format == "json" and (years or not all(
+                        os.path.isfile(get_json_path(
+                            first_year, last_year,
+                            *CHARTER_VARIANTS[variant]))
+                        for variant in variants)):
+                    years = list(range(first_year, last_year + 1))
+                if not years:
+                    click.echo("🍏🍏🍏 Data is already up to date 🍏🍏🍏")
+                    report_metrics(profile, metrics_json)
+                    return None
+                click.echo("Rebuilding changed years: "
+                           + ", ".join(str(year) for year in years))
+            pvalue_path = get_cache_path('pvalues.pickle')
+            if cache:
+                PVALUE_CACHE.load(pvalue_path)
+            with METRICS.stage("build"):
+                if all_variants:
+                    dicts = TEA_to_variant_dicts(first_year, last_year,
+                                                 workers, years)
+                else:
+                    dicts = {variants[0]:
+                             TEA_to_dict(first_year, last_year,
+                                         include_charters,
+                                         include_traditional,
+                                         workers, years)}
+            click.echo(PVALUE_CACHE.report())
+            if cache:
+                PVALUE_CACHE.save(pvalue_path)
+            for variant, d in dicts.items():
+                variant_flags = CHARTER_VARIANTS[variant]
+                written: Dict[int, List[str]] = {}
+                with METRICS.stage(f"export {format} {variant}".strip()):
+                    if format == "json":
+                        written = dict_to_json(d, first_year, last_year,
+                                               *variant_flags,
+                                               compressions=precompress)
+                    if format == "nested":
+                        written = dict_to_nested(d, first_year, last_year,
+                                                 *variant_flags,
+                                                 compressions=precompress)
+                    if format == "nested_json":
+                        written = dict_to_nested_json(
+                            d, first_year, last_year, *variant_flags,
+                            compressions=precompress)
+                    if format == "binary":
+                        written = dict_to_binary(d, first_year, last_year,
+                                                 *variant_flags,
+                                                 compressions=precompress)
+                    if format == "sqlite":
+                        written = dict_to_sqlite(d, first_year, last_year,
+                                                 *variant_flags)
+                    METRICS.count("files", sum(len(paths)
+                                               for paths in written.values()))
+                if keep_manifest:
+                    for year, paths in written.items():
+                        manifest.record(year, get_output_key(
+                            format, variant, compressions), paths)
+            if keep_manifest:
+                manifest.save(manifest_path)
+    report_metrics(profile, metrics_json)
     return None
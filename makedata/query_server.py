@@ -0,0 +1,196 @@
+# use python -m makedata.query_server --help
+
+"""
+An HTTP service answering queries about the statistics made by
+TEA_to_dict, from an index built in memory once at startup:
+
+    /districts/<district>                  every year for one district
+    /years/<year>/<demo>/<punishment>/top  the highest scale scores,
+                                           ?n=10 by default
+    /years/<year>/statewide                statewide totals for a year
+    /statewide                             statewide totals for every year
+"""
+
+import json
+import re
+import socketserver
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from typing import Callable, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+import click
+
+from makedata import collectFromFile
+
+
+class DisciplineIndex:
+
+    """
+    The nested dict from TEA_to_dict, rearranged so each query is a
+    dict lookup: by district, by year for the statewide totals, and
+    for each year, demo and punishment, a list of districts sorted by
+    scale score."""
+
+    def __init__(self, d: dict) -> None:
+        self.years = sorted(d)
+        self.districts: Dict[int, dict] = {}
+        self.statewide: Dict[int, dict] = {}
+        self.ranked: Dict[Tuple[int, str, str], List[dict]] = {}
+        for year in self.years:
+            self.statewide[year] = {}
+            for demo, punishments in d[year].items():
+                for p, entries in punishments.items():
+                    self.add_slice(year, demo, p, entries)
+
+    @classmethod
+    def from_json(cls, path: str) -> "DisciplineIndex":
+
+        """
+        Loads a file written by "collectFromFile --json", whose int keys
+        have become strings."""
+
+        def int_keys(pairs: list) -> dict:
+            return {int(key) if key.isdigit() else key: value
+                    for key, value in pairs}
+
+        with open(path) as f:
+            return cls(json.load(f, object_pairs_hook=int_keys))
+
+    def add_slice(self, year: int, demo: str, p: str,
+                  entries: Dict[int, dict]) -> None:
+        for district, entry in entries.items():
+            if district == 0:
+                self.statewide[year].setdefault(demo, {})[p] = entry["C"]
+                continue
+            self.districts.setdefault(district, {}).setdefault(
+                year, {}).setdefault(demo, {})[p] = entry
+        if p != "POP":
+            scored = [{"district": district, "S": entry["S"],
+                       "C": entry["C"]}
+                      for district, entry in entries.items()
+                      if "S" in entry and district != 0]
+            scored.sort(key=lambda row: (-row["S"], -row["C"],
+                                         row["district"]))
+            self.ranked[(year, demo, p)] = scored
+        return None
+
+    def district(self, district: int) -> Optional[dict]:
+        if district not in self.districts:
+            return None
+        return {"district": district, "years": self.districts[district]}
+
+    def top(self, year: int, demo: str, p: str, n: int = 10
+            ) -> Optional[List[dict]]:
+        if n < 0:
+            raise ValueError("n can't be negative")
+        if (year, demo, p) not in self.ranked:
+            return None
+        return self.ranked[(year, demo, p)][:n]
+
+    def totals(self, year: Optional[int] = None) -> Optional[dict]:
+        if year is None:
+            return self.statewide
+        return self.statewide.get(year)
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def make_handler(index: DisciplineIndex) -> type:
+
+    routes: List[Tuple["re.Pattern", Callable]] = [
+        (re.compile(r"/districts/(\d+)"),
+         lambda query, district: index.district(int(district))),
+        (re.compile(r"/years/(\d+)/(\w+)/(\w+)/top"),
+         lambda query, year, demo, p: index.top(
+             int(year), demo, p, int(query.get("n", ["10"])[0]))),
+        (re.compile(r"/years/(\d+)/statewide"),
+         lambda query, year: index.totals(int(year))),
+        (re.compile(r"/statewide"),
+         lambda query: index.totals())]
+
+    class QueryHandler(BaseHTTPRequestHandler):
+
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self) -> None:
+            url = urlsplit(self.path)
+            for pattern, answer in routes:
+                match = pattern.fullmatch(url.path.rstrip("/"))
+                if match is None:
+                    continue
+                try:
+                    result = answer(parse_qs(url.query), *match.groups())
+                except ValueError:
+                    return self.send_json(HTTPStatus.BAD_REQUEST,
+                                          {"error": "Invalid query"})
+                if result is None:
+                    return self.send_json(HTTPStatus.NOT_FOUND,
+                                          {"error": "No such data"})
+                return self.send_json(HTTPStatus.OK, result)
+            return self.send_json(HTTPStatus.NOT_FOUND,
+                                  {"error": "Unknown query"})
+
+        def send_json(self, status: HTTPStatus, result) -> None:
+            body = collectFromFile.json_dumps(result)
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("Access-Control-Allow-Origin", "*")
+            self.end_headers()
+            self.wfile.write(body)
+            return None
+
+        def log_message(self, *args) -> None:
+            pass
+
+    return QueryHandler
+
+
+def make_server(index: DisciplineIndex, port: int) -> HTTPServer:
+    return ThreadingHTTPServer(("", port), make_handler(index))
+
+
+@click.command()
+@click.option('--json-file', type=click.Path(exists=True, dir_okay=False),
+              help="A file exported by 'collectFromFile --json' to load. "
+              "Otherwise the statistics are calculated from the TEA's "
+              "files, using the cache in 'data/cache/'.")
+@click.option('--first-year', '-f', type=click.IntRange(2006, 2050),
+              default=2006)
+@click.option('--last-year', '-l', type=click.IntRange(2006, 2050),
+              default=2016)
+@click.option('--include-charters', is_flag=True)
+@click.option('--charters-only', is_flag=True)
+@click.option('--port', '-p', type=int, default=31339)
+def cli(json_file: Optional[str],
+        first_year: int,
+        last_year: int,
+        include_charters: bool,
+        charters_only: bool,
+        port: int) -> None:
+    if json_file:
+        index = DisciplineIndex.from_json(json_file)
+    else:
+        collectFromFile.FILE_CACHE_ENABLED = True
+        pvalue_path = collectFromFile.get_cache_path('pvalues.pickle')
+        collectFromFile.PVALUE_CACHE.load(pvalue_path)
+        index = DisciplineIndex(collectFromFile.TEA_to_dict(
+            first_year, last_year, include_charters or charters_only,
+            not charters_only))
+        collectFromFile.PVALUE_CACHE.save(pvalue_path)
+    server = make_server(index, port)
+    click.echo(f"Answering queries for {len(index.districts)} districts "
+               f"at http://localhost:{port}/")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    return None
+
+
+if __name__ == "__main__":
+    cli()
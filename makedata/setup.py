@@ -8,9 +8,14 @@ setup(
     py_modules=['collectFromFile'],
     install_requires=[
         'click',
+        'numpy',
         'scipy',
         'requests',
     ],
+    extras_require={
+        'fast': ['orjson'],
+        'brotli': ['brotli'],
+    },
     entry_points='''
         [console_scripts]
         collectFromFile=collectFromFile:cli
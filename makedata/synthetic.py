@@ -0,0 +1,421 @@
+# use python -m makedata.synthetic --help
+
+"""
+Writes made-up TEA files, in the same layout as the real ones in
+data/from_agency/, for any number of districts:
+
+    data/from_agency/by_region/REGION_XX_DISTRICT_summary_YY.csv
+    data/from_agency/districts/districtYYYY.dat
+
+The counts are random, but loosely shaped like the real data, with
+some groups disciplined more often than others, TEA's masking of
+counts from 1 to 4, and rows that collectFromFile filters out. The
+same seed always writes the same files. district2016.dat is always
+written, because collectFromFile reads each district's charter status
+from it.
+"""
+
+import csv
+import os
+from typing import Dict, Iterable, List, Tuple
+
+import click
+import numpy as np
+
+
+REGIONS = range(1, 21)
+
+REGION_HEADER = ["AGGREGATION LEVEL", "REGION", "DISTNAME", "DISTRICT",
+                 "SECTION", "HEADING", "HEADING NAME"]
+
+DISTRICT_HEADER = ["DISTNAME", "DISTRICT", "DZCNTYNM", "REGION",
+                   "DZRATING", "DZCAMPUS", "DPETALLC", "DPETBLAP",
+                   "DPETHISP", "DPETWHIP", "DPETINDP", "DPETASIP",
+                   "DPETPCIP", "DPETTWOP", "DPETECOP", "DPETLEPP",
+                   "DPETSPEP", "COMMTYPE"]
+
+# The race columns of the district files, with the share of students
+# in a typical district (as Dirichlet weights) and how much more often
+# than average they're disciplined.
+
+RACES = {"BLA": (1.2, 2.0),
+         "HIS": (2.5, 1.1),
+         "WHI": (2.5, 0.8),
+         "IND": (0.1, 1.0),
+         "ASI": (0.3, 0.3),
+         "PCI": (0.05, 1.0),
+         "TWO": (0.3, 1.0)}
+
+# Actions per enrolled student in a typical district, the share of them
+# that are mandatory, and the heading codes and names used for each
+# punishment in the TEA's files.
+
+PUNISHMENTS = {
+    "EXP": {"rate": 0.002, "mandatory": 0.4,
+            "trends": (("B04", "COUNT OF STUDENTS EXPELLED"),
+                       ("B05", "MANDATORY EXPULSIONS"),
+                       ("B06", "DISCRETIONARY EXPULSIONS")),
+            "race_section": "D-EXPULSION ACTIONS", "race_code": 6,
+            "spe": ("I-SPEC. ED. EXPULSIONS",
+                    ("D04", "SPEC. ED. STUDENTS EXPELLED"),
+                    ("D05", "SPEC. ED. EXPULSIONS"),
+                    ("D06", "NON SPEC. ED. EXPULSIONS")),
+            "eco": ("N-ECO. DISADV. EXPULSIONS",
+                    ("E05", "ECO. DISAD. STUDENTS EXPELLED"),
+                    ("E06", "ECO. DISAD. EXPULSIONS"),
+                    ("E07", "NON ECO. DISAD. EXPULSIONS"))},
+    "DAE": {"rate": 0.02, "mandatory": 0.3,
+            "trends": (("B07", "COUNT OF STUDENTS REMOVED TO A DAEP"),
+                       ("B08", "MANDATORY DAEP REMOVALS"),
+                       ("B09", "DISCRETIONARY DAEP REMOVALS")),
+            "race_section": "E-DAEP PLACEMENTS", "race_code": 11,
+            "spe": ("J-SPEC. ED. DAEP PLACEMENTS",
+                    ("D07", "SPEC. ED. STUDENTS IN DAEP PLACEMENT"),
+                    ("D08", "SPEC. ED. DAEP PLACEMENTS"),
+                    ("D09", "NON SPEC. ED. DAEP PLACEMENTS")),
+            "eco": ("O-ECO. DISADV. DAEP PLACEMENTS",
+                    ("E09", "ECO. DISAD. STUDENTS PLACED IN DAEP"),
+                    ("E10", "ECO. DISAD. DAEP PLACEMENTS"),
+                    ("E11", "NON ECO. DISAD. DAEP PLACEMENTS"))},
+    "OSS": {"rate": 0.05, "mandatory": 0.05,
+            "trends": (("B13", "STUDENTS SUSPENDED OUT OF SCHOOL"),
+                       ("B14", "MANDATORY OUT OF SCHOOL SUSPENSIONS"),
+                       ("B15", "DISCRETIONARY OUT OF SCHOOL SUSPENSIONS")),
+            "race_section": "F-OUT OF SCHOOL SUSPENSIONS", "race_code": 16,
+            "spe": ("K-SPEC. ED. OUT OF SCHOOL SUS.",
+                    ("D10", "SPEC. ED. STUDENTS OUT OF SCHOOL SUS."),
+                    ("D11", "SPEC. ED. OUT OF SCHOOL SUSPEN"),
+                    ("D12", "NON SPEC. ED. OUT OF SCHOOL SUSPEN")),
+            "eco": ("P-ECO. DISADV. OUT OF SCHOOL SUS.",
+                    ("E13", "ECO. DISAD. STUDENTS OUT OF SCHOOL SUS"),
+                    ("E14", "ECO. DISAD. OUT OF SCHOOL SUSPEN"),
+                    ("E15", "NON ECO. DISAD. OUT OF SCHOOL SUSPEN"))},
+    "ISS": {"rate": 0.1, "mandatory": 0.02,
+            "trends": (("B10", "COUNT OF STUDENTS SUSPENDED IN SCHOOL"),
+                       ("B11", "MANDATORY IN SCHOOL SUSPENSIONS"),
+                       ("B12", "DISCRETIONARY IN SCHOOL SUSPENSIONS")),
+            "race_section": "G-IN SCHOOL SUSPENSIONS", "race_code": 21,
+            "spe": ("L-SPEC. ED. IN SCHOOL SUS.",
+                    ("D13", "SPEC. ED. STUDENTS IN SCHOOL SUSPEN"),
+                    ("D14", "SPEC. ED. IN SCHOOL SUSPEN"),
+                    ("D15", "NON SPEC. ED. IN SCHOOL SUSPEN")),
+            "eco": ("Q-ECO. DISADV. IN SCHOOL SUS.",
+                    ("E17", "ECO DISAD. STUDENTS SUSPEN IN SCHOOL"),
+                    ("E18", "ECO DISAD. IN SCHOOL SUSPENSIONS"),
+                    ("E19", "NON ECO DISAD. IN SCHOOL SUSPENSIONS"))},
+}
+
+# The races with their own headings in the discipline files, in the
+# order of their codes within each punishment's section.
+
+RACE_HEADINGS = (("BLA", "AFRICAN AMERICAN"),
+                 ("ASI", "ASIAN"),
+                 ("HIS", "HISPANIC"),
+                 ("IND", "NATIVE AMERICAN"),
+                 ("WHI", "WHITE"))
+
+COMMUNITY_TYPES = ("Major Urban", "Major Suburban", "Other Central City",
+                   "Independent Town", "Non-metropolitan Stable", "Rural")
+
+# Counts from 1 to 4 in the tables by group are hidden by the TEA.
+
+MASKED = -99999999
+
+
+class SyntheticDistricts:
+
+    """
+    The districts that stay the same from year to year: their IDs,
+    regions, charter status, and a typical enrollment, demographic mix
+    and discipline rate, which each year varies a little."""
+
+    def __init__(self, count: int, seed: int = 0) -> None:
+        rng = np.random.RandomState(seed)
+        # TEA's six-digit IDs, or nine digits like campus IDs when
+        # there are too many districts for six.
+        digits = 6 if count < 100000 else 9
+        self.digits = digits
+        self.ids = np.sort(sample_without_replacement(
+            rng, 10 ** digits - 1001, count)) + 1001
+        self.regions = rng.choice(np.array(REGIONS), size=count)
+        self.charter = rng.random_sample(count) < 0.15
+        self.enrollment = np.maximum(
+            rng.lognormal(7.2, 1.4, size=count), 20).astype(np.int64)
+        self.race_shares = rng.dirichlet(
+            [weight for weight, _ in RACES.values()], size=count)
+        self.eco_share = rng.uniform(0.05, 0.95, size=count)
+        self.spe_share = np.clip(rng.normal(0.09, 0.03, size=count),
+                                 0.01, 0.3)
+        self.strictness = rng.lognormal(0, 0.5, size=count)
+        self.community = rng.choice(len(COMMUNITY_TYPES), size=count)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def district_id(self, i: int) -> str:
+        return str(self.ids[i]).zfill(self.digits)
+
+    def name(self, i: int) -> str:
+        kind = "CHARTER SCHOOL" if self.charter[i] else "ISD"
+        return f"SYNTHETIC {kind} {self.district_id(i)}"
+
+
+def sample_without_replacement(rng: np.random.RandomState, high: int,
+                               count: int) -> np.ndarray:
+
+    """
+    count different integers from 0 to high - 1. Unlike
+    rng.choice(high, count, replace=False), this doesn't shuffle all of
+    range(high), which is too big for nine-digit IDs."""
+
+    if count > high:
+        raise ValueError(f"Can't choose {count} different numbers "
+                         f"below {high}.")
+    found = np.array([], dtype=np.int64)
+    while len(found) < count:
+        found = np.unique(np.concatenate([
+            found, rng.randint(0, high, size=count - len(found) + 10,
+                               dtype=np.int64)]))
+    return rng.choice(found, size=count, replace=False)
+
+
+def multinomial_rows(rng: np.random.RandomState, totals: np.ndarray,
+                     weights: np.ndarray) -> np.ndarray:
+
+    """
+    A multinomial draw of totals[i] into the categories weighted by
+    each row of weights, one binomial per category, since
+    RandomState.multinomial only takes one total and one set of
+    weights."""
+
+    counts = np.zeros(weights.shape, dtype=np.int64)
+    remaining = np.asarray(totals, dtype=np.int64).copy()
+    rest = weights.sum(axis=1)
+    for i in range(weights.shape[1] - 1):
+        p = np.divide(weights[:, i], rest, out=np.zeros(len(rest)),
+                      where=rest > 0)
+        counts[:, i] = rng.binomial(remaining, np.clip(p, 0, 1))
+        remaining -= counts[:, i]
+        rest = rest - weights[:, i]
+    counts[:, -1] = remaining
+    return counts
+
+
+def get_year_rng(seed: int, year: int) -> np.random.RandomState:
+    return np.random.RandomState([seed, year])
+
+
+def make_year_of_districts(districts: SyntheticDistricts, year: int,
+                           seed: int = 0) -> Dict[str, np.ndarray]:
+
+    """
+    One year's enrollment and demographic percentages, as the columns
+    of a district file."""
+
+    rng = get_year_rng(seed, year)
+    n = len(districts)
+    columns = {"DPETALLC": np.maximum(
+        districts.enrollment * rng.normal(1, 0.03, size=n), 1
+        ).astype(np.int64)}
+    shares = districts.race_shares * rng.normal(1, 0.02, size=(n, 1))
+    shares = shares / shares.sum(axis=1, keepdims=True)
+    for i, race in enumerate(RACES):
+        columns[f"DPET{race}P"] = np.round(shares[:, i] * 100, 1)
+    columns["DPETECOP"] = np.round(districts.eco_share * 100, 1)
+    columns["DPETSPEP"] = np.round(districts.spe_share * 100, 1)
+    columns["DPETLEPP"] = np.round(rng.uniform(0, 40, size=n), 1)
+    return columns
+
+
+def make_year_counts(districts: SyntheticDistricts,
+                     year_of_districts: Dict[str, np.ndarray],
+                     year: int,
+                     seed: int = 0) -> List[Tuple[str, str, str, np.ndarray]]:
+
+    """
+    The (section, heading, heading name, counts by district) of every
+    row in a year's discipline files, in the order the TEA lists them."""
+
+    rng = get_year_rng(seed + 1, year)
+    n = len(districts)
+    enrollment = year_of_districts["DPETALLC"]
+    race_shares = np.stack([year_of_districts[f"DPET{race}P"] / 100
+                            for race in RACES], axis=1)
+    spe = year_of_districts["DPETSPEP"] / 100
+    eco = year_of_districts["DPETECOP"] / 100
+
+    actions = {p: rng.poisson(enrollment * punishment["rate"]
+                              * districts.strictness)
+               for p, punishment in PUNISHMENTS.items()}
+    all_actions = sum(actions.values())
+    rows = [("A-PARTICIPATION", "A01",
+             "DISTRICT CUMULATIVE YEAR END ENROLLMENT", enrollment),
+            ("A-PARTICIPATION", "A02", "DISTRICT DISCIPLINE POPULATION",
+             rng.binomial(all_actions, 0.6)),
+            ("A-PARTICIPATION", "A03", "DISTRICT DISCIPLINE RECORD COUNT",
+             all_actions)]
+
+    for p in ("EXP", "DAE", "ISS", "OSS"):
+        punishment = PUNISHMENTS[p]
+        total = actions[p]
+        mandatory = rng.binomial(total, punishment["mandatory"])
+        (students_code, students_name), mandatory_heading, \
+            discretionary_heading = punishment["trends"]
+        rows += [("B-DISCIPLINE DATA TRENDS", students_code, students_name,
+                  rng.binomial(total, 0.7)),
+                 ("B-DISCIPLINE DATA TRENDS", *mandatory_heading, mandatory),
+                 ("B-DISCIPLINE DATA TRENDS", *discretionary_heading,
+                  total - mandatory)]
+
+    for p in ("EXP", "DAE", "OSS", "ISS"):
+        punishment = PUNISHMENTS[p]
+        total = actions[p]
+        weights = race_shares * np.array(
+            [disparity for _, disparity in RACES.values()])
+        weights = weights / weights.sum(axis=1, keepdims=True)
+        by_race = dict(zip(RACES, multinomial_rows(rng, total, weights).T))
+        for i, (race, name) in enumerate(RACE_HEADINGS):
+            rows.append((punishment["race_section"],
+                         f"C{punishment['race_code'] + i:02}", name,
+                         by_race[race]))
+
+    for group, share, disparity in (("spe", spe, 1.8), ("eco", eco, 1.3)):
+        for p in ("EXP", "DAE", "OSS", "ISS"):
+            total = actions[p]
+            section, students, in_group, not_in_group = \
+                PUNISHMENTS[p][group]
+            member = rng.binomial(total, np.minimum(share * disparity, 1))
+            rows += [(section, *students, rng.binomial(member, 0.7)),
+                     (section, *in_group, member),
+                     (section, *not_in_group, total - member)]
+
+    # Rows that collectFromFile drops.
+    rows += [("U-AT RISK OUT OF SCHOOL SUS.", "F14",
+              "AT RISK OUT OF SCHOOL SUSPEN",
+              rng.binomial(actions["OSS"], 0.5)),
+             ("W-REASON INCIDENT COUNTS", "G21",
+              "21-VIOLATED LOCAL CODE OF CONDUCT",
+              rng.binomial(all_actions, 0.6)),
+             ("W-REASON INCIDENT COUNTS", "G41", "41-FIGHTING/MUTUAL COMBAT",
+              rng.binomial(all_actions, 0.1)),
+             ("X-DISCIPLINE ACTION COUNTS", "H05",
+              "05-OUT-OF-SCHOOL SUSPENSION", actions["OSS"]),
+             ("X-DISCIPLINE ACTION COUNTS", "H06", "06-IN-SCHOOL SUSPENSION",
+              actions["ISS"])]
+    return rows
+
+
+def get_from_agency_path(root: str, *parts: str) -> str:
+    return os.path.join(root, 'data', 'from_agency', *parts)
+
+
+def write_region_files(root: str, year: int,
+                       districts: SyntheticDistricts,
+                       rows: List[Tuple[str, str, str, np.ndarray]]) -> int:
+
+    """
+    Writes the year's discipline rows for each region, returning the
+    number of rows written. Like the TEA's files, a district has no
+    row for a heading with a count of 0."""
+
+    yy = str(year)[-2:]
+    folder = get_from_agency_path(root, 'by_region')
+    os.makedirs(folder, exist_ok=True)
+    counts = np.stack([row[3] for row in rows], axis=1)
+    # The participation and trend rows aren't masked.
+    masked = np.array([section[0] not in "AB" for section, *_ in rows])
+    written = 0
+    for region in REGIONS:
+        r = str(region).zfill(2)
+        path = os.path.join(folder, f'REGION_{r}_DISTRICT_summary_{yy}.csv')
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f, quoting=csv.QUOTE_ALL)
+            writer.writerow(REGION_HEADER + [f"YR{yy}"])
+            for i in np.flatnonzero(districts.regions == region):
+                district = districts.district_id(i)
+                name = districts.name(i)
+                for (section, code, heading_name, _), count, mask in zip(
+                        rows, counts[i].tolist(), masked):
+                    if count == 0 and code != "A01":
+                        continue
+                    if mask and count < 5:
+                        count = MASKED
+                    writer.writerow(["DISTRICT SUMMARY", r, name, district,
+                                     section, code, heading_name, count])
+                    written += 1
+    return written
+
+
+def write_district_file(root: str, year: int,
+                        districts: SyntheticDistricts,
+                        year_of_districts: Dict[str, np.ndarray]) -> None:
+    folder = get_from_agency_path(root, 'districts')
+    os.makedirs(folder, exist_ok=True)
+    with open(os.path.join(folder, f'district{year}.dat'), 'w',
+              newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(DISTRICT_HEADER)
+        for i in range(len(districts)):
+            district = districts.district_id(i)
+            region = str(districts.regions[i]).zfill(2)
+            row = {"DISTNAME": districts.name(i),
+                   "DISTRICT": district,
+                   "DZCNTYNM": f"{district[:3]} SYNTHETIC",
+                   "REGION": region,
+                   "DZRATING": "Met Standard",
+                   "DZCAMPUS": 1 + districts.enrollment[i] // 600,
+                   "COMMTYPE": "Charters" if districts.charter[i] else
+                   COMMUNITY_TYPES[districts.community[i]]}
+            for column, values in year_of_districts.items():
+                row[column] = values[i]
+            writer.writerow([row[column] for column in DISTRICT_HEADER])
+    return None
+
+
+def generate(root: str, count: int, years: Iterable[int],
+             seed: int = 0) -> Dict[int, int]:
+
+    """
+    Writes the TEA files for count districts and each of the years under
+    root, returning the number of discipline rows written for each
+    year."""
+
+    years = set(years)
+    districts = SyntheticDistricts(count, seed)
+    written = {}
+    for year in sorted(years | {2016}):
+        year_of_districts = make_year_of_districts(districts, year, seed)
+        write_district_file(root, year, districts, year_of_districts)
+        if year in years:
+            written[year] = write_region_files(
+                root, year, districts,
+                make_year_counts(districts, year_of_districts, year, seed))
+    return written
+
+
+@click.command()
+@click.argument('root', type=click.Path(file_okay=False))
+@click.option('--districts', '-n', type=click.IntRange(1, None),
+              default=1200, help="The number of districts to make up. "
+              "Texas has about 1,200 districts and 9,000 campuses.")
+@click.option('--first-year', '-f', type=click.IntRange(2006, 2050),
+              default=2009)
+@click.option('--last-year', '-l', type=click.IntRange(2006, 2050),
+              default=2009)
+@click.option('--seed', type=int, default=0)
+def cli(root: str, districts: int, first_year: int, last_year: int,
+        seed: int) -> None:
+
+    """
+    Writes synthetic TEA files to ROOT/data/from_agency/. To process
+    them, copy or link the makedata folder into ROOT and run
+    collectFromFile from there."""
+
+    years = list(range(first_year, last_year + 1))
+    for year, rows in generate(root, districts, years, seed).items():
+        click.echo(f"{year}: {districts:,} districts, {rows:,} rows")
+    return None
+
+
+if __name__ == "__main__":
+    cli()
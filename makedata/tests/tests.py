@@ -1,9 +1,25 @@
 # use pytest tests/tests.py
 
 import pytest
+import gzip
+import http.client
+import importlib.util
+import json
 import os
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.error import HTTPError
+from urllib.parse import parse_qs
+from urllib.request import urlopen
+
+from click.testing import CliRunner
 
 from makedata import collectFromFile
+from makedata import query_server
 
 @pytest.fixture()
 def load_year_for_testing():
@@ -47,11 +63,64 @@ def dump_dict_to_dir(load_dict_with_year, tmpdir, monkeypatch):
 
     return _test_helper
 
+@pytest.fixture()
+def fake_project_dir(tmpdir, monkeypatch):
+
+    # Makes collectFromFile read and write its data folder in tmpdir.
+
+    monkeypatch.setattr(collectFromFile, "__file__",
+                        str(tmpdir.join("makedata", "fake_src.py")))
+    return tmpdir
+
+@pytest.fixture()
+def stub_TEA_server():
+
+    # Answers like the TEA's server, except for region 02, which gets
+    # an error page.
+
+    requests_seen = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            length = int(self.headers["Content-Length"])
+            form = parse_qs(self.rfile.read(length).decode())
+            requests_seen.append(form)
+            if form.get("region") == ["02"]:
+                body = b"<html>Service unavailable</html>"
+            else:
+                body = b'"DISTRICT","SECTION"\n"031901","A"\n'
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}/", requests_seen
+    server.shutdown()
+    server.server_close()
+
 def test_load_one_year():
     assert load_year_for_testing()[0][0] == 'DISTRICT'
     assert int(load_year_for_testing()[1][0]) == 31901
     assert len(load_year_for_testing()) == 73692
 
+def test_stream_one_year():
+    rows = collectFromFile.iter_year(2009)
+    assert next(rows)[0] == 'DISTRICT'
+    assert int(next(rows)[0]) == 31901
+    assert sum(1 for row in rows) == 73690
+
+def test_stream_cleaned_records(load_year_list):
+    records = collectFromFile.iter_year_of_records(2009)
+    assert next(records) == load_year_list[0]
+    assert list(records) == load_year_list[1:]
+    assert max(len(row[1]) for row in load_year_list[1:]) == 3
+
 SHORT_DATA = [["DISTRICT","SECTION","HEADING","HEADING NAME","YR08"],
             ["184907","G-IN SCHOOL SUSPENSIONS","C24","NATIVE AMERICAN","14"],
             ["184907","G-IN SCHOOL SUSPENSIONS","C25","WHITE","509"],
@@ -100,6 +169,89 @@ def test_replace_category_names_for_one_year():
     a = collectFromFile.replace_category_names(a,3,1)
     assert max(len(row[1]) for row in a[1:]) == 3
 
+def test_classify_headings():
+    assert collectFromFile.classify_headings(
+        "B05", "MANDATORY EXPULSIONS", "B-DISCIPLINE DATA TRENDS") == (
+            "MAN", "EXP")
+    assert collectFromFile.classify_headings(
+        "C25", "WHITE", "G-IN SCHOOL SUSPENSIONS") == ("WHI", "ISS")
+    assert collectFromFile.classify_headings(
+        "D04", "SPEC. ED. STUDENTS EXPELLED",
+        "I-SPEC. ED. EXPULSIONS") is None
+
+def test_filter_records_keeps_same_rows_as_column_filters():
+    a = collectFromFile.mandatory_and_discretionary(
+        collectFromFile.get_year(2009), 2, 3, 1)
+    b = [row[:] for row in a]
+    a = collectFromFile.filter_records(a, 3, 1)
+    b = collectFromFile.filter_year_by_column(
+        b, 3, collectFromFile.HEADING_NAME_IN, keep_matches=True)
+    b = collectFromFile.filter_year_by_column(
+        b, 3, collectFromFile.HEADING_NAME_OUT)
+    b = collectFromFile.filter_year_by_column(
+        b, 1, collectFromFile.SECTION_OUT)
+    assert a == b
+
+@pytest.fixture()
+def file_cache_dir(tmpdir, monkeypatch):
+    cache_dir = tmpdir.mkdir('cache')
+    monkeypatch.setattr(collectFromFile, "FILE_CACHE_ENABLED", True)
+    monkeypatch.setattr(collectFromFile, "get_cache_path",
+                        lambda filename: str(cache_dir.join(filename)))
+    return cache_dir
+
+def test_cached_stream_rebuilds_when_source_changes(file_cache_dir, tmpdir):
+    source = tmpdir.join("source.csv")
+    source.write("a,b\n")
+    builds = []
+    def build():
+        builds.append(source.read())
+        return iter(source.read().splitlines())
+    for _ in range(2):
+        assert list(collectFromFile.cached_stream(
+            "test.pickle", [str(source)], build)) == ["a,b"]
+    assert len(builds) == 1
+    source.write("a,b\nc,d\n")
+    assert list(collectFromFile.cached_stream(
+        "test.pickle", [str(source)], build)) == ["a,b", "c,d"]
+    assert len(builds) == 2
+
+def test_cached_stream_rebuilds_unreadable_cache(file_cache_dir, tmpdir):
+    source = tmpdir.join("source.csv")
+    source.write("a,b\n")
+    items = list(range(5000))
+    builds = []
+    def build():
+        builds.append(1)
+        return iter(items)
+    cache = file_cache_dir.join("test.pickle")
+    assert list(collectFromFile.cached_stream(
+        "test.pickle", [str(source)], build)) == items
+    whole = cache.read_binary()
+    for cut in (1, 20, len(whole) // 2):
+        cache.write_binary(whole[:-cut])
+        assert list(collectFromFile.cached_stream(
+            "test.pickle", [str(source)], build)) == items
+        assert cache.read_binary() == whole
+    assert len(builds) == 4
+
+def test_cached_year_of_records(file_cache_dir, load_year_list):
+    assert collectFromFile.make_year_of_records(2009) == load_year_list
+    assert file_cache_dir.join("records2009.pickle").exists()
+    assert collectFromFile.make_year_of_records(2009) == load_year_list
+    assert 14803 in collectFromFile.get_charters()
+    assert collectFromFile.get_charters() == collectFromFile.read_charters()
+    assert collectFromFile.get_demo_year(2009)["BLA"][5902] == 1
+    assert file_cache_dir.join("districts2009.pickle").exists()
+
+def test_district_index_cache_holds_plain_data(file_cache_dir):
+    index = collectFromFile.get_district_index(2009)
+    cache = file_cache_dir.join("districts2009.pickle").read_binary()
+    assert b"collectFromFile" not in cache
+    cached = collectFromFile.get_district_index(2009)
+    assert cached.get(5902) == index.get(5902)
+    assert cached.demo_dict() == collectFromFile.read_demo_year(2009)
+
 def test_get_demo_year():
     assert collectFromFile.get_demo_year(2009)["BLA"][5902] == 1
     assert collectFromFile.get_demo_year(2009)["WHI"][5902] == 93
@@ -107,6 +259,56 @@ def test_get_demo_year():
 def test_get_charters():
     assert 14803 in collectFromFile.get_charters()
 
+def test_district_index_reads_needed_columns():
+    index = collectFromFile.read_district_index(2009)
+    assert index.charter is None
+    assert index.percents["ASI"] is None
+    assert index.get(5902)["percents"]["WHI"] == 93
+    assert index.get(1902)["region"] == 7
+    assert index.get(1902)["county"] == "001 ANDERSON"
+    assert index.get(999999) is None
+    assert index.demo_dict() == collectFromFile.read_demo_year(2009)
+
+def test_district_index_skips_blank_and_short_lines(tmpdir):
+    path = tmpdir.join("district2015.dat")
+    path.write("DISTRICT,REGION,DPETBLAP,COMMTYPE\n"
+               "101902,04,20.5,Charters\n"
+               "\n"
+               "014803,12\n"
+               "014804,12,3,Rural\n"
+               "\n")
+    index = collectFromFile.DistrictIndex.from_file(2015, str(path))
+    assert index.districts.tolist() == [14804, 101902]
+    assert index.charters() == {101902}
+    assert index.get(14804)["percents"] == {"BLA": 3}
+    path.write("DISTRICT\n101902\n\n014803\n")
+    index = collectFromFile.DistrictIndex.from_file(2015, str(path))
+    assert index.districts.tolist() == [14803, 101902]
+    assert index.charter is None
+    path.write("")
+    index = collectFromFile.DistrictIndex.from_file(2015, str(path))
+    assert len(index) == 0 and index.get(101902) is None
+
+def test_charters_for_each_year(fake_project_dir):
+    districts = fake_project_dir.ensure('data', 'from_agency', 'districts',
+                                        dir=True)
+    for year, commtypes in ((2015, ("Charters", "Rural")),
+                            (2016, ("Rural", "Charters"))):
+        districts.join(f'district{year}.dat').write(
+            "DISTRICT,REGION,DZCNTYNM,DPETBLAP,COMMTYPE\n"
+            f"101902,04,\"101 HARRIS, TX\",20.5,{commtypes[0]}\n"
+            f"014803,12,014 BELL,3,{commtypes[1]}\n\n")
+    districts.join('district2014.dat').write(
+        "DISTRICT,REGION,DPETBLAP\n101902,04,20\n014803,12,3\n")
+    assert collectFromFile.get_charters(2015) == {101902}
+    assert collectFromFile.get_charters(2016) == {14803}
+    assert collectFromFile.get_charters(2014) == {14803}
+    assert collectFromFile.get_district_index(2015).get(101902)[
+        "county"] == "101 HARRIS, TX"
+    fallback = str(districts.join('district2016.dat'))
+    assert fallback not in collectFromFile.get_year_source_paths(2015)
+    assert fallback in collectFromFile.get_year_source_paths(2014)
+
 def test_impossible_statistics():
     assert not collectFromFile.impossible(8, 2, 10, 100)
     assert collectFromFile.impossible(8, 20, 0, 100)
@@ -175,6 +377,47 @@ def test_percentage_scaling_calculation():
 
     assert collectFromFile.binomial_scale(800, 10000, 10000, 100000) == 4
 
+def test_binomial_scale_array_matches_binomial_scale():
+    cases = [(0, 50, 30, 100), (3, 50, 30, 100), (15, 50, 30, 100),
+             (40, 50, 30, 100), (1300, 10000, 10000, 100000),
+             (800, 10000, 10000, 100000), (8, 20, 0, 100), (0, 0, 0, 100),
+             (20, 12, 5, 100), (0, 7, 0, 100), (1, 0, 3, 443)]
+    scores = collectFromFile.binomial_scale_array(*zip(*cases))
+    assert list(scores) == [collectFromFile.binomial_scale(*case)
+                            for case in cases]
+
+def test_binomial_scale_array_empty_slice():
+    assert len(collectFromFile.binomial_scale_array([], [], [], [])) == 0
+
+def test_pvalue_cache_evicts_least_recently_used():
+    cache = collectFromFile.PValueCache(max_size=2)
+    cache.put((1, 2, 3, 4, "less"), .5)
+    cache.put((2, 2, 3, 4, "less"), .25)
+    assert cache.get((1, 2, 3, 4, "less")) == .5
+    cache.put((3, 3, 3, 4, "greater"), .125)
+    assert cache.get((2, 2, 3, 4, "less")) is None
+    assert len(cache) == 2
+    assert (cache.hits, cache.misses) == (1, 1)
+
+def test_pvalue_cache_saved_between_runs(tmpdir):
+    path = str(tmpdir.join("cache", "pvalues.pickle"))
+    cache = collectFromFile.PValueCache()
+    cache.put((3, 50, 30, 100, "less"), .001)
+    cache.save(path)
+    reloaded = collectFromFile.PValueCache()
+    reloaded.load(path)
+    assert reloaded.get((3, 50, 30, 100, "less")) == .001
+    assert "1 hits, 0 misses" in reloaded.report()
+
+def test_binomial_scale_uses_pvalue_cache(monkeypatch):
+    cache = collectFromFile.PValueCache()
+    monkeypatch.setattr(collectFromFile, "PVALUE_CACHE", cache)
+    first = collectFromFile.binomial_scale_array([3, 3], [50, 50],
+                                                 [30, 30], [100, 100])
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert collectFromFile.binomial_scale(3, 50, 30, 100) == first[0] == 2
+    assert cache.hits == 2
+
 def test_add_scale_variable_to_dict(load_dict_with_year):
     year = 2009
     assert load_dict_with_year[year]["BLA"]["OSS"][101902]["S"] == 8
@@ -194,6 +437,124 @@ def test_unavailable_scale_variable_omitted(load_dict_with_year):
     assert "C" in load_dict_with_year[year]["ASI"]["ISS"][31901]
     assert "S" not in load_dict_with_year[year]["ASI"]["ISS"][31901]
 
+def test_worker_processes_match_serial_build(load_dict_with_year):
+    d = collectFromFile.TEA_to_dict(2009, 2009, workers=2)
+    assert d == {2009: load_dict_with_year[2009]}
+
+def test_worker_processes_reuse_loaded_pvalues(monkeypatch):
+    cache = collectFromFile.PValueCache()
+    monkeypatch.setattr(collectFromFile, "PVALUE_CACHE", cache)
+    collectFromFile.TEA_to_dict(2009, 2009)
+    stored = len(cache)
+    cache.hits = cache.misses = 0
+    collectFromFile.TEA_to_dict(2009, 2009, workers=2)
+    assert cache.misses == 0
+    assert cache.hits > 0
+    assert len(cache) == stored
+
+def test_pvalue_cache_take_sends_only_new_entries():
+    cache = collectFromFile.PValueCache()
+    cache.put((1, 2, 3, 4, "less"), .5)
+    cache.track_added()
+    cache.get((1, 2, 3, 4, "less"))
+    cache.put((2, 2, 3, 4, "less"), .25)
+    taken = cache.take()
+    assert dict(taken.entries) == {(2, 2, 3, 4, "less"): .25}
+    assert (taken.hits, taken.misses) == (1, 0)
+    assert len(cache.take()) == 0
+
+def test_variant_dicts_match_separate_builds(load_dict_with_year):
+    dicts = collectFromFile.TEA_to_variant_dicts(2009, 2009)
+    assert set(dicts) == {"", "WithCharters", "ChartersOnly"}
+    assert dicts[""] == {2009: load_dict_with_year[2009]}
+    for variant in ("WithCharters", "ChartersOnly"):
+        assert dicts[variant] == collectFromFile.add_year_to_dict(
+            2009, collectFromFile.make_empty_dict(2009, 2009),
+            *collectFromFile.CHARTER_VARIANTS[variant])
+
+def test_stage_metrics_measure_each_step(load_dict_with_year, monkeypatch):
+    metrics = collectFromFile.StageMetrics(enabled=True, profile_scoring=True)
+    monkeypatch.setattr(collectFromFile, "METRICS", metrics)
+    d = collectFromFile.add_year_to_dict(
+        2009, collectFromFile.make_empty_dict(2009, 2009),
+        show_progress=False)
+    assert d == {2009: load_dict_with_year[2009]}
+    stages = {stage["stage"]: stage for stage in metrics.summary()}
+    assert stages["add_year_to_dict"]["depth"] == 0
+    assert stages["add_scale_statistic"]["depth"] == 1
+    assert stages["add_scale_statistic"]["year"] == 2009
+    assert stages["read records"]["counts"]["records"] > 0
+    assert stages["add_scale_statistic"]["counts"]["scores"] > 0
+    assert "binomial_scale_array" in metrics.scoring_profile()
+    assert json.loads(json.dumps(metrics.to_json()))["stages"]
+
+def test_year_table_round_trip(load_dict_with_year):
+    table = collectFromFile.YearTable.from_year_dict(
+        2009, load_dict_with_year[2009])
+    assert table.columns["ALL"]["POP"].total == 5068223
+    assert table.to_year_dict() == load_dict_with_year[2009]
+
+def test_year_table_add_zeros():
+    table = collectFromFile.YearTable.from_counts(2009, {
+        ("BLA", "ISS"): {1: 5},
+        ("HIS", "OSS"): {2: 3},
+        ("ASI", "EXP"): {},
+        ("ALL", "POP"): {1: 100, 2: 200, 3: 300}})
+    table.add_zeros()
+    d = table.to_year_dict()
+    assert d["ASI"]["EXP"] == {1: {"C": 0}, 2: {"C": 0}}
+    assert d["BLA"]["ISS"] == {1: {"C": 5}, 2: {"C": 0}}
+    assert 3 in d["ALL"]["POP"]
+
+def test_year_table_add_aggregates():
+    table = collectFromFile.YearTable.from_counts(2009, {
+        ("BLA", "DAE"): {1: 4, 2: 1},
+        ("SPE", "DAE"): {1: 3},
+        ("NON", "DAE"): {1: 5},
+        ("MAN", "DAE"): {1: 2, 2: 6},
+        ("ALL", "POP"): {1: 100, 2: 200, 3: 300}})
+    table.add_aggregates({"BLA": {1: 25.0, 3: 10.0, 4: 50.0},
+                          "ASI": {}})
+    d = table.to_year_dict()
+    assert "NON" not in d and "MAN" not in d
+    assert d["ALL"]["DAE"] == {1: {"C": 8}, 2: {"C": 6}, 0: {"C": 14}}
+    assert d["ALL"]["ISS"] == {0: {"C": 0}}
+    assert d["BLA"]["POP"] == {1: {"C": 25}, 3: {"C": 30}, 0: {"C": 55}}
+    assert d["ASI"]["POP"] == {0: {"C": 0}}
+
+def test_aggregates_from_district_index(load_dict_with_year):
+    d = collectFromFile.make_empty_dict(2009, 2009)
+    year_of_records = collectFromFile.make_year_of_records(2009)
+    d = collectFromFile.add_records_to_dict(
+        2009, d, year_of_records, collectFromFile.get_charters(2009))
+    by_dict = collectFromFile.add_aggregates_to_dict(
+        2009, {2009: d[2009]}, collectFromFile.get_demo_year(2009))
+    by_index = collectFromFile.add_aggregates_to_dict(2009, d)
+    assert by_index == by_dict
+    assert by_index[2009]["BLA"]["POP"][61906]["C"] == \
+        load_dict_with_year[2009]["BLA"]["POP"][61906]["C"]
+
+def test_dataset_scores_only_what_is_looked_up(load_dict_with_year):
+    d = collectFromFile.TEA_to_dataset(2009, 2009)
+    assert list(d) == [2009]
+    assert d[2009]["BLA"]["OSS"][101902] == {"C": 9333, "S": 8}
+    table = d[2009].table
+    assert not table.columns["HIS"]["DAE"].has_scale.any()
+    assert "NON" not in d[2009]
+    assert d[2009]["ALL"]["EXP"] == load_dict_with_year[2009]["ALL"]["EXP"]
+    assert d.to_dict() == {2009: load_dict_with_year[2009]}
+    assert d[2009].table is table
+
+def test_district_ids_positions():
+    ids = collectFromFile.DistrictIds([101902, 3903, 14803, 3903])
+    assert len(ids) == 3
+    assert ids.positions([14803, 3903]).tolist() == [1, 0]
+    where, found = ids.find([101902, 5, 999999])
+    assert found.tolist() == [True, False, False]
+    assert where[0] == 2
+    with pytest.raises(KeyError):
+        ids.positions([3903, 5])
+
 def test_make_csv_row_demo(load_dict_with_year):
     assert collectFromFile.make_csv_row_demo(load_dict_with_year,
         2009, "BLA", "OSS", 101902) == [
@@ -237,6 +598,322 @@ def test_json_dump_with_charters(dump_dict_to_dir):
     assert os.path.exists(os.path.join(d, 'data', 'processed',
                                        'stppWithCharters2010-2012.json'))
 
+def test_build_manifest_finds_changed_years(fake_project_dir, monkeypatch):
+    sources = {year: fake_project_dir.join(f"source{year}.csv")
+               for year in (2009, 2010)}
+    for source in sources.values():
+        source.write("1,2,3\n")
+    monkeypatch.setattr(collectFromFile, "get_year_source_paths",
+                        lambda year: [str(sources[year])])
+    outputs = {year: fake_project_dir.mkdir(str(year)).join("OSS.json")
+               for year in (2009, 2010)}
+    manifest = collectFromFile.BuildManifest()
+    for year, output in outputs.items():
+        output.write("{}")
+        manifest.record(year, "nested_json", [str(output)])
+    path = str(fake_project_dir.join("data", "cache", "manifest.json"))
+    manifest.save(path)
+
+    manifest = collectFromFile.BuildManifest()
+    manifest.load(path)
+    assert collectFromFile.find_stale_years(
+        manifest, 2009, 2010, ["nested_json"]) == []
+    assert collectFromFile.find_stale_years(
+        manifest, 2009, 2010, ["nested_jsonWithCharters"]) == [2009, 2010]
+    assert collectFromFile.find_stale_years(
+        manifest, 2009, 2010, [collectFromFile.get_output_key(
+            "nested_json", "", ["gz"])]) == [2009, 2010]
+    sources[2010].write("1,2,4\n")
+    outputs[2009].remove()
+    assert collectFromFile.find_stale_years(
+        manifest, 2009, 2010, ["nested_json"]) == [2009, 2010]
+
+def test_no_cache_run_writes_no_manifest(fake_project_dir, monkeypatch):
+    from makedata import synthetic
+    for name in ("FILE_CACHE_ENABLED", "JSON_BACKEND", "METRICS"):
+        monkeypatch.setattr(collectFromFile, name,
+                            getattr(collectFromFile, name))
+    synthetic.generate(str(fake_project_dir), 60, [2009])
+    manifest = fake_project_dir.join("data", "cache", "manifest.json")
+    args = ["--json-folders", "-f", "2009", "-l", "2009", "--no-cache"]
+    result = CliRunner().invoke(collectFromFile.cli, args)
+    assert result.exit_code == 0, result.output
+    assert fake_project_dir.join("data", "2009", "BLA", "OSS.json").exists()
+    assert not manifest.exists()
+    result = CliRunner().invoke(collectFromFile.cli, args + ["--incremental"])
+    assert result.exit_code == 0, result.output
+    assert manifest.exists()
+
+def test_download_files_skips_complete_files(stub_TEA_server,
+                                             fake_project_dir):
+    url, requests_seen = stub_TEA_server
+    downloads = collectFromFile.get_region_downloads(2009, 2009, url)
+    failed = collectFromFile.download_files(downloads, workers=4,
+                                            requests_per_second=0)
+    region_dir = fake_project_dir.join("data", "from_agency", "by_region")
+    assert failed == [str(region_dir.join(
+        "REGION_02_DISTRICT_summary_09.csv"))]
+    assert len(region_dir.listdir()) == 19
+    assert not any(path.ext == ".tmp" for path in region_dir.listdir())
+    assert region_dir.join("REGION_01_DISTRICT_summary_09.csv").read(
+        ).startswith('"DISTRICT"')
+
+    # Running again resumes, trying only the file that failed.
+
+    del requests_seen[:]
+    assert collectFromFile.download_files(
+        downloads, requests_per_second=0) == failed
+    assert [form["region"] for form in requests_seen] == [["02"]] * 3
+
+def test_rate_limiter_spaces_out_each_thread():
+    limiter = collectFromFile.RateLimiter(5)
+    def make_requests():
+        for _ in range(3):
+            limiter.wait()
+    threads = [threading.Thread(target=make_requests) for _ in range(2)]
+    start = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # Three requests on each thread, 0.2 seconds apart, side by side.
+    assert 0.35 < time.monotonic() - start < 0.8
+
+def test_negative_download_rate_is_rejected():
+    result = CliRunner().invoke(collectFromFile.cli, [
+        "--download", "--skip-processing", "--download-rate", "-1"])
+    assert result.exit_code == 2
+    assert "can't be negative" in result.output
+
+def test_import_leaves_out_scoring_and_downloading():
+    project_dir = os.path.dirname(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))))
+    imported = subprocess.run(
+        [sys.executable, "-c", "import sys; "
+         "from makedata import collectFromFile; "
+         "print([name for name in ('numpy', 'scipy', 'requests') "
+         "if name in sys.modules])"],
+        cwd=project_dir, stdout=subprocess.PIPE, check=True).stdout
+    assert imported.decode().strip() == "[]"
+
+def test_nested_json_skips_unchanged_files(load_dict_with_year,
+                                           fake_project_dir):
+    written = collectFromFile.dict_to_nested_json(load_dict_with_year,
+                                                  2009, 2009)
+    path = fake_project_dir.join("data", "2009", "BLA", "OSS.json")
+    assert str(path) in written[2009]
+    os.utime(str(path), (0, 0))
+    collectFromFile.dict_to_nested_json(load_dict_with_year, 2009, 2009)
+    assert path.mtime() == 0
+    load_dict_with_year[2009]["BLA"]["OSS"][101902]["C"] += 1
+    collectFromFile.dict_to_nested_json(load_dict_with_year, 2009, 2009)
+    assert path.mtime() != 0
+    assert not any(p.ext == ".tmp" for p in path.dirpath().listdir())
+
+@pytest.mark.parametrize("extension", collectFromFile.COMPRESSIONS)
+def test_nested_json_writes_compressed_copies(load_dict_with_year,
+                                              fake_project_dir, extension):
+    written = collectFromFile.dict_to_nested_json(
+        load_dict_with_year, 2009, 2009, compressions=[extension])
+    path = fake_project_dir.join("data", "2009", "BLA", "OSS.json")
+    sibling = fake_project_dir.join("data", "2009", "BLA",
+                                    f"OSS.json.{extension}")
+    assert str(sibling) in written[2009]
+    decompress = (gzip.decompress if extension == "gz"
+                  else pytest.importorskip("brotli").decompress)
+    assert decompress(sibling.read_binary()) == path.read_binary()
+    assert sibling.stat().mode & 0o777 == collectFromFile.FILE_MODE
+
+    os.utime(str(sibling), (path.mtime() + 1, path.mtime() + 1))
+    collectFromFile.dict_to_nested_json(
+        load_dict_with_year, 2009, 2009, compressions=[extension])
+    assert sibling.mtime() == path.mtime() + 1
+
+@pytest.mark.parametrize("backend", sorted(collectFromFile.JSON_BACKENDS))
+def test_json_backends_write_the_same_bytes(load_dict_with_year, backend,
+                                            monkeypatch):
+    monkeypatch.setattr(collectFromFile, "JSON_BACKEND", backend)
+    d = {2009: load_dict_with_year[2009], 2010: {"ALL": {}}}
+    streamed = b"".join(collectFromFile.iter_json_chunks(d))
+    assert streamed == collectFromFile.stdlib_json_dumps(d)
+    assert json.loads(streamed) == json.loads(json.dumps(d))
+
+def test_binary_export_matches_nested_json(load_dict_with_year,
+                                           fake_project_dir):
+    written = collectFromFile.dict_to_binary(load_dict_with_year, 2009, 2009)
+    assert written == {2009: [str(fake_project_dir.join("data", "2009",
+                                                        "stpp.bin"))]}
+    year_data = collectFromFile.load_binary_year(written[2009][0])
+    assert year_data["year"] == 2009
+    for demo, p in (("ALL", "OSS"), ("BLA", "ISS"), ("ASI", "EXP")):
+        view = json.loads(collectFromFile.nested_json_content(
+            collectFromFile.make_nested_rows(load_dict_with_year,
+                                             2009, demo, p)))
+        assert {str(district): row for district, row in
+                collectFromFile.binary_year_to_view(
+                    year_data, demo, p).items()} == view
+
+def test_query_index(load_dict_with_year):
+    index = query_server.DisciplineIndex(load_dict_with_year)
+    district = index.district(101902)
+    assert district["years"][2009]["BLA"]["OSS"] == {"C": 9333, "S": 8}
+    assert 2010 not in district["years"]
+    top = index.top(2009, "BLA", "OSS", 5)
+    assert len(top) == 5
+    assert [row["S"] for row in top] == sorted(
+        (row["S"] for row in top), reverse=True)
+    assert top[0]["S"] == max(
+        entry.get("S", 0) for district, entry in
+        load_dict_with_year[2009]["BLA"]["OSS"].items() if district != 0)
+    assert index.totals(2009)["ALL"]["OSS"] == 583121
+    assert index.district(5) is None
+
+def test_query_server_answers_http(load_dict_with_year):
+    index = query_server.DisciplineIndex(load_dict_with_year)
+    server = query_server.make_server(index, 0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+    try:
+        with urlopen(url + "/years/2009/BLA/OSS/top?n=2") as response:
+            assert json.loads(response.read()) == json.loads(json.dumps(
+                index.top(2009, "BLA", "OSS", 2)))
+        with pytest.raises(HTTPError) as error:
+            urlopen(url + "/years/2009/BLA/OSS/top?n=-1")
+        assert error.value.code == 400
+    finally:
+        server.shutdown()
+        server.server_close()
+
+@pytest.fixture()
+def cors_server(tmpdir, monkeypatch):
+
+    # scripts/cors_server.py on a free port, serving tmpdir.
+
+    path = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__)))), "scripts", "cors_server.py")
+    spec = importlib.util.spec_from_file_location("cors_server", path)
+    cors_server = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(cors_server)
+    handler = cors_server.CORSHTTPRequestHandler
+    monkeypatch.setattr(handler, "file_cache", cors_server.FileCache())
+    monkeypatch.setattr(handler, "log_message", lambda *args: None)
+    monkeypatch.chdir(tmpdir)
+    server = cors_server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    def get(path, headers=None):
+        connection = http.client.HTTPConnection("127.0.0.1",
+                                                server.server_address[1])
+        try:
+            connection.request("GET", path, headers=headers or {})
+            response = connection.getresponse()
+            return response.status, dict(response.getheaders()), \
+                response.read()
+        finally:
+            connection.close()
+
+    yield get
+    server.shutdown()
+    server.server_close()
+
+def test_cors_server_revalidates_with_etag(cors_server, tmpdir):
+    tmpdir.ensure("data", "2009", "BLA", "OSS.json").write_binary(b'{"a":1}')
+    status, headers, body = cors_server("/data/2009/BLA/OSS.json")
+    assert (status, body) == (200, b'{"a":1}')
+    assert headers["Access-Control-Allow-Origin"] == "*"
+    assert headers["Content-Length"] == "7"
+    status, headers, body = cors_server(
+        "/data/2009/BLA/OSS.json", {"If-None-Match": headers["ETag"]})
+    assert (status, body) == (304, b"")
+    assert "Content-Length" not in headers
+    assert headers["Access-Control-Allow-Origin"] == "*"
+    status, _, _ = cors_server("/data/2009/BLA/OSS.json",
+                               {"If-None-Match": '"other"'})
+    assert status == 200
+
+def test_cors_server_sends_precompressed_copies(cors_server, tmpdir):
+    path = tmpdir.ensure("data", "2009", "BLA", "OSS.json")
+    for extension, content in (("", b"plain"), (".gz", b"gzipped"),
+                               (".br", b"brotli")):
+        tmpdir.join("data", "2009", "BLA",
+                    "OSS.json" + extension).write_binary(content)
+    for accept, encoding, content in (
+            ("gzip, br", "br", b"brotli"),
+            ("gzip", "gzip", b"gzipped"),
+            ("br;q=0, gzip", "gzip", b"gzipped"),
+            ("identity", None, b"plain")):
+        status, headers, body = cors_server("/data/2009/BLA/OSS.json",
+                                            {"Accept-Encoding": accept})
+        assert (status, body) == (200, content)
+        assert headers.get("Content-Encoding") == encoding
+        assert headers["Vary"] == "Accept-Encoding"
+    # A copy older than the file is out of date, so it isn't sent.
+    mtime = path.mtime()
+    os.utime(str(path) + ".br", (mtime - 10, mtime - 10))
+    _, headers, body = cors_server("/data/2009/BLA/OSS.json",
+                                   {"Accept-Encoding": "gzip, br"})
+    assert (headers["Content-Encoding"], body) == ("gzip", b"gzipped")
+
+def test_cors_server_reloads_changed_files(cors_server, tmpdir):
+    path = tmpdir.ensure("data", "2009", "BLA", "OSS.json")
+    path.write_binary(b"old")
+    _, old_headers, body = cors_server("/data/2009/BLA/OSS.json")
+    assert body == b"old"
+    assert cors_server("/data/2009/BLA/OSS.json")[2] == b"old"
+    path.write_binary(b"newer")
+    mtime = path.mtime() + 10
+    os.utime(str(path), (mtime, mtime))
+    _, headers, body = cors_server("/data/2009/BLA/OSS.json")
+    assert body == b"newer"
+    assert headers["ETag"] != old_headers["ETag"]
+    assert cors_server("/data/2009/BLA/OSS.json",
+                       {"If-None-Match": old_headers["ETag"]})[0] == 200
+
+def test_sqlite_export_upserts_years(load_dict_with_year, load_charter_list,
+                                     fake_project_dir):
+    written = collectFromFile.dict_to_sqlite(load_dict_with_year, 2009, 2009,
+                                             charters=load_charter_list)
+    db_path = str(fake_project_dir.join("data", "processed", "stpp.sqlite"))
+    assert written == {2009: [db_path]}
+    query = ("SELECT district, C, S, P, aC, aP FROM facts WHERE variant = '' "
+             "AND year = 2009 AND demo = 'BLA' AND punishment = 'OSS' "
+             "AND district = 101902")
+    connection = sqlite3.connect(db_path)
+    assert connection.execute(query).fetchall() == [tuple(
+        collectFromFile.make_csv_row_demo(load_dict_with_year,
+                                          2009, "BLA", "OSS", 101902))]
+    count = connection.execute("SELECT COUNT(*) FROM facts").fetchone()
+    connection.close()
+
+    load_dict_with_year[2009]["BLA"]["OSS"][101902]["C"] = 1
+    collectFromFile.dict_to_sqlite(load_dict_with_year, 2009, 2009,
+                                   charters=load_charter_list)
+    connection = sqlite3.connect(db_path)
+    assert connection.execute(query).fetchone()[1] == 1
+    assert connection.execute("SELECT COUNT(*) FROM facts").fetchone() == count
+    assert connection.execute("SELECT charter FROM districts "
+                              "WHERE district = 101902").fetchone() == (0,)
+    connection.close()
+
+def test_synthetic_files_match_TEA_layout(fake_project_dir):
+    from makedata import synthetic
+    root = str(fake_project_dir)
+    assert synthetic.generate(root, 60, [2009], seed=1) == \
+        synthetic.generate(root, 60, iter([2009]), seed=1)
+    assert collectFromFile.check_for_input_files(2009, 2009)
+    districts = synthetic.SyntheticDistricts(60, seed=1)
+    assert collectFromFile.get_charters() == set(
+        districts.ids[districts.charter].tolist())
+    d = collectFromFile.add_year_to_dict(
+        2009, collectFromFile.make_empty_dict(2009, 2009),
+        show_progress=False)
+    assert set(d[2009]["ALL"]["POP"]) == set(
+        districts.ids[~districts.charter].tolist()) | {0}
+    assert d[2009]["BLA"]["OSS"][0]["C"] > 0
+    assert any("S" in entry for entry in d[2009]["HIS"]["ISS"].values())
+
 def test_report_nested_file_location():
     assert "through" not in collectFromFile.report_nested_file_location(2008, 2008)
     assert "through" in collectFromFile.report_nested_file_location(2006, 2016)
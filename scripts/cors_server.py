@@ -1,5 +1,18 @@
 """
-Allow CORS with python simple http server
+Static file server for the map and its data/ tree, allowing CORS.
+
+Each request is handled in its own thread. Responses carry an ETag and
+Cache-Control header, and a matching If-None-Match gets a 304. When the
+client accepts it, a precompressed copy written by
+"collectFromFile --precompress" (OSS.json.br or OSS.json.gz) is sent in
+place of the file. Small files are kept in memory in an LRU cache,
+and reloaded when their size or mtime changes.
+
+Usage:
+
+    python3 scripts/cors_server.py [port] [--directory DIR] [--max-age SECONDS]
+
+The directory defaults to the project folder containing index.html.
 
 Reference:
 
@@ -7,69 +20,198 @@ Reference:
 
 """
 
-import SimpleHTTPServer
+import argparse
+import email.utils
+import hashlib
+import io
+import os
+import socketserver
+import threading
+from collections import OrderedDict
+from http import HTTPStatus
+from http.server import HTTPServer, SimpleHTTPRequestHandler
+from typing import Optional, Tuple
+
+
+# Encodings of precompressed copies, in order of preference.
+
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+
+
+class CachedFile:
+
+    def __init__(self, content: bytes, stat: os.stat_result) -> None:
+        self.content = content
+        self.stat = stat
+        self.signature = (stat.st_size, stat.st_mtime_ns)
+        self.etag = '"' + hashlib.sha256(content).hexdigest()[:32] + '"'
+
+
+class FileCache:
+
+    """
+    A thread-safe LRU of file contents, limited by the total size of
+    the files it holds. Files bigger than max_file_size aren't cached."""
+
+    def __init__(self, max_size: int = 64 << 20,
+                 max_file_size: int = 4 << 20) -> None:
+        self.max_size = max_size
+        self.max_file_size = max_file_size
+        self.size = 0
+        self.entries: "OrderedDict[str, CachedFile]" = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, path: str, stat: os.stat_result) -> Optional[CachedFile]:
+        if stat.st_size > self.max_file_size:
+            return None
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None and entry.signature == (stat.st_size,
+                                                         stat.st_mtime_ns):
+                self.entries.move_to_end(path)
+                return entry
+        with open(path, 'rb') as f:
+            entry = CachedFile(f.read(), os.fstat(f.fileno()))
+        with self.lock:
+            old = self.entries.pop(path, None)
+            if old is not None:
+                self.size -= len(old.content)
+            self.entries[path] = entry
+            self.size += len(entry.content)
+            while self.size > self.max_size:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted.content)
+        return entry
 
-class CORSHTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
-    def send_head(self):
-        """Common code for GET and HEAD commands.
 
-        This sends the response code and MIME headers.
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
 
-        Return value is either a file object (which has to be copied
-        to the outputfile by the caller unless the command was HEAD,
-        and must be closed by the caller under all circumstances), or
-        None, in which case the caller has nothing further to do.
+
+class CORSHTTPRequestHandler(SimpleHTTPRequestHandler):
+
+    # Keeps connections open between requests. The headers and the body
+    # are sent separately, so without TCP_NODELAY each response on a
+    # kept-alive connection would wait for the client's delayed ACK.
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    file_cache = FileCache()
+    max_age = 300
+
+    def end_headers(self) -> None:
+        self.send_header("Access-Control-Allow-Origin", "*")
+        super().end_headers()
+
+    def accepted_encodings(self) -> set:
+        accepted = set()
+        for part in self.headers.get("Accept-Encoding", "").split(","):
+            encoding, _, params = part.strip().partition(";")
+            if params.replace(" ", "") not in ("q=0", "q=0.0", "q=0.00",
+                                               "q=0.000"):
+                accepted.add(encoding.strip().lower())
+        return accepted
+
+    def choose_file(self, path: str) -> Tuple[str, Optional[str],
+                                              os.stat_result]:
 
         """
+        Picks the precompressed copy of path the client prefers, if
+        there is one that's at least as new as path itself."""
+
+        stat = os.stat(path)
+        accepted = self.accepted_encodings()
+        for encoding, extension in ENCODINGS:
+            if encoding not in accepted:
+                continue
+            try:
+                compressed_stat = os.stat(path + extension)
+            except OSError:
+                continue
+            if compressed_stat.st_mtime_ns >= stat.st_mtime_ns:
+                return path + extension, encoding, compressed_stat
+        return path, None, stat
+
+    def etag_matches(self, etag: str) -> bool:
+        if_none_match = self.headers.get("If-None-Match")
+        if if_none_match is None:
+            return False
+        if if_none_match.strip() == "*":
+            return True
+        tags = (tag.strip() for tag in if_none_match.split(","))
+        return etag in (tag[2:] if tag.startswith("W/") else tag
+                        for tag in tags)
+
+    def send_head(self):
         path = self.translate_path(self.path)
-        f = None
-        if os.path.isdir(path):
-            if not self.path.endswith('/'):
-                # redirect browser - doing basically what apache does
-                self.send_response(301)
-                self.send_header("Location", self.path + "/")
-                self.end_headers()
-                return None
-            for index in "index.html", "index.htm":
-                index = os.path.join(path, index)
-                if os.path.exists(index):
-                    path = index
-                    break
-            else:
-                return self.list_directory(path)
-        ctype = self.guess_type(path)
+        if os.path.isdir(path) or not os.path.isfile(path):
+            # Redirects, directory listings and 404s as before.
+            return super().send_head()
         try:
-            # Always read in binary mode. Opening files in text mode may cause
-            # newline translations, making the actual size of the content
-            # transmitted *less* than the content-length!
-            f = open(path, 'rb')
-        except IOError:
-            self.send_error(404, "File not found")
+            file_path, encoding, stat = self.choose_file(path)
+            entry = self.file_cache.get(file_path, stat)
+            if entry is None:
+                f = open(file_path, 'rb')
+                stat = os.fstat(f.fileno())
+                etag = f'"{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+            else:
+                f = io.BytesIO(entry.content)
+                stat = entry.stat
+                etag = entry.etag
+        except OSError:
+            self.send_error(HTTPStatus.NOT_FOUND, "File not found")
             return None
-        self.send_response(200)
-        self.send_header("Content-type", ctype)
-        fs = os.fstat(f.fileno())
-        self.send_header("Content-Length", str(fs[6]))
-        self.send_header("Last-Modified", self.date_time_string(fs.st_mtime))
-        self.send_header("Access-Control-Allow-Origin", "*")
+        if self.etag_matches(etag):
+            f.close()
+            self.send_response(HTTPStatus.NOT_MODIFIED)
+            # No Content-Length, which in a 304 would describe the 200
+            # response that caches already have.
+            self.send_validators(etag, stat)
+            self.end_headers()
+            return None
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-type", self.guess_type(path))
+        if encoding is not None:
+            self.send_header("Content-Encoding", encoding)
+        self.send_header("Content-Length", str(stat.st_size))
+        self.send_validators(etag, stat)
         self.end_headers()
         return f
 
+    def send_validators(self, etag: str, stat: os.stat_result) -> None:
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified",
+                         email.utils.formatdate(stat.st_mtime, usegmt=True))
+        self.send_header("Cache-Control",
+                         f"public, max-age={self.max_age}")
+        self.send_header("Vary", "Accept-Encoding")
+        return None
 
-if __name__ == "__main__":
-
-    import os
-    import SocketServer
-    import sys
 
-    if len(sys.argv) >= 2:
-        PORT = int(sys.argv[1])
-    else:
-        PORT = 31338
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("port", type=int, nargs="?", default=31338)
+    parser.add_argument("--directory", default=os.path.dirname(
+        os.path.dirname(os.path.abspath(__file__))))
+    parser.add_argument("--max-age", type=int, default=300,
+                        help="Seconds browsers may reuse a file without "
+                        "checking its ETag.")
+    parser.add_argument("--cache-mb", type=int, default=64,
+                        help="Megabytes of files to keep in memory.")
+    args = parser.parse_args()
 
-    Handler = CORSHTTPRequestHandler
+    os.chdir(args.directory)
+    CORSHTTPRequestHandler.max_age = args.max_age
+    CORSHTTPRequestHandler.file_cache = FileCache(args.cache_mb << 20)
+    httpd = ThreadingHTTPServer(("", args.port), CORSHTTPRequestHandler)
+    print("serving", args.directory, "at port", args.port)
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    httpd.server_close()
 
-    httpd = SocketServer.TCPServer(("", PORT), Handler)
 
-    print "serving at port", PORT
-    httpd.serve_forever()
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+"""
+Measures requests per second against a server for the map's data files.
+
+Each client thread keeps one connection open and requests the JSON
+files under data/<year>/ in turn, for a fixed number of seconds.
+
+    python3 scripts/load_test.py http://localhost:31338/ --year 2009
+
+With --compare, starts the server in scripts/cors_server.py and one
+that behaves like the old Python 2 version (a single thread, no
+caching, and a new connection for every request), and tests both.
+With --revalidate, requests send the ETag from the first response in
+If-None-Match, like a browser checking its cache.
+"""
+
+import argparse
+import http.client
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+from typing import List, Tuple
+from urllib.parse import urlsplit
+
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The old server: SimpleHTTPServer on a single-threaded TCPServer,
+# adding only the CORS header.
+
+LEGACY_SERVER = """
+import sys
+from http.server import HTTPServer, SimpleHTTPRequestHandler
+
+class CORSHTTPRequestHandler(SimpleHTTPRequestHandler):
+    def end_headers(self):
+        self.send_header("Access-Control-Allow-Origin", "*")
+        super().end_headers()
+
+    def log_message(self, *args):
+        pass
+
+HTTPServer(("", int(sys.argv[1])), CORSHTTPRequestHandler).serve_forever()
+"""
+
+
+def find_paths(year: int) -> List[str]:
+    year_dir = os.path.join(PROJECT_DIR, 'data', str(year))
+    paths = []
+    for root, _, files in os.walk(year_dir):
+        for name in sorted(files):
+            if name.endswith('.json'):
+                relative = os.path.relpath(os.path.join(root, name),
+                                           PROJECT_DIR)
+                paths.append('/' + relative.replace(os.sep, '/'))
+    return sorted(paths)
+
+
+def run_client(url: str, paths: List[str], stop_at: float,
+               headers: dict, revalidate: bool,
+               results: List[Tuple[int, int, int]]) -> None:
+    parts = urlsplit(url)
+    connection = http.client.HTTPConnection(parts.hostname, parts.port)
+    etags = {}
+    count = failures = received = 0
+    i = 0
+    while time.monotonic() < stop_at:
+        path = paths[i % len(paths)]
+        i += 1
+        request_headers = dict(headers)
+        if revalidate and path in etags:
+            request_headers["If-None-Match"] = etags[path]
+        try:
+            connection.request("GET", path, headers=request_headers)
+            response = connection.getresponse()
+            received += len(response.read())
+        except (OSError, http.client.HTTPException):
+            failures += 1
+            connection.close()
+            connection = http.client.HTTPConnection(parts.hostname,
+                                                    parts.port)
+            continue
+        if response.status not in (200, 304):
+            failures += 1
+        elif response.getheader("ETag"):
+            etags[path] = response.getheader("ETag")
+        count += 1
+        if response.getheader("Connection", "").lower() == "close" or \
+                response.version == 10:
+            connection.close()
+    connection.close()
+    results.append((count, failures, received))
+
+
+def load_test(url: str, paths: List[str], clients: int, seconds: float,
+              headers: dict, revalidate: bool) -> dict:
+    results: List[Tuple[int, int, int]] = []
+    stop_at = time.monotonic() + seconds
+    threads = [threading.Thread(target=run_client,
+                                args=(url, paths, stop_at, headers,
+                                      revalidate, results))
+               for _ in range(clients)]
+    start = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - start
+    count = sum(result[0] for result in results)
+    return {"requests": count,
+            "failures": sum(result[1] for result in results),
+            "megabytes": sum(result[2] for result in results) / 1e6,
+            "requests_per_second": count / elapsed}
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(command: List[str], port: int) -> subprocess.Popen:
+    server = subprocess.Popen(command, cwd=PROJECT_DIR,
+                              stdout=subprocess.DEVNULL,
+                              stderr=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            socket.create_connection(("127.0.0.1", port), 0.1).close()
+            return server
+        except OSError:
+            time.sleep(0.05)
+    server.kill()
+    raise RuntimeError(f"Server on port {port} didn't start")
+
+
+def report(name: str, result: dict) -> None:
+    print(f"{name:10} {result['requests_per_second']:10.1f} req/s "
+          f"{result['requests']:8} requests {result['failures']:6} "
+          f"failures {result['megabytes']:10.1f} MB")
+    return None
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("url", nargs="?", default="http://127.0.0.1:31338/")
+    parser.add_argument("--year", type=int, default=2016)
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--gzip", action="store_true",
+                        help="Sends Accept-Encoding: gzip, br.")
+    parser.add_argument("--revalidate", action="store_true")
+    parser.add_argument("--compare", action="store_true")
+    args = parser.parse_args()
+
+    paths = find_paths(args.year)
+    if not paths:
+        sys.exit(f"No JSON files found in data/{args.year}")
+    headers = {"Accept-Encoding": "gzip, br"} if args.gzip else {}
+    print(f"{args.clients} clients, {args.seconds} seconds, "
+          f"{len(paths)} files from data/{args.year}")
+
+    if not args.compare:
+        report("server", load_test(args.url, paths, args.clients,
+                                   args.seconds, headers, args.revalidate))
+        return None
+
+    servers = {
+        "old": [sys.executable, "-c", LEGACY_SERVER],
+        "new": [sys.executable,
+                os.path.join(PROJECT_DIR, 'scripts', 'cors_server.py')]}
+    for name, command in servers.items():
+        port = free_port()
+        server = start_server(command + [str(port)], port)
+        try:
+            report(name, load_test(f"http://127.0.0.1:{port}/", paths,
+                                   args.clients, args.seconds, headers,
+                                   args.revalidate))
+        finally:
+            server.terminate()
+            server.wait()
+    return None
+
+
+if __name__ == "__main__":
+    main()